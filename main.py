@@ -5,12 +5,27 @@ import json
 import time
 import sqlite3
 import hashlib
+import hmac
+import socket
+import queue
+import atexit
+import gzip
+import shutil
+import random
+import heapq
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from collections import deque, OrderedDict
 from datetime import datetime, timezone, timedelta
 from dotenv import load_dotenv
-from flask import Flask
-from threading import Thread
+from flask import Flask, request, abort
+from threading import Thread, Lock, RLock, Event
 from typing import Dict, List, Optional, Tuple
 import traceback
+import threading
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FuturesTimeout
 
 # ==================== CONFIGURAÇÃO ====================
 load_dotenv()
@@ -63,10 +78,10 @@ class PizzaSabor:
     }
 
     TAMANHOS = {
-        "pequena": {"nome": "Pequena", "multiplicador": 0.7, "diametro": "25cm"},
-        "media": {"nome": "Média", "multiplicador": 0.85, "diametro": "30cm"},
-        "grande": {"nome": "Grande", "multiplicador": 1.0, "diametro": "35cm"},
-        "familia": {"nome": "Família", "multiplicador": 1.3, "diametro": "45cm"}
+        "pequena": {"nome": "Pequena", "multiplicador": 0.7, "diametro": "25cm", "fatias": 4},
+        "media": {"nome": "Média", "multiplicador": 0.85, "diametro": "30cm", "fatias": 6},
+        "grande": {"nome": "Grande", "multiplicador": 1.0, "diametro": "35cm", "fatias": 8},
+        "familia": {"nome": "Família", "multiplicador": 1.3, "diametro": "45cm", "fatias": 12}
     }
 
     STATUS = {
@@ -137,6 +152,28 @@ def home():
     </html>
     """.format(datetime.now().strftime("%d/%m/%Y %H:%M:%S"))
 
+@app.route('/webhook/<segredo>', methods=['POST'])
+def webhook(segredo):
+    """Recebe updates do Telegram (ou gravados, via POST local) e entrega ao pool de processamento"""
+    cabecalho = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+    esperado = WEBHOOK_SEGREDO.encode()
+    if not (hmac.compare_digest(segredo.encode(), esperado) and hmac.compare_digest(cabecalho.encode(), esperado)):
+        abort(403)
+
+    dados = request.get_json(silent=True)
+    if not isinstance(dados, (dict, list)):
+        abort(400)
+
+    # Aceita um update ou uma lista deles (facilita reenviar updates gravados)
+    try:
+        updates = [telebot.types.Update.de_json(item) for item in (dados if isinstance(dados, list) else [dados])]
+    except Exception as e:
+        logger.log("warning", f"⚠️ Update inválido recebido no webhook: {e}")
+        abort(400)
+
+    receber_updates(updates)
+    return '', 200
+
 def run_web_server():
     port = int(os.environ.get("PORT", 8080))
     app.run(host='0.0.0.0', port=port, debug=False)
@@ -156,24 +193,302 @@ if not CHAVE_API:
     print("❌ ERRO: TELEGRAM_TOKEN não encontrado")
     sys.exit(1)
 
-bot = telebot.TeleBot(CHAVE_API, parse_mode="Markdown")
+# Ingestão de updates: "polling" (padrão) ou "webhook" pela rota /webhook/<segredo> do Flask
+BOT_MODO = os.getenv("BOT_MODO", "polling").strip().lower()
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")  # base pública, ex: https://romeo.exemplo.com
+# Sem WEBHOOK_SECRET, deriva do token: estável entre instâncias atrás do mesmo balanceador
+WEBHOOK_SEGREDO = os.getenv("WEBHOOK_SECRET") or hashlib.sha256(CHAVE_API.encode()).hexdigest()[:32]
+
+if BOT_MODO not in ("polling", "webhook"):
+    print(f"❌ ERRO: BOT_MODO inválido: {BOT_MODO} (use polling ou webhook)")
+    sys.exit(1)
+
+if not all(c.isascii() and (c.isalnum() or c in "_-") for c in WEBHOOK_SEGREDO) or len(WEBHOOK_SEGREDO) > 256:
+    print("❌ ERRO: WEBHOOK_SECRET aceita apenas A-Z, a-z, 0-9, _ e - (até 256 caracteres)")
+    sys.exit(1)
+
+telebot.apihelper.ENABLE_MIDDLEWARE = True
+# Sem o pool interno do TeleBot: a concorrência fica no PoolProcessamento (por chat)
+bot = telebot.TeleBot(CHAVE_API, parse_mode="Markdown", threaded=False)
+
+# ==================== TRANSPORTE HTTP ====================
+class TransporteHTTP:
+    """Conexões HTTP compartilhadas: pools keep-alive e timeouts por tipo de operação (Telegram e Supabase)"""
+
+    # (conexão, leitura) em segundos; sobrescreva com HTTP_TIMEOUT_<TIPO>="conexão,leitura"
+    TIMEOUTS_PADRAO = {
+        "envio": (5.0, 15.0),
+        "edicao": (5.0, 10.0),
+        "upload": (10.0, 120.0),
+        "banco": (3.0, 10.0),
+        "outros": (10.0, 30.0),
+    }
+
+    def __init__(self):
+        self.timeouts = {}
+        for tipo, padrao in self.TIMEOUTS_PADRAO.items():
+            try:
+                conexao, leitura = os.getenv(f"HTTP_TIMEOUT_{tipo.upper()}", "").split(",")
+                self.timeouts[tipo] = (float(conexao), float(leitura))
+            except ValueError:
+                self.timeouts[tipo] = padrao
+
+        # Um slot por thread que faz chamadas (mesmos padrões dos pools de envio, processamento e leitura)
+        self.pool_telegram = int(os.getenv("HTTP_POOL_TELEGRAM", int(os.getenv("ENVIO_WORKERS", 8)) + 2))
+        self.pool_supabase = int(os.getenv(
+            "HTTP_POOL_SUPABASE",
+            int(os.getenv("PROCESSAMENTO_WORKERS", 8)) + int(os.getenv("LEITURA_WORKERS_REMOTOS", 4)) + 3
+        ))
+        self.keepalive = float(os.getenv("HTTP_KEEPALIVE", 60))
+
+        # Só repete falhas de conexão: a requisição ainda não saiu, então não há risco de envio duplicado
+        self.adaptador = HTTPAdapter(
+            pool_connections=2,
+            pool_maxsize=self.pool_telegram,
+            max_retries=Retry(connect=2, read=0, redirect=0, status=0, backoff_factor=0.2)
+        )
+        self.sessao = requests.Session()
+        self.sessao.mount("https://", self.adaptador)
+        self.sessao.mount("http://", self.adaptador)
+
+        self._lock = Lock()
+        self.chamadas = {}  # tipo -> (quantidade, total_ms)
+        self.supabase_requisicoes = 0
+        self.supabase_conexoes = 0
+
+    # ---- Telegram (requests) ----
+
+    @staticmethod
+    def tipo_telegram(url: str, files) -> str:
+        metodo = url.rsplit("/", 1)[-1]
+        if metodo == "getUpdates":
+            return "polling"
+        if files:
+            return "upload"
+        if metodo.startswith("send"):
+            return "envio"
+        if metodo.startswith("edit"):
+            return "edicao"
+        return "outros"
+
+    def enviar_telegram(self, method, url, params=None, files=None, timeout=None, proxies=None):
+        """CUSTOM_REQUEST_SENDER do TeleBot: sessão única e timeout conforme o tipo de chamada"""
+        tipo = self.tipo_telegram(url, files)
+        if tipo != "polling":
+            timeout = self.timeouts[tipo]  # no polling vale o do TeleBot, ajustado ao long polling
+
+        inicio = time.monotonic()
+        try:
+            return self.sessao.request(method, url, params=params, files=files, timeout=timeout, proxies=proxies)
+        finally:
+            ms = (time.monotonic() - inicio) * 1000
+            with self._lock:
+                quantidade, total = self.chamadas.get(tipo, (0, 0.0))
+                self.chamadas[tipo] = (quantidade + 1, total + ms)
+
+    def _contadores_telegram(self) -> Tuple[int, int]:
+        """(requisições, conexões abertas) somados nos pools do urllib3"""
+        requisicoes = conexoes = 0
+        pools = self.adaptador.poolmanager.pools
+        for chave in list(pools.keys()):
+            pool = pools.get(chave)
+            if pool is not None:
+                requisicoes += pool.num_requests
+                conexoes += pool.num_connections
+        return requisicoes, conexoes
+
+    # ---- Supabase (httpx) ----
+
+    def configurar_supabase(self, cliente):
+        """Troca a sessão httpx do PostgREST por uma com pool dimensionado, keep-alive e timeouts de banco"""
+        try:
+            import httpx
+            from postgrest.utils import SyncClient
+        except ImportError:
+            return
+
+        postgrest = cliente.postgrest
+        anterior = postgrest.session
+        conexao, leitura = self.timeouts["banco"]
+        try:
+            # HTTP/1.1 com keep-alive: não depende do pacote h2
+            sessao = SyncClient(
+                base_url=anterior.base_url,
+                headers=anterior.headers,
+                timeout=httpx.Timeout(leitura, connect=conexao),
+                limits=httpx.Limits(
+                    max_connections=self.pool_supabase,
+                    max_keepalive_connections=self.pool_supabase,
+                    keepalive_expiry=self.keepalive
+                ),
+                event_hooks={"request": [self._rastrear_supabase]},
+                follow_redirects=True,
+            )
+        except Exception as e:
+            # Sem o pool próprio o cliente padrão do PostgREST continua funcionando
+            logger.log("warning", f"⚠️ Pool HTTP do Supabase não configurado: {e}")
+            return
+
+        postgrest.session = sessao
+        anterior.close()
+
+    def _rastrear_supabase(self, requisicao):
+        with self._lock:
+            self.supabase_requisicoes += 1
+        requisicao.extensions["trace"] = self._evento_supabase
+
+    def _evento_supabase(self, evento: str, info: Dict):
+        if evento == "connection.connect_tcp.complete":
+            with self._lock:
+                self.supabase_conexoes += 1
+
+    # ---- Métricas ----
+
+    @staticmethod
+    def _reuso(requisicoes: int, conexoes: int) -> str:
+        if not requisicoes:
+            return "sem requisições"
+        return f"{requisicoes} req, {conexoes} conexões (reuso {max(0.0, 1 - conexoes / requisicoes) * 100:.0f}%)"
+
+    def resumo(self) -> List[str]:
+        with self._lock:
+            chamadas = dict(self.chamadas)
+            supabase = (self.supabase_requisicoes, self.supabase_conexoes)
+
+        linhas = [
+            f"Telegram: {self._reuso(*self._contadores_telegram())} | pool {self.pool_telegram}",
+            f"Supabase: {self._reuso(*supabase)} | pool {self.pool_supabase}",
+        ]
+        if chamadas:
+            linhas.append("Latência: " + ", ".join(
+                f"{tipo} {quantidade}x {total / quantidade:.0f}ms" for tipo, (quantidade, total) in sorted(chamadas.items())
+            ))
+        linhas.append("Timeouts (conexão/leitura): " + ", ".join(
+            f"{tipo} {conexao:g}/{leitura:g}s" for tipo, (conexao, leitura) in self.timeouts.items()
+        ))
+        return linhas
+
+transporte = TransporteHTTP()
+telebot.apihelper.CUSTOM_REQUEST_SENDER = transporte.enviar_telegram
 
 # ==================== SISTEMA DE LOG ====================
+NIVEIS_LOG = {"debug": 10, "info": 20, "success": 25, "warning": 30, "error": 40}
+
 class Logger:
-    """Sistema de logging avançado"""
+    """Sistema de logging avançado (JSON Lines com escrita em segundo plano)"""
     def __init__(self):
-        self.log_file = "bot_logs.json"
-        self.max_logs = 1000
+        self.log_file = os.getenv("LOG_FILE", "bot_logs.jsonl")
+        self.legacy_file = "bot_logs.json"
+        self.tamanho_lote = int(os.getenv("LOG_TAMANHO_LOTE", 200))
+        self.intervalo_flush = float(os.getenv("LOG_INTERVALO_FLUSH", 1.0))
+        # Política de fsync: "nunca", "lote" (a cada lote) ou "intervalo"
+        self.politica_fsync = os.getenv("LOG_FSYNC", "intervalo").lower()
+        self.intervalo_fsync = float(os.getenv("LOG_INTERVALO_FSYNC", 5.0))
+        # Rotação: segmentos selados são comprimidos com gzip e indexados
+        self.diretorio_segmentos = os.getenv("LOG_DIR", "logs")
+        self.tamanho_segmento = int(os.getenv("LOG_TAMANHO_SEGMENTO", 5 * 1024 * 1024))
+        self.max_segmentos = int(os.getenv("LOG_MAX_SEGMENTOS", 50))
+        self.fila = queue.Queue(maxsize=int(os.getenv("LOG_FILA_MAX", 10000)))
+        self.descartados = 0
+
+        # Filtro por nível (aplicado antes de qualquer formatação)
+        self.nivel_minimo = NIVEIS_LOG.get(os.getenv("LOG_NIVEL_MINIMO", "debug").lower(), 10)
+        self.nivel_console = NIVEIS_LOG.get(os.getenv("LOG_NIVEL_CONSOLE", "debug").lower(), 10)
+
+        # Amostragem e limite por chave de mensagem: chave -> (limite, janela, amostra)
+        self.regras_chave = {}
+        self._janelas = {}  # (chave, chat_id) -> [inicio_janela, aceitos, suprimidos]
+        self._lock_janelas = Lock()
+        self.intervalo_resumo = float(os.getenv("LOG_INTERVALO_RESUMO", 60))
+        self._ultimo_resumo = time.monotonic()
+        self._lock_descartados = Lock()
+        self._ultimo_fsync = time.monotonic()
         self.setup_logs()
+        self._indice_ativo = self._indexar_arquivo(self.log_file)
+
+        # Buffer circular dos registros recentes + contadores por nível (sem I/O nas consultas)
+        self.buffer_recentes = deque(maxlen=int(os.getenv("LOG_BUFFER_RECENTES", 500)))
+        self.contadores = {}
+        self._lock_contadores = Lock()
+        self._carregar_estado_inicial()
+
+        self._writer = Thread(target=self._loop_escrita, name="log-writer", daemon=True)
+        self._writer.start()
+        atexit.register(self.fechar)
 
     def setup_logs(self):
-        """Inicializa arquivo de logs"""
-        if not os.path.exists(self.log_file):
-            with open(self.log_file, 'w', encoding='utf-8') as f:
-                json.dump([], f)
+        """Inicializa arquivo de logs (migrando o formato antigo, se existir)"""
+        os.makedirs(self.diretorio_segmentos, exist_ok=True)
+        if os.path.exists(self.log_file):
+            return
+
+        logs_antigos = []
+        if os.path.exists(self.legacy_file):
+            try:
+                with open(self.legacy_file, 'r', encoding='utf-8') as f:
+                    logs_antigos = json.load(f)
+            except Exception as e:
+                print(f"⚠️ Não foi possível migrar {self.legacy_file}: {e}")
+
+        with open(self.log_file, 'w', encoding='utf-8') as f:
+            for entry in logs_antigos:
+                f.write(json.dumps(entry, ensure_ascii=False, separators=(',', ':')) + "\n")
+
+    def configurar_chave(self, chave: str, limite: int = None, janela: float = 60.0, amostra: float = 1.0):
+        """Define limite por chat/janela e taxa de amostragem para uma chave de mensagem"""
+        self.regras_chave[chave] = (limite, janela, amostra)
+
+    def _permitir(self, chave: str, chat_id) -> bool:
+        """Aplica amostragem e limite de taxa para (chave, chat_id)"""
+        limite, janela, amostra = self.regras_chave.get(chave, (None, 60.0, 1.0))
+        resumo = None
+
+        with self._lock_janelas:
+            agora = time.monotonic()
+            estado = self._janelas.get((chave, chat_id))
+            if estado is None or agora - estado[0] >= janela:
+                if estado and estado[2]:
+                    resumo = estado[2]
+                estado = [agora, 0, 0]
+                self._janelas[(chave, chat_id)] = estado
+
+            permitido = (amostra >= 1.0 or random.random() < amostra) and \
+                        (limite is None or estado[1] < limite)
+            if permitido:
+                estado[1] += 1
+            else:
+                estado[2] += 1
+
+        if resumo:
+            self._registrar_resumo(chave, chat_id, resumo)
+        return permitido
+
+    def _registrar_resumo(self, chave: str, chat_id, suprimidos: int):
+        self.log("info", f"🔇 {suprimidos} registro(s) '{chave}' suprimido(s) pelo limite de taxa", chat_id)
+
+    def _emitir_resumos(self):
+        """Emite o total suprimido das janelas encerradas e libera a memória delas"""
+        encerradas = []
+        with self._lock_janelas:
+            agora = time.monotonic()
+            for (chave, chat_id), estado in list(self._janelas.items()):
+                janela = self.regras_chave.get(chave, (None, 60.0, 1.0))[1]
+                if agora - estado[0] >= janela:
+                    del self._janelas[(chave, chat_id)]
+                    if estado[2]:
+                        encerradas.append((chave, chat_id, estado[2]))
+            self._ultimo_resumo = agora
+
+        for chave, chat_id, suprimidos in encerradas:
+            self._registrar_resumo(chave, chat_id, suprimidos)
+
+    def log(self, nivel: str, mensagem: str, chat_id: str = None, chave: str = None):
+        """Registra um log (chave opcional ativa amostragem/limite por chat)"""
+        if NIVEIS_LOG.get(nivel, 20) < self.nivel_minimo:
+            return
+        if chave is not None and not self._permitir(chave, chat_id):
+            return
 
-    def log(self, nivel: str, mensagem: str, chat_id: str = None):
-        """Registra um log"""
         timestamp = datetime.now(timezone.utc).isoformat()
         log_entry = {
             "timestamp": timestamp,
@@ -182,18 +497,20 @@ class Logger:
             "chat_id": str(chat_id) if chat_id else None
         }
 
-        # Salvar em arquivo
+        self.buffer_recentes.append(log_entry)
+
+        # Enfileirar para o writer (nunca bloqueia o handler); só conta o que vai para o arquivo
         try:
-            with open(self.log_file, 'r+', encoding='utf-8') as f:
-                logs = json.load(f)
-                logs.append(log_entry)
-                if len(logs) > self.max_logs:
-                    logs = logs[-self.max_logs:]
-                f.seek(0)
-                json.dump(logs, f, ensure_ascii=False, indent=2)
-                f.truncate()
-        except Exception as e:
-            print(f"❌ Erro ao salvar log: {e}")
+            self.fila.put_nowait(log_entry)
+        except queue.Full:
+            with self._lock_descartados:
+                self.descartados += 1
+        else:
+            with self._lock_contadores:
+                self.contadores[nivel] = self.contadores.get(nivel, 0) + 1
+
+        if NIVEIS_LOG.get(nivel, 20) < self.nivel_console:
+            return
 
         # Imprimir no console com cores
         cores = {
@@ -209,16 +526,1170 @@ class Logger:
         hora = datetime.fromisoformat(timestamp).strftime("%H:%M:%S")
         print(f"{cor}[{nivel.upper():8}] {hora} - {mensagem}{reset}")
 
+    def _carregar_estado_inicial(self):
+        """Preenche buffer e contadores a partir dos índices e do fim do segmento ativo"""
+        contadores = dict(self._indice_ativo["niveis"])
+        for base in self._listar_segmentos():
+            try:
+                with open(base + ".idx.json", 'r', encoding='utf-8') as f:
+                    niveis = json.load(f).get("niveis", {})
+            except Exception:
+                continue
+            for nivel, quantidade in niveis.items():
+                contadores[nivel] = contadores.get(nivel, 0) + quantidade
+        self.contadores = contadores
+
+        try:
+            self.buffer_recentes.extend(self.ler_ultimos(self.buffer_recentes.maxlen))
+        except Exception as e:
+            print(f"⚠️ Não foi possível carregar logs recentes: {e}")
+
+    def recentes(self, limite: int = 15, nivel: str = None) -> List[Dict]:
+        """Últimos registros em memória, opcionalmente filtrados por nível"""
+        registros = list(self.buffer_recentes)
+        if nivel:
+            registros = [r for r in registros if r.get("nivel") == nivel]
+        return registros[-limite:] if limite > 0 else []
+
+    @property
+    def total_registros(self) -> int:
+        return sum(self.contadores.values())
+
+    def _loop_escrita(self):
+        """Consome a fila e grava os logs em lotes no arquivo"""
+        while True:
+            if time.monotonic() - self._ultimo_resumo >= self.intervalo_resumo:
+                self._emitir_resumos()
+
+            try:
+                entry = self.fila.get(timeout=self.intervalo_flush)
+            except queue.Empty:
+                continue
+
+            lote = [entry]
+            while len(lote) < self.tamanho_lote:
+                try:
+                    lote.append(self.fila.get_nowait())
+                except queue.Empty:
+                    break
+
+            encerrar = None in lote
+            registros = [e for e in lote if e is not None]
+
+            try:
+                if registros:
+                    self._gravar_lote(registros)
+            except Exception as e:
+                print(f"❌ Erro ao salvar log: {e}")
+            finally:
+                for _ in lote:
+                    self.fila.task_done()
+
+            if encerrar:
+                return
+
+    def _gravar_lote(self, registros: List[Dict]):
+        """Anexa um lote de registros ao arquivo JSON Lines"""
+        linhas = "".join(
+            json.dumps(r, ensure_ascii=False, separators=(',', ':')) + "\n"
+            for r in registros
+        )
+
+        with open(self.log_file, 'a', encoding='utf-8') as f:
+            f.write(linhas)
+            f.flush()
+
+            agora = time.monotonic()
+            if self.politica_fsync == "lote" or (
+                self.politica_fsync == "intervalo" and agora - self._ultimo_fsync >= self.intervalo_fsync
+            ):
+                os.fsync(f.fileno())
+                self._ultimo_fsync = agora
+
+            tamanho_atual = f.tell()
+
+        for registro in registros:
+            self._atualizar_indice(self._indice_ativo, registro)
+
+        if tamanho_atual >= self.tamanho_segmento:
+            self._selar_segmento()
+
+    @staticmethod
+    def _novo_indice() -> Dict:
+        return {"inicio": None, "fim": None, "linhas": 0, "niveis": {}, "chat_ids": set()}
+
+    @staticmethod
+    def _atualizar_indice(indice: Dict, registro: Dict):
+        """Acrescenta um registro ao índice de um segmento"""
+        timestamp = registro.get("timestamp")
+        if timestamp:
+            if indice["inicio"] is None or timestamp < indice["inicio"]:
+                indice["inicio"] = timestamp
+            if indice["fim"] is None or timestamp > indice["fim"]:
+                indice["fim"] = timestamp
+
+        nivel = registro.get("nivel", "info")
+        indice["niveis"][nivel] = indice["niveis"].get(nivel, 0) + 1
+        if registro.get("chat_id"):
+            indice["chat_ids"].add(registro["chat_id"])
+        indice["linhas"] += 1
+
+    def _indexar_arquivo(self, caminho: str) -> Dict:
+        """Reconstrói o índice de um arquivo JSON Lines não comprimido"""
+        indice = self._novo_indice()
+        if not os.path.exists(caminho):
+            return indice
+
+        with open(caminho, 'r', encoding='utf-8') as f:
+            for linha in f:
+                try:
+                    self._atualizar_indice(indice, json.loads(linha))
+                except ValueError:
+                    continue
+        return indice
+
+    def _selar_segmento(self):
+        """Comprime o segmento ativo, grava o índice e inicia um novo segmento"""
+        nome = f"{os.path.splitext(os.path.basename(self.log_file))[0]}." \
+               f"{datetime.now(timezone.utc).strftime('%Y%m%d%H%M%S%f')}"
+        base = os.path.join(self.diretorio_segmentos, nome)
+        temporario = base + ".jsonl"
+
+        os.replace(self.log_file, temporario)
+        indice = self._indice_ativo
+        self._indice_ativo = self._novo_indice()
+
+        with open(temporario, 'rb') as origem, gzip.open(base + ".jsonl.gz", 'wb') as destino:
+            shutil.copyfileobj(origem, destino)
+
+        indice_serializado = dict(indice, chat_ids=sorted(indice["chat_ids"]))
+        with open(base + ".idx.json", 'w', encoding='utf-8') as f:
+            json.dump(indice_serializado, f, ensure_ascii=False, separators=(',', ':'))
+        os.remove(temporario)
+
+        # Retenção: remover os segmentos mais antigos (e descontá-los dos contadores)
+        segmentos = self._listar_segmentos()
+        for antigo in segmentos[:-self.max_segmentos] if self.max_segmentos > 0 else []:
+            try:
+                with open(antigo + ".idx.json", 'r', encoding='utf-8') as f:
+                    niveis = json.load(f).get("niveis", {})
+            except Exception:
+                niveis = {}
+            with self._lock_contadores:
+                for nivel, quantidade in niveis.items():
+                    self.contadores[nivel] = max(self.contadores.get(nivel, 0) - quantidade, 0)
+
+            for sufixo in (".jsonl.gz", ".idx.json"):
+                try:
+                    os.remove(antigo + sufixo)
+                except FileNotFoundError:
+                    pass
+
+    def _listar_segmentos(self) -> List[str]:
+        """Lista os segmentos selados (sem extensão), do mais antigo ao mais novo"""
+        if not os.path.isdir(self.diretorio_segmentos):
+            return []
+        return sorted(
+            os.path.join(self.diretorio_segmentos, nome[:-len(".idx.json")])
+            for nome in os.listdir(self.diretorio_segmentos)
+            if nome.endswith(".idx.json")
+        )
+
+    def consultar(self, nivel: str = None, chat_id: str = None,
+                  desde: datetime = None, ate: datetime = None, limite: int = 100) -> List[Dict]:
+        """Busca logs por nível, chat e intervalo, abrindo só os segmentos relevantes"""
+        self.flush()
+        chat_id = str(chat_id) if chat_id else None
+        desde_iso = desde.astimezone(timezone.utc).isoformat() if desde else None
+        ate_iso = ate.astimezone(timezone.utc).isoformat() if ate else None
+
+        def indice_relevante(indice: Dict) -> bool:
+            if not indice["linhas"]:
+                return False
+            if nivel and nivel not in indice["niveis"]:
+                return False
+            if chat_id and chat_id not in indice["chat_ids"]:
+                return False
+            if desde_iso and indice["fim"] < desde_iso:
+                return False
+            if ate_iso and indice["inicio"] > ate_iso:
+                return False
+            return True
+
+        def registro_relevante(registro: Dict) -> bool:
+            if nivel and registro.get("nivel") != nivel:
+                return False
+            if chat_id and registro.get("chat_id") != chat_id:
+                return False
+            timestamp = registro.get("timestamp", "")
+            if desde_iso and timestamp < desde_iso:
+                return False
+            if ate_iso and timestamp > ate_iso:
+                return False
+            return True
+
+        arquivos = []
+        for base in self._listar_segmentos():
+            try:
+                with open(base + ".idx.json", 'r', encoding='utf-8') as f:
+                    indice = json.load(f)
+                indice["chat_ids"] = set(indice.get("chat_ids", []))
+            except Exception:
+                continue
+            if indice_relevante(indice):
+                arquivos.append(base + ".jsonl.gz")
+        arquivos.append(self.log_file)
+
+        resultados = deque(maxlen=limite)
+        for caminho in arquivos:
+            abrir = gzip.open if caminho.endswith(".gz") else open
+            try:
+                with abrir(caminho, 'rt', encoding='utf-8') as f:
+                    for linha in f:
+                        try:
+                            registro = json.loads(linha)
+                        except ValueError:
+                            continue
+                        if registro_relevante(registro):
+                            resultados.append(registro)
+            except FileNotFoundError:
+                # Segmento removido pela retenção durante a leitura
+                continue
+
+        return list(resultados)
+
+    def flush(self, timeout: float = 5.0):
+        """Aguarda até que todos os logs enfileirados estejam gravados"""
+        limite = time.monotonic() + timeout
+        while self.fila.unfinished_tasks and time.monotonic() < limite:
+            time.sleep(0.01)
+
+    def fechar(self):
+        """Grava os logs pendentes e encerra o writer"""
+        if not self._writer.is_alive():
+            return
+        try:
+            self.fila.put(None, timeout=1)
+        except queue.Full:
+            pass
+        self._writer.join(timeout=5)
+
+    def ler_ultimos(self, limite: int = 15) -> List[Dict]:
+        """Retorna os últimos registros gravados no arquivo"""
+        self.flush()
+        if not os.path.exists(self.log_file):
+            return []
+
+        with open(self.log_file, 'r', encoding='utf-8') as f:
+            linhas = deque(f, maxlen=limite)
+
+        registros = []
+        for linha in linhas:
+            try:
+                registros.append(json.loads(linha))
+            except ValueError:
+                continue
+        return registros
+
 logger = Logger()
+logger.configurar_chave(
+    "mensagem_nao_reconhecida",
+    limite=int(os.getenv("LOG_LIMITE_NAO_RECONHECIDA", 3)),
+    janela=60
+)
+logger.configurar_chave("menu", limite=int(os.getenv("LOG_LIMITE_MENU", 5)), janela=60)
+
+# ==================== CONEXÕES SQLITE ====================
+class ConexoesSQLite:
+    """Conexões SQLite por thread em modo WAL, com uma única via de escrita"""
+    def __init__(self, caminho: str):
+        self.caminho = caminho
+        self.busy_timeout_ms = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", 5000))
+        self.synchronous = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL").upper()
+        self.lock_escrita = RLock()
+        self._local = threading.local()
+        self._conexoes = []
+        self._lock_conexoes = Lock()
+
+        conn = self.conexao()
+        self.journal_mode = conn.execute("PRAGMA journal_mode=WAL").fetchone()[0]
+
+    def _abrir(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.caminho,
+            timeout=self.busy_timeout_ms / 1000,
+            check_same_thread=False
+        )
+        conn.row_factory = sqlite3.Row
+        conn.execute(f"PRAGMA busy_timeout = {self.busy_timeout_ms}")
+        conn.execute(f"PRAGMA synchronous = {self.synchronous}")
+        conn.execute("PRAGMA temp_store = MEMORY")
+
+        with self._lock_conexoes:
+            self._conexoes.append(conn)
+        return conn
+
+    def conexao(self) -> sqlite3.Connection:
+        """Conexão exclusiva da thread atual (leituras não disputam com a escrita)"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._abrir()
+            self._local.conn = conn
+            self._local.profundidade = 0
+        return conn
+
+    @contextmanager
+    def escrita(self):
+        """Transação de escrita serializada; transações aninhadas reaproveitam a externa"""
+        with self.lock_escrita:
+            conn = self.conexao()
+            self._local.profundidade += 1
+            try:
+                yield conn
+                if self._local.profundidade == 1:
+                    conn.commit()
+            except Exception:
+                if self._local.profundidade == 1:
+                    conn.rollback()
+                raise
+            finally:
+                self._local.profundidade -= 1
+
+    def fechar(self):
+        with self._lock_conexoes:
+            for conn in self._conexoes:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+            self._conexoes.clear()
+
+# ==================== DISJUNTOR (CIRCUIT BREAKER) ====================
+try:
+    from postgrest.exceptions import APIError as ErroRespostaSupabase
+except ImportError:
+    ErroRespostaSupabase = None
+
+class CircuitoAberto(Exception):
+    """Chamada recusada sem tocar a rede porque o disjuntor está aberto"""
+
+class Disjuntor:
+    """Circuit breaker (fechado → aberto → meio_aberto) com sonda de recuperação em segundo plano"""
+
+    def __init__(self, nome: str):
+        self.nome = nome
+        self.limite_falhas = int(os.getenv("DISJUNTOR_LIMITE_FALHAS", 3))
+        self.tempo_aberto = float(os.getenv("DISJUNTOR_TEMPO_ABERTO", 30))
+        self.intervalo_sonda = float(os.getenv("DISJUNTOR_INTERVALO_SONDA", 10))
+
+        self.estado = "fechado"
+        self.falhas_consecutivas = 0
+        self.aberto_em = 0.0
+        self.aberturas = 0
+        self.recusadas = 0
+        self.ultimo_erro = None
+        self._teste_em_andamento = False
+        self._ao_mudar = []
+        self._lock = Lock()
+        self._parar = Event()
+        self._sonda = None
+
+    def ao_mudar(self, callback):
+        """Registra callback(estado) chamado a cada transição"""
+        self._ao_mudar.append(callback)
+
+    def permite(self) -> bool:
+        """Indica, sem alterar o estado, se uma chamada seria tentada agora"""
+        with self._lock:
+            if self.estado == "fechado":
+                return True
+            if self.estado == "meio_aberto":
+                return not self._teste_em_andamento
+            return time.time() - self.aberto_em >= self.tempo_aberto
+
+    def executar(self, funcao):
+        """Executa a chamada protegida; levanta CircuitoAberto se estiver aberto"""
+        with self._lock:
+            if self.estado == "aberto" and time.time() - self.aberto_em >= self.tempo_aberto:
+                self.estado = "meio_aberto"
+
+            if self.estado == "aberto" or (self.estado == "meio_aberto" and self._teste_em_andamento):
+                self.recusadas += 1
+                raise CircuitoAberto(f"{self.nome} indisponível (circuito aberto)")
+
+            if self.estado == "meio_aberto":
+                self._teste_em_andamento = True
+
+        try:
+            resultado = funcao()
+        except Exception as e:
+            # Erro 4xx devolvido pelo próprio backend (ex.: violação de constraint) prova que ele responde
+            if (ErroRespostaSupabase is not None and isinstance(e, ErroRespostaSupabase)
+                    and not self._erro_de_servidor(e)):
+                self._registrar_sucesso()
+            else:
+                self._registrar_falha(e)
+            raise
+
+        self._registrar_sucesso()
+        return resultado
+
+    # Classes SQLSTATE que o PostgREST devolve como 5xx (exceto 25006 → 405 e P0001 → 400)
+    CLASSES_SQLSTATE_5XX = ("08", "09", "25", "2D", "38", "39", "3B", "40", "53", "54", "55", "57", "58",
+                            "F0", "HV", "P0", "XX")
+
+    @classmethod
+    def _erro_de_servidor(cls, erro) -> bool:
+        """APIError que indica backend degradado: sem código, HTTP 5xx, PGRST0xx (sem banco) ou SQLSTATE 5xx"""
+        codigo = str(erro.code or "")
+        if not codigo:
+            return True
+        if codigo.isdigit() and len(codigo) == 3:
+            return int(codigo) >= 500  # resposta não-JSON (ex.: 502/504 do gateway)
+        if codigo.startswith("PGRST"):
+            return codigo.startswith("PGRST0")
+        if codigo in ("25006", "P0001"):
+            return False
+        return codigo[:2] in cls.CLASSES_SQLSTATE_5XX
+
+    def abrir(self, erro: Exception = None):
+        """Abre o circuito imediatamente (ex.: falha na conexão inicial)"""
+        with self._lock:
+            self.ultimo_erro = str(erro)[:120] if erro else self.ultimo_erro
+            mudou = self._abrir()
+        if mudou:
+            self._notificar("aberto")
+
+    def _abrir(self) -> bool:
+        self._teste_em_andamento = False
+        self.aberto_em = time.time()
+        if self.estado == "aberto":
+            return False
+        self.estado = "aberto"
+        self.aberturas += 1
+        return True
+
+    def _registrar_falha(self, erro: Exception):
+        with self._lock:
+            self.falhas_consecutivas += 1
+            self.ultimo_erro = str(erro)[:120]
+            mudou = False
+            if self.estado == "meio_aberto" or self.falhas_consecutivas >= self.limite_falhas:
+                mudou = self._abrir()
+        if mudou:
+            logger.log(
+                "warning",
+                f"🔌 Disjuntor {self.nome} aberto após {self.falhas_consecutivas} falha(s): {self.ultimo_erro[:80]}"
+            )
+            self._notificar("aberto")
+
+    def _registrar_sucesso(self):
+        with self._lock:
+            self.falhas_consecutivas = 0
+            self._teste_em_andamento = False
+            mudou = self.estado != "fechado"
+            self.estado = "fechado"
+        if mudou:
+            logger.log("success", f"✅ {self.nome} respondeu, disjuntor fechado")
+            self._notificar("fechado")
+
+    def _notificar(self, estado: str):
+        for callback in self._ao_mudar:
+            try:
+                callback(estado)
+            except Exception as e:
+                logger.log("error", f"❌ Erro ao notificar mudança do disjuntor {self.nome}: {e}")
+
+    def iniciar_sonda(self, sondar):
+        """Inicia a thread que testa o backend enquanto o circuito não estiver fechado"""
+        def loop():
+            while not self._parar.wait(self.intervalo_sonda):
+                if self.estado != "fechado" and self.permite():
+                    try:
+                        self.executar(sondar)
+                    except Exception:
+                        pass
+
+        self._sonda = Thread(target=loop, name=f"sonda-{self.nome.lower()}", daemon=True)
+        self._sonda.start()
+
+    def parar(self, timeout: float = 5):
+        self._parar.set()
+        sonda = getattr(self, "_sonda", None)
+        if sonda is not None and sonda.is_alive():
+            sonda.join(timeout=timeout)
+
+    def resumo(self) -> str:
+        rotulos = {"fechado": "✅ Fechado", "aberto": "🔴 Aberto", "meio_aberto": "🟡 Meio aberto"}
+        texto = f"{rotulos[self.estado]} | aberturas: {self.aberturas} | recusadas: {self.recusadas}"
+        if self.estado != "fechado":
+            restante = max(0, self.tempo_aberto - (time.time() - self.aberto_em))
+            texto += f" | nova tentativa em {restante:.0f}s"
+        return texto
+
+# ==================== ROTEAMENTO DE LEITURAS ====================
+class RoteadorLeitura:
+    """Política de leitura por tipo de consulta, com latência registrada por origem"""
+
+    MODOS = ("local_primeiro", "remoto_primeiro", "somente_remoto")
+
+    POLITICA_PADRAO = {
+        "pedidos_usuario": "local_primeiro",
+        "pedidos_admin": "remoto_primeiro",
+        "pedido_codigo": "remoto_primeiro",
+        "anuncios": "local_primeiro",
+    }
+
+    def __init__(self):
+        self.politica = dict(self.POLITICA_PADRAO)
+        # Formato: POLITICA_LEITURA="pedidos_admin=local_primeiro,anuncios=remoto_primeiro"
+        for item in os.getenv("POLITICA_LEITURA", "").split(","):
+            consulta, _, modo = item.strip().partition("=")
+            if consulta and modo in self.MODOS:
+                self.politica[consulta] = modo
+
+        self.timeout_remoto = float(os.getenv("LEITURA_TIMEOUT_REMOTO_MS", 800)) / 1000
+        self.executor = ThreadPoolExecutor(
+            max_workers=int(os.getenv("LEITURA_WORKERS_REMOTOS", 4)),
+            thread_name_prefix="leitura-remota"
+        )
+        self.metricas = {}  # consulta -> {origem: (leituras, total_ms, max_ms), "falhas": n}
+        self._lock = Lock()
+
+    def modo(self, consulta: str) -> str:
+        return self.politica.get(consulta, "local_primeiro")
+
+    def fechar(self):
+        """Libera as threads de leitura remota (leituras em andamento são abandonadas)"""
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def registrar(self, consulta: str, origem: str, ms: float, falhou: bool = False):
+        with self._lock:
+            metricas = self.metricas.setdefault(consulta, {"falhas": 0})
+            if falhou:
+                metricas["falhas"] += 1
+                return
+            leituras, total, maximo = metricas.get(origem, (0, 0.0, 0.0))
+            metricas[origem] = (leituras + 1, total + ms, max(maximo, ms))
+
+    def resumo(self) -> List[str]:
+        """Linhas legíveis com a latência média por consulta e origem"""
+        linhas = []
+        with self._lock:
+            for consulta, metricas in sorted(self.metricas.items()):
+                partes = []
+                for origem in ("local", "remoto"):
+                    if origem in metricas:
+                        leituras, total, maximo = metricas[origem]
+                        partes.append(f"{origem} {leituras}x {total / leituras:.1f}ms (máx {maximo:.1f})")
+                if metricas["falhas"]:
+                    partes.append(f"{metricas['falhas']} falha(s)")
+                # Sem "_" para não quebrar o Markdown das mensagens do Telegram
+                rotulo = f"{consulta} [{self.modo(consulta)}]".replace("_", " ")
+                linhas.append(f"{rotulo}: " + ", ".join(partes))
+        return linhas
+
+# ==================== CACHE DE ANÚNCIOS ====================
+class CacheAnuncios:
+    """Cache em memória dos anúncios ativos por tipo, invalidado nas escritas"""
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._entradas = {}  # tipo -> (expira_em, anuncios)
+        self._versao = 0
+        self._lock = Lock()
+        self.acertos = 0
+        self.falhas = 0
+
+    def obter(self, tipo: Optional[str]) -> Tuple[Optional[List[Dict]], int]:
+        """Retorna (anúncios ou None, versão atual do cache)"""
+        with self._lock:
+            entrada = self._entradas.get(tipo)
+            if entrada and entrada[0] > time.monotonic():
+                self.acertos += 1
+                return entrada[1], self._versao
+            self.falhas += 1
+            return None, self._versao
+
+    def guardar(self, tipo: Optional[str], anuncios: List[Dict], versao: int):
+        """Guarda o resultado, a menos que tenha havido invalidação durante a consulta"""
+        with self._lock:
+            if versao == self._versao:
+                self._entradas[tipo] = (time.monotonic() + self.ttl, anuncios)
+
+    def invalidar(self):
+        with self._lock:
+            self._versao += 1
+            self._entradas.clear()
+
+# ==================== REPLICAÇÃO (OUTBOX) ====================
+class ReplicadorOutbox:
+    """Envia para o Supabase, em segundo plano, as escritas registradas na outbox do SQLite"""
+
+    # Chave comum aos dois bancos usada nas inserções (anúncios levam o id local)
+    CHAVES_INSERCAO = {"pedidos": "codigo_pedido", "anuncios": "id"}
+
+    def __init__(self, db: "DatabaseManager"):
+        self.db = db
+        self.tamanho_lote = int(os.getenv("OUTBOX_TAMANHO_LOTE", 100))
+        self.intervalo = float(os.getenv("OUTBOX_INTERVALO", 2.0))
+        self.backoff_base = float(os.getenv("OUTBOX_BACKOFF_BASE", 2.0))
+        self.backoff_max = float(os.getenv("OUTBOX_BACKOFF_MAX", 300.0))
+        # Depois disso o item vai para outbox_falhas (a reconciliação ainda envia o pedido depois)
+        self.max_tentativas = int(os.getenv("OUTBOX_MAX_TENTATIVAS", 10))
+        self.replicados = 0
+        self.falhas = 0
+        self.descartados = 0
+        self._acordar = Event()
+        self._parar = Event()
+        self._thread = Thread(target=self._loop, name="outbox-replicador", daemon=True)
+
+    def iniciar(self):
+        self._thread.start()
+
+    def notificar(self):
+        """Acorda o replicador após uma nova escrita"""
+        self._acordar.set()
+
+    def parar(self):
+        self._parar.set()
+        self._acordar.set()
+        if self._thread.is_alive():
+            self._thread.join(timeout=5)
+
+    def _loop(self):
+        while not self._parar.is_set():
+            self._acordar.wait(self.intervalo)
+            self._acordar.clear()
+            if self._parar.is_set():
+                break
+
+            try:
+                while self.db.supabase_disponivel and self.db.sqlite and self.replicar_lote():
+                    pass
+            except Exception as e:
+                logger.log("error", f"❌ Erro no replicador da outbox: {e}")
+
+    def replicar_lote(self) -> bool:
+        """Replica um lote de pendências; retorna True se todo o lote foi enviado"""
+        cursor = self.db.sqlite_conn.cursor()
+        cursor.execute('''
+            SELECT id, tabela, operacao, filtro, payload, tentativas, proxima_tentativa
+            FROM outbox
+            ORDER BY id
+            LIMIT ?
+        ''', (self.tamanho_lote,))
+
+        # Estritamente em ordem: para no item mais antigo ainda em espera, para que um
+        # update nunca chegue ao Supabase antes do insert do mesmo registro
+        agora = time.time()
+        pendentes = []
+        for row in cursor.fetchall():
+            if row['proxima_tentativa'] > agora:
+                break
+            pendentes.append(dict(row))
+
+        if not pendentes:
+            return False
+
+        # Agrupar inserções consecutivas da mesma tabela em um único envio
+        grupos = []
+        for item in pendentes:
+            if (grupos and item['operacao'] == 'insert'
+                    and grupos[-1][0]['operacao'] == 'insert'
+                    and grupos[-1][0]['tabela'] == item['tabela']):
+                grupos[-1].append(item)
+            else:
+                grupos.append([item])
+
+        for grupo in grupos:
+            try:
+                self._enviar(grupo)
+            except CircuitoAberto:
+                # Sem custo de tentativa: o lote volta quando o disjuntor fechar
+                return False
+            except Exception as e:
+                if len(grupo) == 1:
+                    self._agendar_nova_tentativa(grupo, e)
+                    return False
+                # Um registro ruim não pode travar o grupo inteiro: reenvia um a um para isolá-lo
+                logger.log("debug", f"Grupo de {len(grupo)} inserções falhou, reenviando um a um: {str(e)[:80]}")
+                if not self._enviar_individualmente(grupo):
+                    return False
+                continue
+
+            self._remover(grupo)
+
+        return len(pendentes) == self.tamanho_lote
+
+    def _enviar_individualmente(self, grupo: List[Dict]) -> bool:
+        """Envia item a item, em ordem; para no primeiro que falhar"""
+        for item in grupo:
+            try:
+                self._enviar([item])
+            except CircuitoAberto:
+                return False
+            except Exception as e:
+                self._agendar_nova_tentativa([item], e)
+                return False
+            self._remover([item])
+        return True
+
+    def _remover(self, grupo: List[Dict]):
+        with self.db.sqlite.escrita() as conn:
+            conn.executemany(
+                "DELETE FROM outbox WHERE id = ?", [(item['id'],) for item in grupo]
+            )
+        self.replicados += len(grupo)
+
+    def _enviar(self, grupo: List[Dict]):
+        """Executa um grupo da outbox no Supabase"""
+        primeiro = grupo[0]
+        tabela = self.db.supabase.table(primeiro['tabela'])
+
+        if primeiro['operacao'] == 'insert':
+            registros = [json.loads(item['payload']) for item in grupo]
+            # Reenvio idempotente pela chave estável; uma versão remota já existente (talvez mais nova) é preservada
+            self.db.executar_remoto(tabela.upsert(
+                registros, on_conflict=self.CHAVES_INSERCAO[primeiro['tabela']], ignore_duplicates=True
+            ))
+        else:
+            payload = json.loads(primeiro['payload'])
+            query = tabela.update(payload)
+            for coluna, valor in json.loads(primeiro['filtro']).items():
+                query = query.eq(coluna, valor)
+            if payload.get('updated_at'):
+                # Não sobrescrever uma alteração remota mais recente
+                query = query.or_(f'updated_at.is.null,updated_at.lt."{payload["updated_at"]}"')
+            self.db.executar_remoto(query)
+
+    def _agendar_nova_tentativa(self, grupo: List[Dict], erro: Exception):
+        """Registra a falha e reagenda o grupo com backoff exponencial (ou descarta após o limite)"""
+        self.falhas += 1
+        tentativas = grupo[0]['tentativas'] + 1
+        if tentativas >= self.max_tentativas:
+            self._descartar(grupo, erro)
+            return
+
+        espera = min(self.backoff_max, self.backoff_base * (2 ** (tentativas - 1)))
+        espera *= random.uniform(0.8, 1.2)
+
+        with self.db.sqlite.escrita() as conn:
+            conn.executemany('''
+                UPDATE outbox SET tentativas = tentativas + 1, proxima_tentativa = ?, ultimo_erro = ?
+                WHERE id = ?
+            ''', [(time.time() + espera, str(erro)[:200], item['id']) for item in grupo])
+
+        logger.log(
+            "warning",
+            f"⚠️ Falha ao replicar {len(grupo)} item(ns) da outbox "
+            f"(tentativa {tentativas}, nova tentativa em {espera:.0f}s): {str(erro)[:80]}"
+        )
+
+    def _descartar(self, grupo: List[Dict], erro: Exception):
+        """Move para outbox_falhas os itens que esgotaram as tentativas, liberando a fila"""
+        agora = datetime.now(timezone.utc).isoformat()
+        with self.db.sqlite.escrita() as conn:
+            for item in grupo:
+                conn.execute('''
+                    INSERT INTO outbox_falhas (id, tabela, operacao, filtro, payload, tentativas, ultimo_erro, criado_em, descartado_em)
+                    SELECT id, tabela, operacao, filtro, payload, tentativas + 1, ?, criado_em, ?
+                    FROM outbox WHERE id = ?
+                ''', (str(erro)[:200], agora, item['id']))
+                conn.execute("DELETE FROM outbox WHERE id = ?", (item['id'],))
+        self.descartados += len(grupo)
+
+        logger.log(
+            "error",
+            f"❌ {len(grupo)} item(ns) da outbox descartado(s) após {self.max_tentativas} tentativas "
+            f"(ids {', '.join(str(item['id']) for item in grupo)}): {str(erro)[:80]}"
+        )
+
+# ==================== CÓDIGOS DE PEDIDO ====================
+class GeradorCodigoPedido:
+    """Códigos únicos e ordenáveis por tempo sem coordenação: PED + instante + sequência + nó + verificador"""
+
+    ALFABETO = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+    TAMANHO_LEGADO = 23  # PED + AAAAMMDDHHMMSS + 6 hex do md5
+
+    LARGURA_NO = 4  # 36^4 nós distintos
+
+    def __init__(self, no: str = None):
+        # NODE_ID deve ser único por instância (ex.: réplicas atrás do mesmo balanceador) e é usado
+        # como está; sem ele, o nó é derivado de host + pid, com chance pequena (1 em 36^4) de repetir
+        no = no or os.getenv("NODE_ID")
+        if no:
+            no = no.strip().upper()
+            if not 1 <= len(no) <= self.LARGURA_NO or any(c not in self.ALFABETO for c in no):
+                raise ValueError(f"NODE_ID inválido: {no!r} (use 1 a {self.LARGURA_NO} caracteres 0-9/A-Z)")
+            self.no = no.rjust(self.LARGURA_NO, "0")
+        else:
+            origem = f"{socket.gethostname()}:{os.getpid()}"
+            self.no = self._base36(
+                int(hashlib.md5(origem.encode()).hexdigest(), 16) % 36 ** self.LARGURA_NO, self.LARGURA_NO
+            )
+        self._ultimo_ms = 0
+        self._sequencia = 0
+        self._lock = Lock()
+
+    @classmethod
+    def _base36(cls, valor: int, largura: int) -> str:
+        digitos = ""
+        for _ in range(largura):
+            valor, resto = divmod(valor, 36)
+            digitos = cls.ALFABETO[resto] + digitos
+        return digitos
+
+    @classmethod
+    def digito_verificador(cls, corpo: str) -> str:
+        """Luhn mod 36 sobre o corpo do código (sem o prefixo PED)"""
+        soma = 0
+        for posicao, caractere in enumerate(reversed(corpo)):
+            valor = cls.ALFABETO.index(caractere) * (2 if posicao % 2 == 0 else 1)
+            soma += valor // 36 + valor % 36
+        return cls.ALFABETO[(36 - soma % 36) % 36]
+
+    @classmethod
+    def valido(cls, codigo: str) -> bool:
+        """Confere o dígito verificador (códigos do formato antigo são aceitos como estão)"""
+        if not codigo.startswith("PED") or any(c not in cls.ALFABETO for c in codigo[3:]):
+            return False
+        if len(codigo) == cls.TAMANHO_LEGADO:
+            return True
+        return len(codigo) > 4 and cls.digito_verificador(codigo[3:-1]) == codigo[-1]
+
+    def gerar(self) -> str:
+        with self._lock:
+            agora_ms = time.time_ns() // 1_000_000
+            # Relógio voltou ou mesmo milissegundo: segue no último instante emitido
+            if agora_ms <= self._ultimo_ms:
+                agora_ms = self._ultimo_ms
+                self._sequencia += 1
+                if self._sequencia >= 36 ** 2:
+                    agora_ms += 1
+                    self._sequencia = 0
+            else:
+                self._sequencia = 0
+            self._ultimo_ms = agora_ms
+            sequencia = self._sequencia
+
+        instante = datetime.fromtimestamp(agora_ms / 1000, timezone.utc)
+        corpo = (
+            f"{instante.strftime('%Y%m%d%H%M%S')}{agora_ms % 1000:03d}"
+            f"{self._base36(sequencia, 2)}{self.no}"
+        )
+        return f"PED{corpo}{self.digito_verificador(corpo)}"
+
+# ==================== RECONCILIAÇÃO ====================
+class ReconciliadorPedidos:
+    """Converge pedidos entre SQLite e Supabase por marca d'água de updated_at (mais recente vence)"""
+
+    def __init__(self, db: "DatabaseManager"):
+        self.db = db
+        self.tamanho_lote = int(os.getenv("RECONCILIACAO_TAMANHO_LOTE", 200))
+        self.intervalo = float(os.getenv("RECONCILIACAO_INTERVALO", 900))
+        # Recuo da marca a cada nova rodada, para pegar escritas remotas que chegaram atrasadas
+        self.margem = timedelta(seconds=float(os.getenv("RECONCILIACAO_MARGEM", 300)))
+        self.ultimo_resultado = None
+        self._executando = Lock()
+        self._acordar = Event()
+        self._parar = Event()
+        self._colunas_locais = None
+        self._thread = Thread(target=self._loop, name="reconciliador", daemon=True)
+        self._thread.start()
+
+    def agendar(self):
+        """Pede uma rodada assim que possível (ex.: ao fechar o disjuntor)"""
+        self._acordar.set()
+
+    def parar(self, timeout: float = 5):
+        self._parar.set()
+        self._acordar.set()
+        if self._thread.is_alive():
+            self._thread.join(timeout=timeout)
+
+    def _loop(self):
+        # Primeira rodada logo após iniciar: cobre disco efêmero e pendências antigas
+        self._acordar.set()
+        while not self._parar.is_set():
+            self._acordar.wait(self.intervalo)
+            self._acordar.clear()
+            if self._parar.is_set():
+                break
+            if self.db.supabase_disponivel and self.db.sqlite:
+                try:
+                    self.executar()
+                except Exception as e:
+                    logger.log("error", f"❌ Erro na reconciliação: {str(e)[:120]}")
+
+    def executar(self) -> Optional[Dict]:
+        """Executa uma rodada completa; retorna None se outra já estiver em andamento"""
+        if not self._executando.acquire(blocking=False):
+            return None
+
+        try:
+            inicio = time.time()
+            resultado = {"enviados": 0, "recebidos": 0, "verificados": 0}
+            self._enviar_locais(resultado)
+            self._trazer_remotos(resultado)
+
+            resultado["segundos"] = time.time() - inicio
+            resultado["linhas_por_segundo"] = resultado["verificados"] / max(resultado["segundos"], 0.001)
+            resultado["concluido_em"] = datetime.now(timezone.utc).isoformat()
+            self.ultimo_resultado = resultado
+
+            nivel = "success" if resultado["enviados"] or resultado["recebidos"] else "debug"
+            logger.log(
+                nivel,
+                f"🔁 Reconciliação: {resultado['enviados']} enviado(s), {resultado['recebidos']} recebido(s), "
+                f"{resultado['verificados']} verificado(s) em {resultado['segundos']:.1f}s "
+                f"({resultado['linhas_por_segundo']:.0f} linhas/s)"
+            )
+            return resultado
+        finally:
+            self._executando.release()
+
+    def resumo(self) -> str:
+        r = self.ultimo_resultado
+        if not r:
+            return "nenhuma rodada concluída"
+        return (f"{r['enviados']} enviado(s), {r['recebidos']} recebido(s), "
+                f"{r['linhas_por_segundo']:.0f} linhas/s às {r['concluido_em'][11:19]} UTC")
+
+    @staticmethod
+    def _instante(valor) -> datetime:
+        """Converte o updated_at (SQLite ou Postgres) para comparação"""
+        if not valor:
+            return datetime.min.replace(tzinfo=timezone.utc)
+        instante = datetime.fromisoformat(str(valor).replace("Z", "+00:00"))
+        return instante if instante.tzinfo else instante.replace(tzinfo=timezone.utc)
+
+    def _carregar_marca(self, chave: str) -> Tuple[str, str]:
+        """Posição (updated_at, codigo_pedido) de onde a varredura deve continuar"""
+        row = self.db.sqlite_conn.execute(
+            "SELECT valor FROM sincronizacao WHERE chave = ?", (chave,)
+        ).fetchone()
+        if not row:
+            return "", ""
+
+        marca = json.loads(row['valor'])
+        if not marca.get("concluida"):
+            return marca["updated_at"], marca["codigo_pedido"]
+
+        recuo = self._instante(marca["updated_at"]) - self.margem
+        return recuo.astimezone(timezone.utc).isoformat(), ""
+
+    @staticmethod
+    def _salvar_marca(conn, chave: str, updated_at: str, codigo: str, concluida: bool):
+        conn.execute('''
+            INSERT INTO sincronizacao (chave, valor, atualizado_em) VALUES (?, ?, ?)
+            ON CONFLICT(chave) DO UPDATE SET valor = excluded.valor, atualizado_em = excluded.atualizado_em
+        ''', (
+            chave,
+            json.dumps({"updated_at": updated_at, "codigo_pedido": codigo, "concluida": concluida}),
+            datetime.now(timezone.utc).isoformat()
+        ))
+
+    def _enviar_locais(self, resultado: Dict):
+        """SQLite → Supabase: envia o que não existe ou está mais antigo no remoto"""
+        updated_at, codigo = self._carregar_marca("pedidos_envio")
+        avancou = False
+
+        while True:
+            lote = [dict(row) for row in self.db.sqlite_conn.execute('''
+                SELECT * FROM pedidos
+                WHERE updated_at > ? OR (updated_at = ? AND codigo_pedido > ?)
+                ORDER BY updated_at, codigo_pedido
+                LIMIT ?
+            ''', (updated_at, updated_at, codigo, self.tamanho_lote)).fetchall()]
+
+            if not lote:
+                # Último lote veio cheio: só agora se sabe que a varredura terminou
+                if avancou:
+                    with self.db.sqlite.escrita() as conn:
+                        self._salvar_marca(conn, "pedidos_envio", updated_at, codigo, True)
+                break
+
+            remotos = self.db.executar_remoto(
+                self.db.supabase.table("pedidos")
+                .select("codigo_pedido, updated_at")
+                .in_("codigo_pedido", [p['codigo_pedido'] for p in lote])
+            ).data
+            versoes = {r['codigo_pedido']: self._instante(r.get('updated_at')) for r in remotos}
+
+            divergentes = [
+                {k: v for k, v in p.items() if k != 'id'}
+                for p in lote
+                if p['codigo_pedido'] not in versoes or versoes[p['codigo_pedido']] < self._instante(p['updated_at'])
+            ]
+            if divergentes:
+                self.db.executar_remoto(
+                    self.db.supabase.table("pedidos").upsert(divergentes, on_conflict="codigo_pedido")
+                )
+
+            resultado["enviados"] += len(divergentes)
+            resultado["verificados"] += len(lote)
+            updated_at, codigo = lote[-1]['updated_at'], lote[-1]['codigo_pedido']
+            avancou = True
+            concluida = len(lote) < self.tamanho_lote
+            with self.db.sqlite.escrita() as conn:
+                self._salvar_marca(conn, "pedidos_envio", updated_at, codigo, concluida)
+
+            if concluida:
+                break
+
+    def _trazer_remotos(self, resultado: Dict):
+        """Supabase → SQLite: aplica linhas remotas mais novas, ajustando as estatísticas"""
+        updated_at, codigo = self._carregar_marca("pedidos_recebimento")
+        avancou = False
+
+        if self._colunas_locais is None:
+            self._colunas_locais = {
+                row[1] for row in self.db.sqlite_conn.execute("PRAGMA table_info(pedidos)")
+            } - {"id"}
+
+        while True:
+            # Linhas remotas sem updated_at precisam do mesmo preenchimento feito no SQLite:
+            #   update pedidos set updated_at = created_at where updated_at is null;
+            query = self.db.supabase.table("pedidos").select("*").not_.is_("updated_at", "null")
+            if updated_at:
+                query = query.or_(
+                    f'updated_at.gt."{updated_at}",'
+                    f'and(updated_at.eq."{updated_at}",codigo_pedido.gt."{codigo}")'
+                )
+            lote = self.db.executar_remoto(
+                query.order("updated_at").order("codigo_pedido").limit(self.tamanho_lote)
+            ).data
+
+            if not lote:
+                # Último lote veio cheio: só agora se sabe que a varredura terminou
+                if avancou:
+                    with self.db.sqlite.escrita() as conn:
+                        self._salvar_marca(conn, "pedidos_recebimento", updated_at, codigo, True)
+                break
+
+            concluida = len(lote) < self.tamanho_lote
+            with self.db.sqlite.escrita() as conn:
+                cursor = conn.cursor()
+                for remoto in lote:
+                    cursor.execute("SELECT * FROM pedidos WHERE codigo_pedido = ?", (remoto['codigo_pedido'],))
+                    row = cursor.fetchone()
+                    local = dict(row) if row else None
+
+                    if local and self._instante(local['updated_at']) >= self._instante(remoto.get('updated_at')):
+                        continue
+
+                    registro = {k: v for k, v in remoto.items() if k in self._colunas_locais}
+                    colunas = ', '.join(registro)
+                    atualizacoes = ', '.join(f"{c} = excluded.{c}" for c in registro if c != 'codigo_pedido')
+                    cursor.execute(f'''
+                        INSERT INTO pedidos ({colunas}) VALUES ({', '.join('?' for _ in registro)})
+                        ON CONFLICT(codigo_pedido) DO UPDATE SET {atualizacoes}
+                    ''', list(registro.values()))
+                    self.db._ajustar_estatisticas(cursor, local, dict(local or {}, **registro))
+                    resultado["recebidos"] += 1
+
+                updated_at, codigo = lote[-1]['updated_at'], lote[-1]['codigo_pedido']
+                # Marca na mesma transação: uma rodada interrompida retoma do último lote aplicado
+                self._salvar_marca(conn, "pedidos_recebimento", updated_at, codigo, concluida)
+
+            resultado["verificados"] += len(lote)
+            avancou = True
+            if concluida:
+                break
 
 # ==================== GESTÃO DE BANCO DE DADOS ====================
 class DatabaseManager:
     """Gerenciador de banco de dados híbrido (Supabase + SQLite)"""
+
+    INDICES_SQLITE = [
+        ("idx_pedidos_status_created", "pedidos (status, created_at)"),
+        ("idx_pedidos_user_created", "pedidos (user_id, created_at)"),
+        ("idx_pedidos_created", "pedidos (created_at)"),
+        ("idx_anuncios_ativo_tipo", "anuncios (ativo, tipo, prioridade, criado_em)"),
+        ("idx_pedidos_updated_codigo", "pedidos (updated_at, codigo_pedido)"),
+    ]
+
+    # Consultas representativas: (nome, sql, parâmetros, ordenação temporária permitida)
+    CONSULTAS_VERIFICADAS = [
+        ("pedidos_recentes", "SELECT * FROM pedidos WHERE 1=1 ORDER BY created_at DESC LIMIT ?", (50,), False),
+        ("pedidos_por_status", "SELECT * FROM pedidos WHERE 1=1 AND status = ? ORDER BY created_at DESC LIMIT ?",
+         ("pendente", 50), False),
+        ("pedidos_por_usuario", "SELECT * FROM pedidos WHERE 1=1 AND user_id = ? ORDER BY created_at DESC LIMIT ?",
+         ("0", 50), False),
+        ("pedido_por_codigo", "SELECT * FROM pedidos WHERE 1=1 AND codigo_pedido = ? ORDER BY created_at DESC LIMIT ?",
+         ("PED", 50), True),
+        ("anuncios_por_tipo", "SELECT * FROM anuncios WHERE ativo = 1 AND tipo = ? ORDER BY prioridade DESC, criado_em DESC",
+         ("geral",), False),
+        ("anuncios_ativos", "SELECT * FROM anuncios WHERE ativo = 1 ORDER BY prioridade DESC, criado_em DESC",
+         (), True),
+    ]
+
     def __init__(self):
         self.supabase = None
-        self.sqlite_conn = None
+        self.sqlite = None
         self.modo_atual = None
+        self.cache_anuncios = CacheAnuncios(float(os.getenv("ANUNCIOS_CACHE_TTL", 300)))
+        self.roteador = RoteadorLeitura()
+        self.gerador_codigos = GeradorCodigoPedido()
+        self.intervalo_acesso = float(os.getenv("USUARIO_INTERVALO_ACESSO", 300))
+        self._acessos = {}
+        self._acessos_poda = time.time()
+        self._lock_acessos = Lock()
+        self._rpc_estatisticas = True
+        self.disjuntor = Disjuntor("Supabase")
+        self.disjuntor.ao_mudar(self._ao_mudar_disjuntor)
         self.initialize_databases()
+        self.replicador = ReplicadorOutbox(self)
+        self.reconciliador = ReconciliadorPedidos(self)
+        if self.replicacao_ativa:
+            self.replicador.iniciar()
+            self.disjuntor.iniciar_sonda(self._sondar_supabase)
+
+    @property
+    def replicacao_ativa(self) -> bool:
+        """Supabase configurado: só então as escritas locais entram na outbox"""
+        return bool(SUPABASE_URL and SUPABASE_KEY)
+
+    @property
+    def supabase_disponivel(self) -> bool:
+        """Cliente criado e disjuntor aceitando chamadas"""
+        return self.supabase is not None and self.disjuntor.permite()
+
+    def executar_remoto(self, consulta):
+        """Executa uma consulta do Supabase protegida pelo disjuntor"""
+        return self.disjuntor.executar(consulta.execute)
+
+    def _sondar_supabase(self):
+        """Sonda do disjuntor: recria o cliente se preciso e faz uma leitura mínima"""
+        if self.supabase is None:
+            from supabase import create_client
+            self.supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
+            transporte.configurar_supabase(self.supabase)
+        self.supabase.table("pedidos").select("id").limit(1).execute()
+
+    def _ao_mudar_disjuntor(self, estado: str):
+        if estado == "fechado":
+            self.modo_atual = "supabase"
+            if hasattr(self, "replicador"):
+                self.replicador.notificar()
+            if hasattr(self, "reconciliador"):
+                self.reconciliador.agendar()
+        elif estado == "aberto" and self.sqlite:
+            self.modo_atual = "sqlite"
+
+    @property
+    def sqlite_conn(self) -> Optional[sqlite3.Connection]:
+        """Conexão SQLite da thread atual (None se o SQLite estiver indisponível)"""
+        return self.sqlite.conexao() if self.sqlite else None
+
+    def fechar(self):
+        """Encerra sonda, reconciliador, replicador e leituras remotas, e só então as conexões"""
+        self.disjuntor.parar()
+        self.reconciliador.parar()
+        self.replicador.parar()
+        self.roteador.fechar()
+        if self.sqlite:
+            self.sqlite.fechar()
 
     def initialize_databases(self):
         """Inicializa ambos os bancos de dados"""
@@ -228,6 +1699,7 @@ class DatabaseManager:
         try:
             from supabase import create_client
             self.supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
+            transporte.configurar_supabase(self.supabase)
 
             # Testar conexão
             self.supabase.table("pedidos").select("*").limit(1).execute()
@@ -237,20 +1709,22 @@ class DatabaseManager:
         except Exception as e:
             logger.log("warning", f"⚠️ Supabase não disponível: {str(e)[:80]}")
             self.supabase = None
+            self.disjuntor.abrir(e)
 
         # Inicializar SQLite (sempre como fallback)
         try:
-            self.sqlite_conn = sqlite3.connect('pizzaria_romeo.db', check_same_thread=False)
-            self.sqlite_conn.row_factory = sqlite3.Row
+            self.sqlite = ConexoesSQLite(os.getenv("SQLITE_PATH", "pizzaria_romeo.db"))
             self.create_sqlite_tables()
-            logger.log("success", "✅ SQLite configurado com sucesso")
+            self.verificar_indices()
+            self._inicializar_estatisticas()
+            logger.log("success", f"✅ SQLite configurado com sucesso (journal: {self.sqlite.journal_mode})")
 
-            if not self.supabase:
+            if self.modo_atual != "supabase":
                 self.modo_atual = "sqlite"
 
         except Exception as e:
             logger.log("error", f"❌ Erro SQLite: {e}")
-            self.sqlite_conn = None
+            self.sqlite = None
 
         logger.log("info", f"📊 Modo de banco selecionado: {self.modo_atual}")
 
@@ -310,6 +1784,99 @@ class DatabaseManager:
             )
         ''')
 
+        # Índices secundários alinhados às consultas de buscar_pedidos e buscar_anuncios_ativos
+        for nome, definicao in self.INDICES_SQLITE:
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS {nome} ON {definicao}")
+
+        # Estatísticas materializadas (atualizadas na mesma transação das escritas de pedidos)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS estatisticas_diarias (
+                dia TEXT NOT NULL,
+                status TEXT NOT NULL,
+                total_pedidos INTEGER DEFAULT 0,
+                valor_total REAL DEFAULT 0.0,
+                PRIMARY KEY (dia, status)
+            )
+        ''')
+
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS estatisticas_pizzas (
+                pizza TEXT PRIMARY KEY,
+                total_pedidos INTEGER DEFAULT 0
+            )
+        ''')
+
+        # Outbox de replicação para o Supabase
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                tabela TEXT NOT NULL,
+                operacao TEXT NOT NULL,
+                filtro TEXT,
+                payload TEXT NOT NULL,
+                tentativas INTEGER DEFAULT 0,
+                proxima_tentativa REAL DEFAULT 0,
+                ultimo_erro TEXT,
+                criado_em TEXT NOT NULL
+            )
+        ''')
+
+        # Itens da outbox que esgotaram as tentativas (mantidos para análise)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS outbox_falhas (
+                id INTEGER PRIMARY KEY,
+                tabela TEXT NOT NULL,
+                operacao TEXT NOT NULL,
+                filtro TEXT,
+                payload TEXT NOT NULL,
+                tentativas INTEGER DEFAULT 0,
+                ultimo_erro TEXT,
+                criado_em TEXT NOT NULL,
+                descartado_em TEXT NOT NULL
+            )
+        ''')
+
+        # Sessões em andamento (gravadas em segundo plano para sobreviver a reinícios)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS sessoes (
+                chat_id INTEGER PRIMARY KEY,
+                dados TEXT NOT NULL,
+                atualizada_em REAL NOT NULL
+            )
+        ''')
+
+        # Difusões de anúncios (progresso salvo por lote para retomar após reinícios)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS difusoes (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                anuncio_id TEXT NOT NULL,
+                titulo TEXT NOT NULL,
+                mensagem TEXT NOT NULL,
+                criada_por TEXT,
+                status TEXT DEFAULT 'em_andamento',
+                total INTEGER DEFAULT 0,
+                ultimo_user_id TEXT DEFAULT '',
+                entregues INTEGER DEFAULT 0,
+                bloqueados INTEGER DEFAULT 0,
+                falhas INTEGER DEFAULT 0,
+                criada_em TEXT NOT NULL,
+                atualizada_em TEXT,
+                concluida_em TEXT
+            )
+        ''')
+
+        # Marcas d'água da reconciliação com o Supabase
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS sincronizacao (
+                chave TEXT PRIMARY KEY,
+                valor TEXT NOT NULL,
+                atualizado_em TEXT NOT NULL
+            )
+        ''')
+
+        # Pedidos antigos sem updated_at entram na marca d'água pela data de criação
+        cursor.execute("UPDATE pedidos SET updated_at = created_at WHERE updated_at IS NULL")
+
         # Tabela configuracoes
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS configuracoes (
@@ -326,7 +1893,8 @@ class DatabaseManager:
             ('telefone_contato', '(11) 99999-9999'),
             ('horario_funcionamento', '18:00-23:00'),
             ('mensagem_boas_vindas', 'Bem-vindo à Pizzaria Romeo! 🍕'),
-            ('valor_minimo_entrega', '30.00')
+            ('valor_minimo_entrega', '0.00'),
+            ('valor_entrega_gratis', '60.00')
         ]
 
         for chave, valor in defaults:
@@ -338,97 +1906,203 @@ class DatabaseManager:
         self.sqlite_conn.commit()
         logger.log("debug", "✅ Tabelas SQLite criadas/verificadas")
 
+    def verificar_indices(self) -> Dict[str, Tuple[bool, str]]:
+        """Confere via EXPLAIN QUERY PLAN se as consultas principais usam os índices"""
+        resultado = {}
+        conn = self.sqlite_conn
+
+        for nome, sql, params, ordenacao_permitida in self.CONSULTAS_VERIFICADAS:
+            plano = [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params).fetchall()]
+            varredura_total = any(
+                passo.startswith(("SCAN", "SEARCH")) and "USING" not in passo for passo in plano
+            )
+            ordenacao_temporaria = any("TEMP B-TREE" in passo for passo in plano)
+
+            ok = not varredura_total and (ordenacao_permitida or not ordenacao_temporaria)
+            resultado[nome] = (ok, " | ".join(plano))
+
+            if not ok:
+                logger.log("warning", f"⚠️ Consulta '{nome}' sem índice adequado: {' | '.join(plano)}")
+
+        return resultado
+
     def salvar_pedido(self, pedido_data: Dict) -> Tuple[bool, str, str]:
-        """Salva pedido em ambos os bancos se possível"""
+        """Salva pedido no SQLite e agenda a replicação para o Supabase"""
         # Gerar código único para o pedido
-        timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
-        random_hash = hashlib.md5(str(time.time()).encode()).hexdigest()[:6].upper()
-        codigo = f"PED{timestamp}{random_hash}"
+        codigo = self.gerador_codigos.gerar()
         pedido_data['codigo_pedido'] = codigo
+        pedido_data.setdefault('updated_at', pedido_data['created_at'])
 
         logger.log("info", f"💾 Salvando pedido {codigo}...")
 
-        resultado_supabase = False
-        resultado_sqlite = False
+        if not self.sqlite:
+            return self._salvar_pedido_supabase(pedido_data, codigo)
 
-        # 1. Tentar Supabase
-        if self.supabase:
-            try:
-                response = self.supabase.table("pedidos").insert(pedido_data).execute()
-                resultado_supabase = bool(response.data)
-                if resultado_supabase:
-                    logger.log("success", f"✅ Pedido {codigo} salvo no Supabase")
-            except Exception as e:
-                logger.log("warning", f"⚠️ Falha no Supabase: {str(e)[:100]}")
-
-        # 2. Sempre salvar no SQLite (backup obrigatório)
-        if self.sqlite_conn:
-            try:
-                cursor = self.sqlite_conn.cursor()
+        # SQLite é o ponto de commit síncrono; o Supabase recebe via outbox
+        try:
+            with self.sqlite.escrita() as conn:
+                cursor = conn.cursor()
                 columns = ', '.join(pedido_data.keys())
                 placeholders = ', '.join(['?' for _ in pedido_data])
 
-                sql = f"INSERT OR REPLACE INTO pedidos ({columns}) VALUES ({placeholders})"
+                sql = f"INSERT INTO pedidos ({columns}) VALUES ({placeholders})"
                 cursor.execute(sql, list(pedido_data.values()))
+                self._ajustar_estatisticas(cursor, None, pedido_data)
+                self._enfileirar_outbox(cursor, "pedidos", "insert", pedido_data)
 
-                self.sqlite_conn.commit()
-                resultado_sqlite = True
-                logger.log("success", f"✅ Pedido {codigo} salvo no SQLite")
+        except Exception as e:
+            # Disco cheio ou banco travado: o pedido ainda pode ir direto para o Supabase
+            logger.log("error", f"❌ Erro SQLite: {e}")
+            return self._salvar_pedido_supabase(pedido_data, codigo)
 
-            except Exception as e:
-                logger.log("error", f"❌ Erro SQLite: {e}")
+        self.replicador.notificar()
+        logger.log("success", f"🎉 Pedido {codigo} salvo com sucesso (Fonte: sqlite)")
 
-        # Determinar fonte principal
-        fonte_principal = "supabase" if resultado_supabase else "sqlite" if resultado_sqlite else None
+        return True, codigo, "sqlite"
 
-        sucesso = resultado_supabase or resultado_sqlite
-        if sucesso:
-            logger.log("success", f"🎉 Pedido {codigo} salvo com sucesso (Fonte: {fonte_principal})")
+    def _salvar_pedido_supabase(self, pedido_data: Dict, codigo: str) -> Tuple[bool, str, str]:
+        """Caminho de contingência quando o SQLite está indisponível"""
+        if not self.supabase:
+            logger.log("error", f"❌ Nenhum banco disponível, pedido {codigo} não salvo")
+            return False, codigo, None
 
-        return sucesso, codigo, fonte_principal
+        try:
+            response = self.executar_remoto(self.supabase.table("pedidos").insert(pedido_data))
+            if response.data:
+                logger.log("success", f"🎉 Pedido {codigo} salvo com sucesso (Fonte: supabase)")
+                return True, codigo, "supabase"
+        except Exception as e:
+            logger.log("error", f"❌ Falha no Supabase: {str(e)[:100]}")
 
-    def buscar_pedidos(self, filtros: Dict = None, limite: int = 50) -> List[Dict]:
-        """Busca pedidos com filtros"""
-        pedidos = []
+        return False, codigo, None
 
-        if self.modo_atual == "supabase" and self.supabase:
-            try:
-                query = self.supabase.table("pedidos").select("*")
+    def _enfileirar_outbox(self, cursor, tabela: str, operacao: str, payload: Dict, filtro: Dict = None):
+        """Registra uma escrita para replicação, na mesma transação do SQLite"""
+        if not self.replicacao_ativa:
+            return
+        cursor.execute('''
+            INSERT INTO outbox (tabela, operacao, filtro, payload, criado_em)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (
+            tabela,
+            operacao,
+            json.dumps(filtro, ensure_ascii=False) if filtro else None,
+            json.dumps(payload, ensure_ascii=False),
+            datetime.now(timezone.utc).isoformat()
+        ))
+
+    def outbox_pendentes(self) -> int:
+        """Quantidade de escritas aguardando replicação"""
+        if not self.sqlite:
+            return 0
+        return self.sqlite_conn.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+
+    def registrar_acesso(self, user_id: str, username: str = None, primeiro_nome: str = None):
+        """Atualiza ultimo_acesso do usuário (no máximo uma escrita por intervalo)"""
+        if not self.sqlite:
+            return
 
-                if filtros:
-                    for key, value in filtros.items():
-                        if value:
-                            query = query.eq(key, value)
+        agora = time.time()
+        with self._lock_acessos:
+            if agora - self._acessos.get(user_id, 0) < self.intervalo_acesso:
+                return
+            self._acessos[user_id] = agora
 
-                response = query.order("created_at", desc=True).limit(limite).execute()
-                pedidos = [dict(p) for p in response.data]
+            # Entradas mais antigas que o intervalo já não bloqueiam nada; o mapa fica com os usuários ativos
+            if agora - self._acessos_poda >= self.intervalo_acesso:
+                self._acessos = {uid: t for uid, t in self._acessos.items() if agora - t < self.intervalo_acesso}
+                self._acessos_poda = agora
+        momento = datetime.now(timezone.utc).isoformat()
 
-            except Exception as e:
-                logger.log("warning", f"⚠️ Erro ao buscar do Supabase: {e}")
+        try:
+            with self.sqlite.escrita() as conn:
+                conn.execute('''
+                    INSERT INTO usuarios (user_id, username, primeiro_nome, ultimo_acesso, created_at)
+                    VALUES (?, ?, ?, ?, ?)
+                    ON CONFLICT(user_id) DO UPDATE SET
+                        username = excluded.username,
+                        primeiro_nome = excluded.primeiro_nome,
+                        ultimo_acesso = excluded.ultimo_acesso
+                ''', (user_id, username, primeiro_nome, momento, momento))
+        except Exception as e:
+            logger.log("warning", f"⚠️ Erro ao registrar acesso de {user_id}: {e}")
+
+    def buscar_usuario(self, user_id: str) -> Optional[Dict]:
+        """Linha do usuário com os totais mantidos a cada pedido"""
+        if not self.sqlite:
+            return None
+        row = self.sqlite_conn.execute("SELECT * FROM usuarios WHERE user_id = ?", (user_id,)).fetchone()
+        return dict(row) if row else None
+
+    def _ler(self, consulta: str, ler_local, ler_remoto):
+        """Executa uma leitura conforme a política configurada para a consulta"""
+        modo = self.roteador.modo(consulta)
+        remoto_disponivel = self.supabase_disponivel
+
+        if modo == "somente_remoto":
+            tentativas = [("remoto", ler_remoto, None)]
+        elif modo == "remoto_primeiro":
+            tentativas = [("remoto", ler_remoto, self.roteador.timeout_remoto), ("local", ler_local, None)]
+        else:
+            tentativas = [("local", ler_local, None), ("remoto", ler_remoto, None)]
 
-        # Fallback para SQLite
-        if not pedidos and self.sqlite_conn:
+        for origem, ler, timeout in tentativas:
+            if (origem == "remoto" and not remoto_disponivel) or (origem == "local" and not self.sqlite):
+                continue
+
+            inicio = time.perf_counter()
             try:
-                cursor = self.sqlite_conn.cursor()
-                sql = "SELECT * FROM pedidos WHERE 1=1"
-                params = []
+                if timeout:
+                    resultado = self.roteador.executor.submit(ler).result(timeout=timeout)
+                else:
+                    resultado = ler()
+            except Exception as e:
+                self.roteador.registrar(consulta, origem, 0, falhou=True)
+                motivo = f"excedeu {timeout * 1000:.0f}ms" if isinstance(e, FuturesTimeout) else str(e)[:80]
+                logger.log("warning", f"⚠️ Leitura {origem} '{consulta}' falhou: {motivo}")
+                continue
+
+            self.roteador.registrar(consulta, origem, (time.perf_counter() - inicio) * 1000)
+            return resultado
+
+        return None
+
+    def buscar_pedidos(self, filtros: Dict = None, limite: int = 50, consulta: str = "pedidos_admin") -> List[Dict]:
+        """Busca pedidos com filtros (origem definida pela política de leitura)"""
+        pedidos = self._ler(
+            consulta,
+            lambda: self._buscar_pedidos_sqlite(filtros, limite),
+            lambda: self._buscar_pedidos_supabase(filtros, limite)
+        )
+        return pedidos if pedidos is not None else []
 
-                if filtros:
-                    for key, value in filtros.items():
-                        if value:
-                            sql += f" AND {key} = ?"
-                            params.append(value)
+    def _buscar_pedidos_supabase(self, filtros: Optional[Dict], limite: int) -> List[Dict]:
+        query = self.supabase.table("pedidos").select("*")
 
-                sql += " ORDER BY created_at DESC LIMIT ?"
-                params.append(limite)
+        if filtros:
+            for key, value in filtros.items():
+                if value:
+                    query = query.eq(key, value)
 
-                cursor.execute(sql, params)
-                pedidos = [dict(row) for row in cursor.fetchall()]
+        response = self.executar_remoto(query.order("created_at", desc=True).limit(limite))
+        return [dict(p) for p in response.data]
 
-            except Exception as e:
-                logger.log("error", f"❌ Erro ao buscar do SQLite: {e}")
+    def _buscar_pedidos_sqlite(self, filtros: Optional[Dict], limite: int) -> List[Dict]:
+        cursor = self.sqlite_conn.cursor()
+        sql = "SELECT * FROM pedidos WHERE 1=1"
+        params = []
 
-        return pedidos
+        if filtros:
+            for key, value in filtros.items():
+                if value:
+                    sql += f" AND {key} = ?"
+                    params.append(value)
+
+        sql += " ORDER BY created_at DESC LIMIT ?"
+        params.append(limite)
+
+        cursor.execute(sql, params)
+        return [dict(row) for row in cursor.fetchall()]
 
     def atualizar_status_pedido(self, pedido_id: str, novo_status: str, motivo: str = None) -> bool:
         """Atualiza status de um pedido"""
@@ -444,39 +2118,55 @@ class DatabaseManager:
         if motivo:
             update_data["observacoes"] = f"{datetime.now().strftime('%H:%M')} - Status alterado: {motivo}"
 
-        # Atualizar no Supabase
-        if self.supabase:
-            try:
-                response = self.supabase.table("pedidos").update(update_data).eq("codigo_pedido", pedido_id).execute()
-                sucesso = bool(response.data)
-            except Exception as e:
-                logger.log("warning", f"⚠️ Erro ao atualizar no Supabase: {e}")
-
-        # Atualizar no SQLite
-        if self.sqlite_conn:
+        # Atualizar no SQLite e registrar a replicação na mesma transação
+        if self.sqlite:
             try:
-                cursor = self.sqlite_conn.cursor()
-
-                # Buscar observações atuais
-                cursor.execute("SELECT observacoes FROM pedidos WHERE codigo_pedido = ?", (pedido_id,))
-                resultado = cursor.fetchone()
-                observacoes_atuais = dict(resultado)['observacoes'] if resultado else ""
+                with self.sqlite.escrita() as conn:
+                    cursor = conn.cursor()
+
+                    # Buscar estado atual (observações e dados das estatísticas)
+                    cursor.execute('''
+                        SELECT observacoes, status, created_at, valor, pizza, user_id
+                        FROM pedidos WHERE codigo_pedido = ?
+                    ''', (pedido_id,))
+                    resultado = cursor.fetchone()
+                    anterior = dict(resultado) if resultado else None
+                    observacoes_atuais = anterior['observacoes'] if anterior else ""
+
+                    # Adicionar nova observação
+                    nova_observacao = f"\n{update_data['observacoes']}" if 'observacoes' in update_data else ""
+                    observacoes_final = observacoes_atuais + nova_observacao if observacoes_atuais else nova_observacao.lstrip()
+
+                    cursor.execute('''
+                        UPDATE pedidos 
+                        SET status = ?, observacoes = ?, updated_at = ?
+                        WHERE codigo_pedido = ?
+                    ''', (novo_status, observacoes_final.strip(), update_data['updated_at'], pedido_id))
+
+                    if cursor.rowcount > 0:
+                        sucesso = True
+                        self._ajustar_estatisticas(cursor, anterior, dict(anterior, status=novo_status))
+                        update_data["observacoes"] = observacoes_final.strip()
+                        self._enfileirar_outbox(
+                            cursor, "pedidos", "update", update_data, {"codigo_pedido": pedido_id}
+                        )
 
-                # Adicionar nova observação
-                nova_observacao = f"\n{update_data['observacoes']}" if 'observacoes' in update_data else ""
-                observacoes_final = observacoes_atuais + nova_observacao if observacoes_atuais else nova_observacao.lstrip()
-
-                cursor.execute('''
-                    UPDATE pedidos 
-                    SET status = ?, observacoes = ?, updated_at = ?
-                    WHERE codigo_pedido = ?
-                ''', (novo_status, observacoes_final.strip(), update_data['updated_at'], pedido_id))
+            except Exception as e:
+                sucesso = False
+                logger.log("error", f"❌ Erro ao atualizar no SQLite: {e}")
 
-                self.sqlite_conn.commit()
-                sucesso = cursor.rowcount > 0 or sucesso
+            if sucesso:
+                self.replicador.notificar()
 
+        # Pedido inexistente no espelho local: atualizar direto no Supabase
+        if not sucesso and self.supabase:
+            try:
+                response = self.executar_remoto(
+                    self.supabase.table("pedidos").update(update_data).eq("codigo_pedido", pedido_id)
+                )
+                sucesso = bool(response.data)
             except Exception as e:
-                logger.log("error", f"❌ Erro ao atualizar no SQLite: {e}")
+                logger.log("warning", f"⚠️ Erro ao atualizar no Supabase: {e}")
 
         if sucesso:
             logger.log("success", f"✅ Status do pedido {pedido_id} atualizado para {novo_status}")
@@ -491,32 +2181,38 @@ class DatabaseManager:
 
         logger.log("info", "📢 Salvando novo anúncio...")
 
-        # Salvar no Supabase
-        if self.supabase:
-            try:
-                response = self.supabase.table("anuncios").insert(anuncio_data).execute()
-                sucesso = bool(response.data)
-            except Exception as e:
-                logger.log("warning", f"⚠️ Erro ao salvar anúncio no Supabase: {e}")
-
-        # Sempre salvar no SQLite
-        if self.sqlite_conn:
+        # Salvar no SQLite; o Supabase recebe via outbox
+        if self.sqlite:
             try:
-                cursor = self.sqlite_conn.cursor()
-                columns = ', '.join(anuncio_data.keys())
-                placeholders = ', '.join(['?' for _ in anuncio_data])
-
-                cursor.execute(f'''
-                    INSERT INTO anuncios ({columns})
-                    VALUES ({placeholders})
-                ''', list(anuncio_data.values()))
-
-                self.sqlite_conn.commit()
+                with self.sqlite.escrita() as conn:
+                    cursor = conn.cursor()
+                    columns = ', '.join(anuncio_data.keys())
+                    placeholders = ', '.join(['?' for _ in anuncio_data])
+
+                    cursor.execute(f'''
+                        INSERT INTO anuncios ({columns})
+                        VALUES ({placeholders})
+                    ''', list(anuncio_data.values()))
+                    # O id local vai junto, para que desativar_anuncio filtre o mesmo registro no Supabase
+                    self._enfileirar_outbox(cursor, "anuncios", "insert", dict(anuncio_data, id=cursor.lastrowid))
                 sucesso = True
 
             except Exception as e:
                 logger.log("error", f"❌ Erro ao salvar anúncio no SQLite: {e}")
 
+            if sucesso:
+                self.replicador.notificar()
+
+        if not sucesso and self.supabase:
+            try:
+                response = self.executar_remoto(self.supabase.table("anuncios").insert(anuncio_data))
+                sucesso = bool(response.data)
+            except Exception as e:
+                logger.log("warning", f"⚠️ Erro ao salvar anúncio no Supabase: {e}")
+
+        if sucesso:
+            self.cache_anuncios.invalidar()
+
         if sucesso:
             logger.log("success", f"✅ Anúncio salvo: {anuncio_data.get('titulo', 'Sem título')}")
         else:
@@ -525,77 +2221,353 @@ class DatabaseManager:
         return sucesso
 
     def buscar_anuncios_ativos(self, tipo: str = None) -> List[Dict]:
-        """Busca anúncios ativos"""
-        anuncios = []
+        """Busca anúncios ativos (servidos do cache enquanto válidos)"""
+        anuncios, versao = self.cache_anuncios.obter(tipo)
+        if anuncios is not None:
+            return list(anuncios)
+
+        anuncios = self._ler(
+            "anuncios",
+            lambda: self._buscar_anuncios_sqlite(tipo),
+            lambda: self._buscar_anuncios_supabase(tipo)
+        )
 
-        if self.modo_atual == "supabase" and self.supabase:
-            try:
-                query = self.supabase.table("anuncios").select("*").eq("ativo", True)
-                if tipo:
-                    query = query.eq("tipo", tipo)
+        if anuncios is None:
+            return []
+
+        self.cache_anuncios.guardar(tipo, anuncios, versao)
+        return list(anuncios)
+
+    def _buscar_anuncios_sqlite(self, tipo: Optional[str]) -> List[Dict]:
+        cursor = self.sqlite_conn.cursor()
+        sql = "SELECT * FROM anuncios WHERE ativo = 1"
+        params = []
 
-                response = query.order("prioridade", desc=True).order("criado_em", desc=True).execute()
-                anuncios = [dict(a) for a in response.data]
+        if tipo:
+            sql += " AND tipo = ?"
+            params.append(tipo)
+
+        sql += " ORDER BY prioridade DESC, criado_em DESC"
+        cursor.execute(sql, params)
+        return [dict(row) for row in cursor.fetchall()]
+
+    def _buscar_anuncios_supabase(self, tipo: Optional[str]) -> List[Dict]:
+        query = self.supabase.table("anuncios").select("*").eq("ativo", True)
+        if tipo:
+            query = query.eq("tipo", tipo)
+
+        response = self.executar_remoto(query.order("prioridade", desc=True).order("criado_em", desc=True))
+        return [dict(a) for a in response.data]
+
+    def desativar_anuncio(self, anuncio_id: str) -> bool:
+        """Desativa um anúncio e invalida o cache"""
+        sucesso = False
 
+        if self.sqlite:
+            try:
+                with self.sqlite.escrita() as conn:
+                    cursor = conn.cursor()
+                    cursor.execute("UPDATE anuncios SET ativo = 0 WHERE id = ?", (anuncio_id,))
+                    sucesso = cursor.rowcount > 0
+                    if sucesso:
+                        self._enfileirar_outbox(cursor, "anuncios", "update", {"ativo": False}, {"id": anuncio_id})
             except Exception as e:
-                logger.log("warning", f"⚠️ Erro ao buscar anúncios do Supabase: {e}")
+                logger.log("error", f"❌ Erro ao desativar anúncio no SQLite: {e}")
+
+            if sucesso:
+                self.replicador.notificar()
 
-        # Fallback para SQLite
-        if self.sqlite_conn:
+        elif self.supabase:
             try:
-                cursor = self.sqlite_conn.cursor()
-                sql = "SELECT * FROM anuncios WHERE ativo = 1"
-                params = []
+                response = self.executar_remoto(
+                    self.supabase.table("anuncios").update({"ativo": False}).eq("id", anuncio_id)
+                )
+                sucesso = bool(response.data)
+            except Exception as e:
+                logger.log("warning", f"⚠️ Erro ao desativar anúncio no Supabase: {e}")
 
-                if tipo:
-                    sql += " AND tipo = ?"
-                    params.append(tipo)
+        if sucesso:
+            self.cache_anuncios.invalidar()
+            logger.log("success", f"✅ Anúncio {anuncio_id} desativado")
+
+        return sucesso
 
-                sql += " ORDER BY prioridade DESC, criado_em DESC"
-                cursor.execute(sql, params)
-                anuncios = [dict(row) for row in cursor.fetchall()]
+    @staticmethod
+    def _limites_hoje() -> Tuple[str, str]:
+        """Início e fim do dia local atual, em ISO UTC (mesmo formato de created_at)"""
+        inicio = datetime.now().astimezone().replace(hour=0, minute=0, second=0, microsecond=0)
+        fim = inicio + timedelta(days=1)
+        return (
+            inicio.astimezone(timezone.utc).isoformat(),
+            fim.astimezone(timezone.utc).isoformat()
+        )
 
+    def get_estatisticas(self) -> Dict:
+        """Retorna estatísticas do sistema (agregadas no banco)"""
+        estatisticas = None
+
+        if self.sqlite:
+            try:
+                estatisticas = self._estatisticas_sqlite()
+            except Exception as e:
+                logger.log("error", f"❌ Erro ao ler estatísticas do SQLite: {e}")
+
+        if estatisticas is None and self.supabase:
+            try:
+                estatisticas = self._estatisticas_supabase()
             except Exception as e:
-                logger.log("error", f"❌ Erro ao buscar anúncios do SQLite: {e}")
+                logger.log("warning", f"⚠️ Erro ao agregar estatísticas no Supabase: {str(e)[:80]}")
+
+        if estatisticas is None:
+            estatisticas = {
+                "total_pedidos": 0,
+                "pedidos_hoje": 0,
+                "anuncios_ativos": 0,
+                "por_status": {},
+                "valor_total": 0.0,
+                "por_pizza": {}
+            }
 
-        return anuncios
+        total = estatisticas["total_pedidos"]
+        estatisticas["valor_medio"] = estatisticas["valor_total"] / total if total else 0
+        estatisticas["modo_banco"] = self.modo_atual
+        return estatisticas
 
-    def get_estatisticas(self) -> Dict:
-        """Retorna estatísticas do sistema"""
-        pedidos = self.buscar_pedidos(limite=1000)
-        anuncios = self.buscar_anuncios_ativos()
-
-        hoje = datetime.now().date()
-        pedidos_hoje = [
-            p for p in pedidos 
-            if datetime.fromisoformat(p['created_at']).date() == hoje
-        ]
+    def _estatisticas_sqlite(self) -> Dict:
+        """Lê as estatísticas das tabelas materializadas (poucas linhas, sem varrer pedidos)"""
+        conn = self.sqlite_conn
 
-        # Calcular por status
         por_status = {}
-        for pedido in pedidos:
-            status = pedido.get('status', 'pendente')
-            por_status[status] = por_status.get(status, 0) + 1
+        total_pedidos = 0
+        valor_total = 0.0
+        for status, quantidade, valor in conn.execute('''
+            SELECT status, SUM(total_pedidos), SUM(valor_total)
+            FROM estatisticas_diarias
+            GROUP BY status
+        '''):
+            if quantidade:
+                por_status[status] = quantidade
+            total_pedidos += quantidade
+            valor_total += valor
+
+        pedidos_hoje = conn.execute(
+            "SELECT COALESCE(SUM(total_pedidos), 0) FROM estatisticas_diarias WHERE dia = ?",
+            (datetime.now().date().isoformat(),)
+        ).fetchone()[0]
+
+        por_pizza = dict(conn.execute(
+            "SELECT pizza, total_pedidos FROM estatisticas_pizzas WHERE total_pedidos > 0"
+        ).fetchall())
+
+        anuncios_ativos = conn.execute("SELECT COUNT(*) FROM anuncios WHERE ativo = 1").fetchone()[0]
+
+        return {
+            "total_pedidos": total_pedidos,
+            "pedidos_hoje": pedidos_hoje,
+            "anuncios_ativos": anuncios_ativos,
+            "por_status": por_status,
+            "valor_total": valor_total,
+            "por_pizza": por_pizza
+        }
+
+    @staticmethod
+    def _chave_pizza(pizza: str) -> str:
+        partes = (pizza or 'Desconhecida').split()
+        return partes[0] if partes else 'Desconhecida'
+
+    @staticmethod
+    def _dia_local(created_at: str) -> str:
+        return datetime.fromisoformat(created_at).astimezone().date().isoformat()
+
+    def _ajustar_estatisticas(self, cursor, anterior: Optional[Dict], atual: Optional[Dict]):
+        """Move os contadores materializados do estado anterior do pedido para o atual"""
+        for pedido, sinal in ((anterior, -1), (atual, 1)):
+            if not pedido:
+                continue
+
+            cursor.execute('''
+                INSERT INTO estatisticas_diarias (dia, status, total_pedidos, valor_total)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT(dia, status) DO UPDATE SET
+                    total_pedidos = total_pedidos + excluded.total_pedidos,
+                    valor_total = valor_total + excluded.valor_total
+            ''', (
+                self._dia_local(pedido['created_at']),
+                pedido.get('status') or 'pendente',
+                sinal,
+                sinal * (pedido.get('valor') or 0)
+            ))
+
+        # Pizza só muda quando o pedido entra ou sai da base
+        if bool(anterior) != bool(atual):
+            pedido, sinal = (atual, 1) if atual else (anterior, -1)
+            cursor.execute('''
+                INSERT INTO estatisticas_pizzas (pizza, total_pedidos) VALUES (?, ?)
+                ON CONFLICT(pizza) DO UPDATE SET total_pedidos = total_pedidos + excluded.total_pedidos
+            ''', (self._chave_pizza(pedido.get('pizza')), sinal))
+
+        # Totais do cliente: a contagem muda só na entrada/saída; cancelados não somam ao gasto
+        for pedido, sinal in ((anterior, -1), (atual, 1)):
+            if not pedido or not pedido.get('user_id'):
+                continue
+
+            gasto = 0 if pedido.get('status') == 'cancelado' else (pedido.get('valor') or 0)
+            cursor.execute('''
+                INSERT INTO usuarios (user_id, total_pedidos, total_gasto, created_at)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT(user_id) DO UPDATE SET
+                    total_pedidos = total_pedidos + excluded.total_pedidos,
+                    total_gasto = total_gasto + excluded.total_gasto
+            ''', (
+                str(pedido['user_id']),
+                sinal if bool(anterior) != bool(atual) else 0,
+                sinal * gasto,
+                pedido['created_at']
+            ))
+
+    def _inicializar_estatisticas(self):
+        """Preenche as estatísticas materializadas em bases que ainda não as possuem"""
+        conn = self.sqlite_conn
+        vazia = (
+            conn.execute("SELECT 1 FROM estatisticas_diarias LIMIT 1").fetchone() is None
+            or conn.execute("SELECT 1 FROM usuarios WHERE total_pedidos > 0 LIMIT 1").fetchone() is None
+        )
+        if vazia and conn.execute("SELECT 1 FROM pedidos LIMIT 1").fetchone():
+            self.reconstruir_estatisticas()
+
+    def reconstruir_estatisticas(self) -> int:
+        """Recalcula as estatísticas materializadas a partir da tabela pedidos"""
+        por_dia_status = {}
+        por_pizza = {}
+        total = 0
+
+        with self.sqlite.escrita() as conn:
+            for row in conn.execute("SELECT created_at, status, valor, pizza FROM pedidos"):
+                chave = (self._dia_local(row['created_at']), row['status'] or 'pendente')
+                quantidade, valor = por_dia_status.get(chave, (0, 0.0))
+                por_dia_status[chave] = (quantidade + 1, valor + (row['valor'] or 0))
+
+                pizza = self._chave_pizza(row['pizza'])
+                por_pizza[pizza] = por_pizza.get(pizza, 0) + 1
+                total += 1
+
+            conn.execute("DELETE FROM estatisticas_diarias")
+            conn.execute("DELETE FROM estatisticas_pizzas")
+            conn.executemany(
+                "INSERT INTO estatisticas_diarias (dia, status, total_pedidos, valor_total) VALUES (?, ?, ?, ?)",
+                [(dia, status, quantidade, valor) for (dia, status), (quantidade, valor) in por_dia_status.items()]
+            )
+            conn.executemany(
+                "INSERT INTO estatisticas_pizzas (pizza, total_pedidos) VALUES (?, ?)",
+                list(por_pizza.items())
+            )
 
-        # Calcular valores
-        valor_total = sum(p.get('valor', 0) for p in pedidos)
-        valor_medio = valor_total / len(pedidos) if pedidos else 0
+            conn.execute("UPDATE usuarios SET total_pedidos = 0, total_gasto = 0")
+            conn.execute('''
+                INSERT INTO usuarios (user_id, total_pedidos, total_gasto, created_at)
+                SELECT user_id, COUNT(*),
+                       SUM(CASE WHEN status = 'cancelado' THEN 0 ELSE COALESCE(valor, 0) END),
+                       MIN(created_at)
+                FROM pedidos WHERE true GROUP BY user_id
+                ON CONFLICT(user_id) DO UPDATE SET
+                    total_pedidos = excluded.total_pedidos,
+                    total_gasto = excluded.total_gasto
+            ''')
+
+        logger.log("success", f"✅ Estatísticas reconstruídas a partir de {total} pedidos")
+        return total
+
+    # Função esperada no Supabase para as agregações de pedidos:
+    #
+    #   create or replace function estatisticas_pedidos(inicio_hoje timestamptz, fim_hoje timestamptz)
+    #   returns json language sql stable as $$
+    #     select json_build_object(
+    #       'total_pedidos', (select count(*) from pedidos),
+    #       'pedidos_hoje', (select count(*) from pedidos
+    #                        where created_at >= inicio_hoje and created_at < fim_hoje),
+    #       'valor_total', (select coalesce(sum(valor), 0) from pedidos),
+    #       'por_status', (select coalesce(json_object_agg(s, n), '{}') from
+    #                      (select coalesce(status, 'pendente') s, count(*) n from pedidos group by 1) t),
+    #       'por_pizza', (select coalesce(json_object_agg(p, n), '{}') from
+    #                     (select split_part(trim(pizza), ' ', 1) p, count(*) n from pedidos group by 1) t)
+    #     );
+    #   $$;
+    #
+    # Sem a função (PGRST202) as agregações caem para contagens exatas via PostgREST.
+    def _estatisticas_supabase(self) -> Dict:
+        """Agrega pedidos via RPC (ou contagens exatas) e conta anúncios com count exato no Supabase"""
+        inicio_hoje, fim_hoje = self._limites_hoje()
+        dados = None
+
+        if self._rpc_estatisticas:
+            try:
+                dados = self.executar_remoto(self.supabase.rpc(
+                    "estatisticas_pedidos",
+                    {"inicio_hoje": inicio_hoje, "fim_hoje": fim_hoje}
+                )).data
+            except Exception as e:
+                if getattr(e, "code", None) not in ("PGRST202", "42883"):
+                    raise
+                self._rpc_estatisticas = False
+                logger.log("warning", "⚠️ Função estatisticas_pedidos ausente no Supabase; usando contagens exatas")
+
+        if dados is None:
+            dados = self._contagens_supabase(inicio_hoje, fim_hoje)
+        elif isinstance(dados, list):
+            dados = dados[0] if dados else {}
+
+        anuncios = self.executar_remoto(
+            self.supabase.table("anuncios").select("id", count="exact").eq("ativo", True).limit(1)
+        )
+
+        return {
+            "total_pedidos": int(dados.get("total_pedidos", 0)),
+            "pedidos_hoje": int(dados.get("pedidos_hoje", 0)),
+            "anuncios_ativos": anuncios.count or 0,
+            "por_status": dados.get("por_status") or {},
+            "valor_total": float(dados.get("valor_total", 0)),
+            "por_pizza": dados.get("por_pizza") or {}
+        }
+
+    def _contar_pedidos(self, filtro=None) -> int:
+        consulta = self.supabase.table("pedidos").select("id", count="exact")
+        if filtro:
+            consulta = filtro(consulta)
+        return self.executar_remoto(consulta.limit(1)).count or 0
 
-        # Por pizza
+    def _contagens_supabase(self, inicio_hoje: str, fim_hoje: str, pagina: int = 1000) -> Dict:
+        """Mesmas agregações da função estatisticas_pedidos, sem depender dela"""
+        por_status = {}
+        for status in PizzaSabor.STATUS:
+            total_status = self._contar_pedidos(lambda c, s=status: c.eq("status", s))
+            if status == "pendente":
+                total_status += self._contar_pedidos(lambda c: c.is_("status", "null"))
+            if total_status:
+                por_status[status] = total_status
+
+        # Soma e distribuição por sabor não têm count; lê só (id, valor, pizza) em páginas por id
+        valor_total = 0.0
         por_pizza = {}
-        for pedido in pedidos:
-            pizza = pedido.get('pizza', 'Desconhecida').split()[0]
-            por_pizza[pizza] = por_pizza.get(pizza, 0) + 1
+        ultimo_id = None
+        while True:
+            consulta = self.supabase.table("pedidos").select("id,valor,pizza").order("id").limit(pagina)
+            if ultimo_id is not None:
+                consulta = consulta.gt("id", ultimo_id)
+            linhas = self.executar_remoto(consulta).data or []
+            for linha in linhas:
+                valor_total += float(linha.get("valor") or 0)
+                chave = self._chave_pizza(linha.get("pizza"))
+                por_pizza[chave] = por_pizza.get(chave, 0) + 1
+            if len(linhas) < pagina:
+                break
+            ultimo_id = linhas[-1]["id"]
 
         return {
-            "total_pedidos": len(pedidos),
-            "pedidos_hoje": len(pedidos_hoje),
-            "anuncios_ativos": len(anuncios),
-            "por_status": por_status,
+            "total_pedidos": self._contar_pedidos(),
+            "pedidos_hoje": self._contar_pedidos(lambda c: c.gte("created_at", inicio_hoje).lt("created_at", fim_hoje)),
             "valor_total": valor_total,
-            "valor_medio": valor_medio,
-            "por_pizza": por_pizza,
-            "modo_banco": self.modo_atual
+            "por_status": por_status,
+            "por_pizza": por_pizza
         }
 
     def get_modo(self):
@@ -604,12 +2576,102 @@ class DatabaseManager:
 # Inicializar banco de dados
 db = DatabaseManager()
 
+# ==================== CONFIGURAÇÕES DA LOJA ====================
+class ConfiguracaoSistema:
+    """Cache tipado da tabela configuracoes: leituras em memória, recarga atômica após alterações"""
+
+    # chave -> (conversor, valor padrão, descrição)
+    CHAVES = {
+        "taxa_entrega": (float, 5.00, "Taxa de entrega (R$)"),
+        "tempo_entrega": (int, 45, "Tempo máximo de entrega (min)"),
+        "telefone_contato": (str, "(11) 99999-9999", "Telefone de contato"),
+        "horario_funcionamento": (str, "18:00-23:00", "Horário de funcionamento"),
+        "mensagem_boas_vindas": (str, "Bem-vindo à Pizzaria Romeo! 🍕", "Mensagem de boas-vindas"),
+        "valor_minimo_entrega": (float, 0.00, "Valor mínimo do pedido (R$, 0 desativa)"),
+        "valor_entrega_gratis": (float, 60.00, "Entrega grátis a partir de (R$, 0 desativa)"),
+    }
+
+    def __init__(self):
+        self._valores = {chave: padrao for chave, (_, padrao, _) in self.CHAVES.items()}
+        self._lock = Lock()
+        self.recarregar()
+
+    def recarregar(self) -> int:
+        """Lê a tabela inteira e troca o snapshot de uma vez; retorna quantas chaves vieram do banco"""
+        valores = {chave: padrao for chave, (_, padrao, _) in self.CHAVES.items()}
+        carregadas = 0
+
+        if db.sqlite:
+            with self._lock:
+                for row in db.sqlite_conn.execute("SELECT chave, valor FROM configuracoes"):
+                    if row['chave'] not in self.CHAVES:
+                        continue
+                    try:
+                        valores[row['chave']] = self.CHAVES[row['chave']][0](row['valor'])
+                        carregadas += 1
+                    except ValueError:
+                        logger.log("warning", f"⚠️ Configuração '{row['chave']}' inválida: {row['valor']}")
+
+                # Troca da referência: leitores veem o snapshot antigo ou o novo, nunca um misto
+                self._valores = valores
+
+        return carregadas
+
+    def obter(self, chave: str):
+        return self._valores[chave]
+
+    def definir(self, chave: str, valor: str):
+        """Valida, grava e recarrega; levanta KeyError/ValueError para entradas inválidas"""
+        if chave not in self.CHAVES:
+            raise KeyError(chave)
+        if not db.sqlite:
+            raise RuntimeError("SQLite indisponível")
+
+        convertido = self.CHAVES[chave][0](valor.replace(",", ".") if self.CHAVES[chave][0] is float else valor)
+        if isinstance(convertido, (int, float)) and convertido < 0:
+            raise ValueError("valor negativo")
+
+        with db.sqlite.escrita() as conn:
+            conn.execute('''
+                INSERT INTO configuracoes (chave, valor, atualizado_em) VALUES (?, ?, ?)
+                ON CONFLICT(chave) DO UPDATE SET valor = excluded.valor, atualizado_em = excluded.atualizado_em
+            ''', (chave, str(convertido), datetime.now(timezone.utc).isoformat()))
+
+        self.recarregar()
+        logger.log("success", f"⚙️ Configuração '{chave}' alterada para {convertido}")
+        return convertido
+
+    @property
+    def taxa_entrega(self) -> float:
+        return self._valores["taxa_entrega"]
+
+    @property
+    def telefone_contato(self) -> str:
+        return self._valores["telefone_contato"]
+
+    @property
+    def previsao_entrega(self) -> str:
+        tempo = self._valores["tempo_entrega"]
+        return f"{max(tempo - 15, 0)}-{tempo} minutos"
+
+    @property
+    def horario_funcionamento(self) -> str:
+        return self._valores["horario_funcionamento"].replace("-", " - ")
+
+    @property
+    def valor_minimo_entrega(self) -> float:
+        return self._valores["valor_minimo_entrega"]
+
+    @property
+    def valor_entrega_gratis(self) -> float:
+        return self._valores["valor_entrega_gratis"]
+
+config = ConfiguracaoSistema()
+
 # ==================== SISTEMA DE PEDIDOS ====================
 class SistemaPedidos:
     """Sistema de gerenciamento de pedidos"""
 
-    TAXA_ENTREGA = 5.00
-
     def calcular_valor(self, sabor: str, tamanho: str = "grande") -> float:
         """Calcula valor do pedido"""
         sabor_info = PizzaSabor.SABORES.get(sabor.lower())
@@ -622,6 +2684,20 @@ class SistemaPedidos:
 
         return round(valor_base * multiplicador, 2)
 
+    def tamanhos_permitidos(self, sabor: str) -> List[str]:
+        """Tamanhos cujo valor atinge o pedido mínimo configurado (todos, se o mínimo for 0)"""
+        return [
+            tamanho for tamanho in PizzaSabor.TAMANHOS
+            if self.calcular_valor(sabor, tamanho) >= config.valor_minimo_entrega
+        ]
+
+    def calcular_taxa_entrega(self, valor: float) -> float:
+        """Taxa da configuração, zerada quando o pedido atinge o valor de entrega grátis"""
+        gratis = config.valor_entrega_gratis
+        if gratis > 0 and valor >= gratis:
+            return 0.0
+        return config.taxa_entrega
+
     def criar_pedido_data(self, chat_id: str, dados: Dict) -> Dict:
         """Cria estrutura de dados do pedido"""
         sabor = dados['pizza'].split()[0].lower()
@@ -641,7 +2717,7 @@ class SistemaPedidos:
             "created_at": datetime.now(timezone.utc).isoformat(),
             "status": "pendente",
             "valor": valor_pizza,
-            "taxa_entrega": self.TAXA_ENTREGA,
+            "taxa_entrega": self.calcular_taxa_entrega(valor_pizza),
             "fonte": db.get_modo()
         }
 
@@ -669,8 +2745,8 @@ class SistemaPedidos:
 📝 *Observações:* {pedido_data['observacoes'] or 'Nenhuma'}
 📊 *Status:* {status_info['nome']}
 ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
-⏰ *Previsão de entrega:* 30-45 minutos
-📞 *Dúvidas:* (11) 99999-9999
+⏰ *Previsão de entrega:* {config.previsao_entrega}
+📞 *Dúvidas:* {config.telefone_contato}
 
 *Agradecemos sua preferência!* 🍕
 """
@@ -713,37 +2789,967 @@ class SistemaAdmin:
 
 admin = SistemaAdmin()
 
+# ==================== SESSÕES ====================
+class Sessao:
+    """Estado de um fluxo em andamento (pedido ou fluxo de admin), com atributos fixos"""
+
+    __slots__ = (
+        "acao", "etapa", "codigo", "user_id",
+        "pizza", "descricao", "preco_base", "nome", "telefone", "endereco",
+        "idade", "tamanho", "pagamento", "observacoes",
+        "titulo", "mensagem", "tipo",
+        "criada_em", "atualizada_em",
+    )
+
+    CAMPOS_PEDIDO = ("pizza", "nome", "telefone", "endereco", "idade", "tamanho", "pagamento", "observacoes")
+
+    def __init__(self, **campos):
+        for atributo in self.__slots__:
+            setattr(self, atributo, None)
+        for atributo, valor in campos.items():
+            setattr(self, atributo, valor)
+        self.criada_em = self.atualizada_em = time.time()
+
+    def serializar(self) -> str:
+        """JSON compacto só com os campos preenchidos"""
+        return json.dumps(
+            {atributo: getattr(self, atributo) for atributo in self.__slots__ if getattr(self, atributo) is not None},
+            ensure_ascii=False, separators=(",", ":")
+        )
+
+    @classmethod
+    def desserializar(cls, dados: str) -> "Sessao":
+        campos = json.loads(dados)
+        sessao = cls(**{k: v for k, v in campos.items() if k in cls.__slots__})
+        sessao.criada_em = campos.get("criada_em", sessao.criada_em)
+        sessao.atualizada_em = campos.get("atualizada_em", sessao.atualizada_em)
+        return sessao
+
+    def dados_pedido(self) -> Dict:
+        """Campos preenchidos do pedido, no formato esperado por criar_pedido_data"""
+        return {campo: getattr(self, campo) for campo in self.CAMPOS_PEDIDO if getattr(self, campo) is not None}
+
+class ArmazemSessoes:
+    """Sessões por chat com TTL por inatividade, limite de tamanho (LRU), varredura periódica
+    e persistência opcional em segundo plano (write-behind) na tabela sessoes do SQLite"""
+
+    def __init__(self):
+        self.ttl = float(os.getenv("SESSAO_TTL", 1800))
+        self.tamanho_maximo = int(os.getenv("SESSAO_MAX", 10000))
+        self.intervalo_varredura = float(os.getenv("SESSAO_INTERVALO_VARREDURA", 60))
+        self.persistir_ativo = os.getenv("SESSAO_PERSISTIR", "true").lower() in ("1", "true", "sim")
+        self.intervalo_gravacao = float(os.getenv("SESSAO_INTERVALO_GRAVACAO", 2))
+        self.expiradas = 0
+        self.despejadas = 0
+        self.restauradas = 0
+        # Ordem = último acesso: as candidatas a expirar ficam sempre no início
+        self._sessoes = OrderedDict()
+        self._lock = Lock()
+        self._sujas = set()
+        self._removidas = set()
+        # Chats com sessão gravada ainda não carregada: só eles consultam o SQLite
+        self._persistidas = set()
+
+        if self.persistir_ativo:
+            self._carregar_indice_persistido()
+
+        self._thread = Thread(target=self._loop_manutencao, name="sessoes-manutencao", daemon=True)
+        self._thread.start()
+
+    def _carregar_indice_persistido(self):
+        if not db.sqlite:
+            return
+        try:
+            limite = time.time() - self.ttl
+            with db.sqlite.escrita() as conn:
+                conn.execute("DELETE FROM sessoes WHERE atualizada_em < ?", (limite,))
+                self._persistidas = {row[0] for row in conn.execute("SELECT chat_id FROM sessoes")}
+            if self._persistidas:
+                logger.log("info", f"💾 {len(self._persistidas)} sessão(ões) em andamento disponível(is) para retomada")
+        except Exception as e:
+            logger.log("warning", f"⚠️ Não foi possível ler as sessões gravadas: {e}")
+
+    def iniciar(self, chat_id: int, **campos) -> Sessao:
+        """Cria (ou substitui) a sessão do chat"""
+        sessao = Sessao(**campos)
+        with self._lock:
+            self._persistidas.discard(chat_id)
+            self._guardar(chat_id, sessao)
+        return sessao
+
+    def _guardar(self, chat_id: int, sessao: Sessao):
+        self._sessoes[chat_id] = sessao
+        self._sessoes.move_to_end(chat_id)
+        self._sujas.add(chat_id)
+        while len(self._sessoes) > self.tamanho_maximo:
+            despejada, _ = self._sessoes.popitem(last=False)
+            self._marcar_removida(despejada)
+            self.despejadas += 1
+
+    def _marcar_removida(self, chat_id: int):
+        self._sujas.discard(chat_id)
+        if self.persistir_ativo:
+            self._removidas.add(chat_id)
+
+    def _restaurar(self, chat_id: int) -> Optional[Sessao]:
+        """Recarrega do SQLite a sessão gravada antes de um reinício"""
+        self._persistidas.discard(chat_id)
+        try:
+            row = db.sqlite_conn.execute("SELECT dados FROM sessoes WHERE chat_id = ?", (chat_id,)).fetchone()
+            sessao = Sessao.desserializar(row[0]) if row else None
+        except Exception as e:
+            logger.log("warning", f"⚠️ Erro ao restaurar sessão de {chat_id}: {e}")
+            return None
+
+        if sessao is None or time.time() - sessao.atualizada_em > self.ttl:
+            self._marcar_removida(chat_id)
+            return None
+
+        self.restauradas += 1
+        return sessao
+
+    def obter(self, chat_id: int) -> Optional[Sessao]:
+        """Sessão ativa do chat (renova o TTL); None se não existir ou tiver expirado"""
+        with self._lock:
+            sessao = self._sessoes.get(chat_id)
+            if sessao is None:
+                if chat_id not in self._persistidas:
+                    return None
+                sessao = self._restaurar(chat_id)
+                if sessao is None:
+                    return None
+                self._guardar(chat_id, sessao)
+
+            agora = time.time()
+            if agora - sessao.atualizada_em > self.ttl:
+                del self._sessoes[chat_id]
+                self._marcar_removida(chat_id)
+                self.expiradas += 1
+                return None
+
+            # Renova o TTL; a gravação só é agendada por salvar(), depois da alteração
+            sessao.atualizada_em = agora
+            self._sessoes.move_to_end(chat_id)
+            return sessao
+
+    def salvar(self, chat_id: int):
+        """Agenda a gravação da sessão do chat (chamado depois de alterá-la)"""
+        with self._lock:
+            if chat_id in self._sessoes:
+                self._sujas.add(chat_id)
+
+    def encerrar(self, chat_id: int):
+        with self._lock:
+            self._sessoes.pop(chat_id, None)
+            self._persistidas.discard(chat_id)
+            self._marcar_removida(chat_id)
+
+    def __contains__(self, chat_id: int) -> bool:
+        return self.obter(chat_id) is not None
+
+    def __len__(self) -> int:
+        return len(self._sessoes)
+
+    def varrer(self) -> int:
+        """Remove as sessões expiradas; percorre só o início da fila"""
+        limite = time.time() - self.ttl
+        removidas = 0
+        with self._lock:
+            while self._sessoes:
+                chat_id, sessao = next(iter(self._sessoes.items()))
+                if sessao.atualizada_em > limite:
+                    break
+                del self._sessoes[chat_id]
+                self._marcar_removida(chat_id)
+                removidas += 1
+            self.expiradas += removidas
+        return removidas
+
+    def persistir(self) -> int:
+        """Grava em lote as sessões alteradas e apaga as encerradas; retorna quantas foram gravadas"""
+        if not self.persistir_ativo or not db.sqlite:
+            self._sujas.clear()
+            self._removidas.clear()
+            return 0
+
+        with self._lock:
+            gravar = [
+                (chat_id, self._sessoes[chat_id].serializar(), self._sessoes[chat_id].atualizada_em)
+                for chat_id in self._sujas if chat_id in self._sessoes
+            ]
+            apagar = [(chat_id,) for chat_id in self._removidas]
+            self._sujas.clear()
+            self._removidas.clear()
+
+        if not gravar and not apagar:
+            return 0
+
+        try:
+            with db.sqlite.escrita() as conn:
+                conn.executemany('''
+                    INSERT INTO sessoes (chat_id, dados, atualizada_em) VALUES (?, ?, ?)
+                    ON CONFLICT(chat_id) DO UPDATE SET dados = excluded.dados, atualizada_em = excluded.atualizada_em
+                ''', gravar)
+                conn.executemany("DELETE FROM sessoes WHERE chat_id = ?", apagar)
+        except Exception as e:
+            # Devolve para a próxima rodada, sem sobrescrever o que mudou nesse meio tempo
+            with self._lock:
+                self._sujas.update(chat_id for chat_id, _, _ in gravar if chat_id in self._sessoes)
+                self._removidas.update(chat_id for (chat_id,) in apagar if chat_id not in self._sessoes)
+            logger.log("warning", f"⚠️ Erro ao gravar sessões: {e}")
+            return 0
+
+        return len(gravar)
+
+    def _loop_manutencao(self):
+        ultima_varredura = time.time()
+        while True:
+            time.sleep(self.intervalo_gravacao if self.persistir_ativo else self.intervalo_varredura)
+            try:
+                if time.time() - ultima_varredura >= self.intervalo_varredura:
+                    ultima_varredura = time.time()
+                    removidas = self.varrer()
+                    if removidas:
+                        logger.log("debug", f"🧹 {removidas} sessão(ões) expirada(s) removida(s)")
+                self.persistir()
+            except Exception as e:
+                logger.log("error", f"❌ Erro na manutenção de sessões: {e}")
+
+# ==================== DESPACHO DE MENSAGENS ====================
+class Despachante:
+    """Roteia cada mensagem por (estado da sessão, comando) com consultas diretas em dicionário"""
+
+    def __init__(self):
+        self._rotas = {}  # (estado ou None, comando ou None) -> handler
+        self.despachadas = 0
+
+    def comando(self, *comandos: str, estado: str = None):
+        """Registra o handler para os comandos (opcionalmente só dentro de um estado)"""
+        def registrar(handler):
+            for comando in comandos:
+                self._registrar((estado, comando), handler)
+            return handler
+        return registrar
+
+    def estado(self, *estados: str):
+        """Registra o handler para o texto recebido enquanto a sessão está em um dos estados"""
+        def registrar(handler):
+            for estado in estados:
+                self._registrar((estado, None), handler)
+            return handler
+        return registrar
+
+    def padrao(self, handler):
+        """Handler para o que não tiver rota"""
+        self._registrar((None, None), handler)
+        return handler
+
+    @property
+    def total_rotas(self) -> int:
+        return len(self._rotas)
+
+    def _registrar(self, chave: Tuple, handler):
+        if chave in self._rotas:
+            raise ValueError(f"Rota duplicada no despachante: {chave}")
+        self._rotas[chave] = handler
+
+    @staticmethod
+    def extrair_comando(texto: Optional[str]) -> Optional[str]:
+        if not texto or not texto.startswith('/'):
+            return None
+        return texto.split(maxsplit=1)[0][1:].split('@', 1)[0].lower()
+
+    def rota(self, mensagem):
+        """Até quatro consultas: (estado, comando), comando, estado e padrão"""
+        comando = self.extrair_comando(mensagem.text)
+        sessao = user_sessions.obter(mensagem.chat.id)
+        estado = sessao.etapa if sessao else None
+
+        for chave in ((estado, comando), (None, comando), (estado, None), (None, None)):
+            handler = self._rotas.get(chave)
+            if handler:
+                return handler
+        return None
+
+    def despachar(self, mensagem):
+        handler = self.rota(mensagem)
+        if handler:
+            self.despachadas += 1
+            try:
+                handler(mensagem)
+            finally:
+                # Só depois do handler a sessão reflete a etapa nova; marcar antes perderia a alteração
+                user_sessions.salvar(mensagem.chat.id)
+
+# ==================== ENVIO DE MENSAGENS ====================
+class BaldeTokens:
+    """Token bucket: repõe `taxa` tokens por segundo, acumulando até `capacidade`"""
+
+    __slots__ = ("taxa", "capacidade", "tokens", "atualizado")
+
+    def __init__(self, taxa: float, capacidade: float):
+        self.taxa = taxa
+        self.capacidade = capacidade
+        self.tokens = capacidade
+        self.atualizado = time.monotonic()
+
+    def _repor(self, agora: float):
+        if agora <= self.atualizado:
+            return  # esvaziado até um instante futuro
+        self.tokens = min(self.capacidade, self.tokens + (agora - self.atualizado) * self.taxa)
+        self.atualizado = agora
+
+    def espera(self, agora: float) -> float:
+        """Segundos até haver um token disponível (0 se já houver)"""
+        self._repor(agora)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.taxa
+
+    def consumir(self, agora: float):
+        self._repor(agora)
+        self.tokens -= 1
+
+    def esvaziar(self, ate: float):
+        """Zera os tokens e só volta a repor a partir de `ate`"""
+        self.tokens = 0.0
+        self.atualizado = ate
+
+    def cheio(self, agora: float) -> bool:
+        self._repor(agora)
+        return self.tokens >= self.capacidade
+
+class Envio:
+    """Uma chamada pendente à API do Telegram"""
+
+    __slots__ = ("metodo", "args", "kwargs", "futuro", "tentativas")
+
+    def __init__(self, metodo: str, args: Tuple, kwargs: Dict):
+        self.metodo = metodo
+        self.args = args
+        self.kwargs = kwargs
+        self.futuro = Future()
+        self.tentativas = 0
+
+class AgendadorEnvios:
+    """Fila de saída do bot: limite global e por chat (token bucket), ordem por chat e retentativas"""
+
+    # Só falhas em que a requisição certamente não chegou ao Telegram (ConnectTimeout incluso);
+    # ReadTimeout pode ter entregue a mensagem e repetir duplicaria o envio
+    ERROS_TRANSITORIOS = (requests.exceptions.ConnectionError, requests.exceptions.ConnectTimeout)
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.balde_global = BaldeTokens(
+            float(os.getenv("ENVIO_TAXA_GLOBAL", 25)), float(os.getenv("ENVIO_RAJADA_GLOBAL", 30))
+        )
+        self.taxa_chat = float(os.getenv("ENVIO_TAXA_CHAT", 1))
+        self.rajada_chat = float(os.getenv("ENVIO_RAJADA_CHAT", 3))
+        self.max_tentativas = int(os.getenv("ENVIO_MAX_TENTATIVAS", 5))
+
+        self._filas = {}       # chat_id -> deque de Envio (existe enquanto o chat tem envios pendentes)
+        self._baldes = {}      # chat_id -> BaldeTokens
+        self._bloqueios = {}   # chat_id -> instante liberado após um 429
+        self._pausa_global = 0.0  # instante liberado após um 429 (o limite pode ser o global do bot)
+        self._agenda = []      # heap (quando, seq, chat_id) de chats prontos para o próximo envio
+        self._seq = 0
+        self._cond = threading.Condition()
+        self._executor = ThreadPoolExecutor(
+            max_workers=int(os.getenv("ENVIO_WORKERS", 8)), thread_name_prefix="envio"
+        )
+
+        self.enviados = 0
+        self.falhas = 0
+        self.retentativas = 0
+        self.limitados = 0  # respostas 429
+
+        self._thread = Thread(target=self._loop, name="agendador-envios", daemon=True)
+        self._thread.start()
+
+    # ---- API usada pelos handlers: retornam um Future imediatamente ----
+
+    def enviar(self, chat_id, texto: str, **kwargs) -> Future:
+        return self._enfileirar(chat_id, "send_message", (chat_id, texto), kwargs)
+
+    def editar(self, texto: str, chat_id=None, message_id=None, **kwargs) -> Future:
+        """message_id pode ser o Future de um envio anterior ao mesmo chat"""
+        kwargs.update(chat_id=chat_id, message_id=message_id)
+        return self._enfileirar(chat_id, "edit_message_text", (texto,), kwargs)
+
+    def documento(self, chat_id, documento, **kwargs) -> Future:
+        return self._enfileirar(chat_id, "send_document", (chat_id, documento), kwargs)
+
+    # ---- Agendamento ----
+
+    def _agendar(self, quando: float, chat_id):
+        self._seq += 1
+        heapq.heappush(self._agenda, (quando, self._seq, chat_id))
+        self._cond.notify()
+
+    def _enfileirar(self, chat_id, metodo: str, args: Tuple, kwargs: Dict) -> Future:
+        envio = Envio(metodo, args, kwargs)
+        with self._cond:
+            fila = self._filas.get(chat_id)
+            if fila is None:
+                # Chat sem pendências entra na agenda; senão o envio espera a vez atrás dos anteriores
+                fila = self._filas[chat_id] = deque()
+                self._agendar(time.monotonic(), chat_id)
+            fila.append(envio)
+        return envio.futuro
+
+    def _loop(self):
+        proxima_limpeza = time.monotonic() + 60
+        while True:
+            with self._cond:
+                while True:
+                    agora = time.monotonic()
+                    if self._agenda and self._agenda[0][0] <= agora:
+                        break
+                    self._cond.wait(timeout=self._agenda[0][0] - agora if self._agenda else None)
+
+                _, _, chat_id = heapq.heappop(self._agenda)
+                balde = self._baldes.get(chat_id)
+                if balde is None:
+                    balde = self._baldes[chat_id] = BaldeTokens(self.taxa_chat, self.rajada_chat)
+
+                espera = max(
+                    balde.espera(agora),
+                    self.balde_global.espera(agora),
+                    self._bloqueios.get(chat_id, 0) - agora,
+                    self._pausa_global - agora
+                )
+                if espera > 0:
+                    self._agendar(agora + espera, chat_id)
+                    continue
+
+                balde.consumir(agora)
+                self.balde_global.consumir(agora)
+                self._bloqueios.pop(chat_id, None)
+                envio = self._filas[chat_id].popleft()
+
+                if agora >= proxima_limpeza:
+                    # Baldes cheios de chats sem pendências equivalem a baldes novos
+                    for chat in [c for c, b in self._baldes.items() if c not in self._filas and b.cheio(agora)]:
+                        del self._baldes[chat]
+                    proxima_limpeza = agora + 60
+
+            # Fora do lock: a chamada HTTP não segura a agenda; o chat só volta a ela quando terminar
+            self._executor.submit(self._executar, chat_id, envio)
+
+    def _executar(self, chat_id, envio: Envio):
+        proximo = time.monotonic()
+        try:
+            kwargs = envio.kwargs
+            if isinstance(kwargs.get("message_id"), Future):
+                kwargs = dict(kwargs, message_id=kwargs["message_id"].result().message_id)
+
+            envio.futuro.set_result(getattr(self.bot, envio.metodo)(*envio.args, **kwargs))
+            with self._cond:
+                self.enviados += 1
+
+        except Exception as e:
+            espera = self._espera_retentativa(envio, e)
+            with self._cond:
+                if espera is None:
+                    self.falhas += 1
+                else:
+                    self.retentativas += 1
+                    proximo += espera
+                    self._bloqueios[chat_id] = proximo
+                    self._filas[chat_id].appendleft(envio)
+
+            if espera is None:
+                envio.futuro.set_exception(e)
+                nivel = self._nivel_falha(e)
+                emoji = {"info": "🚫", "warning": "⚠️"}.get(nivel, "❌")
+                logger.log(nivel, f"{emoji} Falha ao enviar ({envio.metodo}) para {chat_id}: {e}", chat_id)
+
+        finally:
+            with self._cond:
+                if self._filas[chat_id]:
+                    self._agendar(proximo, chat_id)
+                else:
+                    del self._filas[chat_id]
+
+    @staticmethod
+    def _nivel_falha(erro: Exception) -> str:
+        """403 (bot bloqueado) é rotina, demais 4xx são aviso; só o resto é erro nosso ou do Telegram"""
+        if isinstance(erro, telebot.apihelper.ApiTelegramException):
+            codigo = erro.error_code
+        elif isinstance(erro, telebot.apihelper.ApiHTTPException):
+            codigo = getattr(erro.result, "status_code", 500)
+        else:
+            return "error"
+        if codigo < 500:
+            return "info" if codigo == 403 else "warning"
+        return "error"
+
+    def _espera_retentativa(self, envio: Envio, erro: Exception) -> Optional[float]:
+        """Segundos até tentar de novo, ou None se o erro é definitivo"""
+        envio.tentativas += 1
+        if envio.tentativas > self.max_tentativas:
+            return None
+
+        if isinstance(erro, telebot.apihelper.ApiTelegramException):
+            if erro.error_code == 429:
+                retry_after = (erro.result_json or {}).get("parameters", {}).get("retry_after", 1)
+                with self._cond:
+                    self.limitados += 1
+                    # Todos os chats param até o retry_after e o balde global recomeça vazio
+                    agora = time.monotonic()
+                    self._pausa_global = max(self._pausa_global, agora + retry_after)
+                    self.balde_global.esvaziar(self._pausa_global)
+                return retry_after + random.uniform(0, 0.5)
+            if erro.error_code < 500:
+                return None  # 400/403: mensagem inválida ou usuário bloqueou o bot
+        elif isinstance(erro, telebot.apihelper.ApiHTTPException):
+            # Resposta sem JSON (página HTML de 502/504 do proxy): só 5xx é transitório
+            if getattr(erro.result, "status_code", 0) < 500:
+                return None
+        elif not isinstance(erro, self.ERROS_TRANSITORIOS):
+            return None
+
+        # Backoff exponencial com jitter para 5xx e falhas de rede
+        return min(30.0, 0.5 * 2 ** envio.tentativas) * random.uniform(0.5, 1.5)
+
+    def drenar(self, timeout: float = 5) -> bool:
+        """Espera os envios pendentes terminarem (antes de reiniciar o processo)"""
+        limite = time.monotonic() + timeout
+        while time.monotonic() < limite:
+            with self._cond:
+                if not self._filas:
+                    return True
+            time.sleep(0.1)
+        return False
+
+    def resumo(self) -> str:
+        with self._cond:
+            pendentes = sum(len(fila) for fila in self._filas.values())
+            return (
+                f"{pendentes} pendente(s) em {len(self._filas)} chat(s) | {self.enviados} enviados, "
+                f"{self.retentativas} retentativas, {self.limitados} limitados (429), {self.falhas} falhas"
+            )
+
+# Todas as chamadas de saída (send_message, edit_message_text, send_document) passam por aqui
+agendador = AgendadorEnvios(bot)
+
+# ==================== DIFUSÃO DE ANÚNCIOS ====================
+class DifusorAnuncios:
+    """Envia um anúncio a todos os clientes em lotes, com progresso no SQLite para retomar após reinícios"""
+
+    STATUS = {
+        "em_andamento": "🟡 Em andamento",
+        "concluida": "🟢 Concluída",
+        "cancelada": "🔴 Cancelada",
+    }
+
+    def __init__(self):
+        self.tamanho_lote = int(os.getenv("DIFUSAO_TAMANHO_LOTE", 50))
+        # Abaixo do limite global do agendador, para sobrar vazão às conversas em andamento;
+        # cada envio espera seu token (sem rajada), então a taxa vale a todo instante, não só na média
+        self.taxa = float(os.getenv("DIFUSAO_TAXA", 10))
+        self.balde = BaldeTokens(self.taxa, 1)
+        self._acordar = Event()
+        self._thread = Thread(target=self._loop, name="difusor", daemon=True)
+        self._thread.start()
+
+    def destinatarios(self, apos: str, limite: int) -> List[str]:
+        """Próximos user_id distintos (usuarios + pedidos) depois de `apos`, em ordem"""
+        cursor = db.sqlite_conn.execute('''
+            SELECT user_id FROM usuarios WHERE user_id > ?
+            UNION
+            SELECT user_id FROM pedidos WHERE user_id > ?
+            ORDER BY user_id LIMIT ?
+        ''', (apos, apos, limite))
+        return [linha[0] for linha in cursor.fetchall()]
+
+    def total_destinatarios(self) -> int:
+        return db.sqlite_conn.execute(
+            "SELECT COUNT(*) FROM (SELECT user_id FROM usuarios UNION SELECT user_id FROM pedidos)"
+        ).fetchone()[0]
+
+    def iniciar(self, anuncio: Dict, criada_por) -> int:
+        agora = datetime.now(timezone.utc).isoformat()
+        with db.sqlite.escrita() as conn:
+            # Título e mensagem copiados: editar ou remover o anúncio não altera a difusão em curso
+            cursor = conn.execute('''
+                INSERT INTO difusoes (anuncio_id, titulo, mensagem, criada_por, total, criada_em, atualizada_em)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', (str(anuncio['id']), anuncio['titulo'], anuncio['mensagem'], str(criada_por),
+                  self.total_destinatarios(), agora, agora))
+            difusao_id = cursor.lastrowid
+
+        logger.log("info", f"📣 Difusão #{difusao_id} do anúncio {anuncio['id']} iniciada por {criada_por}")
+        self._acordar.set()
+        return difusao_id
+
+    def cancelar(self, difusao_id: int) -> bool:
+        with db.sqlite.escrita() as conn:
+            cursor = conn.execute(
+                "UPDATE difusoes SET status = 'cancelada', atualizada_em = ? WHERE id = ? AND status = 'em_andamento'",
+                (datetime.now(timezone.utc).isoformat(), difusao_id)
+            )
+        return cursor.rowcount > 0
+
+    def buscar(self, difusao_id: int) -> Optional[Dict]:
+        linha = db.sqlite_conn.execute("SELECT * FROM difusoes WHERE id = ?", (difusao_id,)).fetchone()
+        return dict(linha) if linha else None
+
+    def listar(self, limite: int = 5) -> List[Dict]:
+        cursor = db.sqlite_conn.execute("SELECT * FROM difusoes ORDER BY id DESC LIMIT ?", (limite,))
+        return [dict(linha) for linha in cursor.fetchall()]
+
+    def em_andamento(self, anuncio_id: str) -> bool:
+        return db.sqlite_conn.execute(
+            "SELECT 1 FROM difusoes WHERE anuncio_id = ? AND status = 'em_andamento'", (str(anuncio_id),)
+        ).fetchone() is not None
+
+    def _loop(self):
+        # Começa acordado: retoma difusões interrompidas por um reinício
+        self._acordar.set()
+        while True:
+            self._acordar.wait()
+            self._acordar.clear()
+            try:
+                while db.sqlite:
+                    linha = db.sqlite_conn.execute(
+                        "SELECT * FROM difusoes WHERE status = 'em_andamento' ORDER BY id LIMIT 1"
+                    ).fetchone()
+                    if not linha:
+                        break
+                    self._executar(dict(linha))
+            except Exception as e:
+                logger.log("error", f"❌ Erro na difusão de anúncios: {e}")
+                time.sleep(5)
+                self._acordar.set()
+
+    def _executar(self, difusao: Dict):
+        difusao_id = difusao['id']
+        texto = f"📢 *{difusao['titulo']}*\n\n{difusao['mensagem']}\n\n━━━━━━━━━━━━━━"
+        ultimo = difusao['ultimo_user_id'] or ''
+        if ultimo:
+            logger.log("info", f"📣 Retomando difusão #{difusao_id} após o usuário {ultimo}")
+
+        while True:
+            status = db.sqlite_conn.execute("SELECT status FROM difusoes WHERE id = ?", (difusao_id,)).fetchone()
+            if not status or status[0] != 'em_andamento':
+                logger.log("warning", f"⚠️ Difusão #{difusao_id} interrompida ({status[0] if status else 'removida'})")
+                return
+
+            lote = self.destinatarios(ultimo, self.tamanho_lote)
+            if not lote:
+                break
+
+            entregues, bloqueados, falhas = self._enviar_lote(lote, texto)
+            ultimo = lote[-1]
+
+            # Marca salva por lote: um reinício reenvia no máximo o lote em curso
+            with db.sqlite.escrita() as conn:
+                conn.execute('''
+                    UPDATE difusoes SET ultimo_user_id = ?, entregues = entregues + ?, bloqueados = bloqueados + ?,
+                        falhas = falhas + ?, atualizada_em = ?
+                    WHERE id = ?
+                ''', (ultimo, entregues, bloqueados, falhas, datetime.now(timezone.utc).isoformat(), difusao_id))
+
+        agora = datetime.now(timezone.utc).isoformat()
+        with db.sqlite.escrita() as conn:
+            conn.execute(
+                "UPDATE difusoes SET status = 'concluida', concluida_em = ?, atualizada_em = ? WHERE id = ?",
+                (agora, agora, difusao_id)
+            )
+
+        difusao = self.buscar(difusao_id)
+        logger.log(
+            "success",
+            f"📣 Difusão #{difusao_id} concluída: {difusao['entregues']} entregue(s), "
+            f"{difusao['bloqueados']} bloqueado(s), {difusao['falhas']} falha(s)"
+        )
+        if difusao['criada_por']:
+            agendador.enviar(int(difusao['criada_por']), "✅ *DIFUSÃO CONCLUÍDA*\n\n" + self.formatar(difusao))
+
+    def _enviar_lote(self, lote: List[str], texto: str) -> Tuple[int, int, int]:
+        envios = []
+        falhas = 0
+        for user_id in lote:
+            try:
+                chat_id = int(user_id)
+            except ValueError:
+                falhas += 1  # user_id que não é um chat do Telegram
+                continue
+
+            espera = self.balde.espera(time.monotonic())
+            if espera > 0:
+                time.sleep(espera)
+            self.balde.consumir(time.monotonic())
+            envios.append(agendador.enviar(chat_id, texto))
+
+        entregues = bloqueados = 0
+        for envio in envios:
+            erro = envio.exception()
+            if erro is None:
+                entregues += 1
+            elif isinstance(erro, telebot.apihelper.ApiTelegramException) and erro.error_code == 403:
+                bloqueados += 1  # usuário bloqueou o bot ou desativou a conta
+            else:
+                falhas += 1
+        return entregues, bloqueados, falhas
+
+    def formatar(self, difusao: Dict) -> str:
+        processados = difusao['entregues'] + difusao['bloqueados'] + difusao['falhas']
+        percentual = processados / difusao['total'] * 100 if difusao['total'] else 100.0
+        return (
+            f"📣 *Difusão #{difusao['id']}* - {difusao['titulo'][:40]}\n"
+            f"{self.STATUS.get(difusao['status'], difusao['status'])} | "
+            f"{processados}/{difusao['total']} ({min(percentual, 100.0):.0f}%)\n"
+            f"✅ Entregues: {difusao['entregues']} | 🚫 Bloqueados: {difusao['bloqueados']} | "
+            f"❌ Falhas: {difusao['falhas']}"
+        )
+
+difusor = DifusorAnuncios()
+
+# ==================== NOTIFICAÇÕES DO ADMIN ====================
+class NotificadorAdmin:
+    """Avisos de novos pedidos ao dono fora do caminho do cliente: imediatos com pouco movimento, resumo no pico"""
+
+    def __init__(self, destino: int):
+        self.destino = destino
+        # Acima desta taxa (pedidos no último minuto) os avisos passam a ser agrupados
+        self.max_por_minuto = int(os.getenv("NOTIFICACAO_MAX_POR_MINUTO", 6))
+        self.janela_min = float(os.getenv("NOTIFICACAO_JANELA_MIN", 10))
+        self.janela_max = float(os.getenv("NOTIFICACAO_JANELA_MAX", 120))
+
+        self._pendentes = []    # (instante, pedido)
+        self._chegadas = deque()  # instantes dos pedidos do último minuto
+        self._cond = threading.Condition()
+        self.janela_atual = 0.0
+        self.pedidos = 0
+        self.mensagens = 0
+        self.resumos = 0
+
+        self._thread = Thread(target=self._loop, name="notificador-admin", daemon=True)
+        self._thread.start()
+
+    def registrar_pedido(self, codigo: str, pedido: Dict, fonte: str):
+        if not self.destino:
+            return
+        agora = time.monotonic()
+        with self._cond:
+            self._pendentes.append((agora, dict(pedido, codigo_pedido=codigo, fonte=fonte)))
+            self._chegadas.append(agora)
+            self.pedidos += 1
+            self._cond.notify()
+
+    def _janela(self, agora: float) -> float:
+        """0 com pouco movimento; acima do limite cresce com a taxa de chegada, entre o mínimo e o máximo"""
+        while self._chegadas and self._chegadas[0] < agora - 60:
+            self._chegadas.popleft()
+        taxa = len(self._chegadas)
+        if taxa <= self.max_por_minuto:
+            return 0.0
+        return min(self.janela_max, max(self.janela_min, taxa / self.max_por_minuto * self.janela_min))
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                while True:
+                    if not self._pendentes:
+                        self._cond.wait()
+                        continue
+                    agora = time.monotonic()
+                    self.janela_atual = self._janela(agora)
+                    prazo = self._pendentes[0][0] + self.janela_atual
+                    if agora >= prazo:
+                        break
+                    self._cond.wait(prazo - agora)
+
+                lote = [pedido for _, pedido in self._pendentes]
+                self._pendentes = []
+                janela = self.janela_atual
+                self.mensagens += 1
+                if len(lote) > 1:
+                    self.resumos += 1
+
+            try:
+                texto = self._formatar(lote[0]) if len(lote) == 1 else self._formatar_resumo(lote, janela)
+                agendador.enviar(self.destino, texto)
+            except Exception as e:
+                logger.log("error", f"Erro ao notificar admin: {e}")
+
+    @staticmethod
+    def _formatar(pedido: Dict) -> str:
+        return (
+            f"📦 *NOVO PEDIDO RECEBIDO!*\n\n"
+            f"📋 Código: `{pedido['codigo_pedido']}`\n"
+            f"👤 Cliente: {pedido['nome']}\n"
+            f"🍕 Pizza: {pedido['pizza']}\n"
+            f"📍 Endereço: {pedido['endereco'][:50]}...\n"
+            f"💰 Valor: R$ {pedido['valor']:.2f}\n"
+            f"📱 Telefone: {pedido['telefone']}\n\n"
+            f"💾 Salvo em: {pedido['fonte'].upper()}"
+        )
+
+    @staticmethod
+    def _formatar_resumo(lote: List[Dict], janela: float) -> str:
+        linhas = [
+            f"• `{pedido['codigo_pedido']}` - {pedido['nome'][:20]} - R$ {pedido['valor']:.2f}"
+            for pedido in lote[:15]
+        ]
+        if len(lote) > 15:
+            linhas.append(f"• ... e mais {len(lote) - 15} pedido(s)")
+        total = sum(pedido['valor'] for pedido in lote)
+        return (
+            f"📦 *{len(lote)} NOVOS PEDIDOS* (últimos {max(janela, 1):.0f}s)\n\n"
+            + "\n".join(linhas)
+            + f"\n\n💰 *Total:* R$ {total:.2f}\n"
+            f"Detalhes em /pedidos"
+        )
+
+    def resumo(self) -> str:
+        with self._cond:
+            janela = f"resumo a cada {self.janela_atual:.0f}s" if self.janela_atual else "imediato"
+            return f"{self.pedidos} pedido(s) em {self.mensagens} mensagem(ns) ({self.resumos} resumos) | {janela}"
+
+notificador_admin = NotificadorAdmin(DONO_ID)
+
+# ==================== PROCESSAMENTO DE UPDATES ====================
+class PoolProcessamento:
+    """Workers com uma fila cada; os updates de um chat sempre caem no mesmo worker, em ordem"""
+
+    def __init__(self, processar, workers: int = None, capacidade: int = None):
+        self._processar = processar
+        self.workers = max(1, workers or int(os.getenv("PROCESSAMENTO_WORKERS", 8)))
+        capacidade = capacidade or int(os.getenv("PROCESSAMENTO_FILA_MAX", 1000))
+
+        self.filas = [queue.Queue(maxsize=capacidade) for _ in range(self.workers)]
+        self.processados = 0
+        self.falhas = 0
+        self._atraso_total = 0.0
+        self._atraso_max = 0.0
+        self._inicio_atual = [None] * self.workers  # início do update em execução em cada worker
+        self._lock = Lock()
+
+        self._threads = []
+        for indice in range(self.workers):
+            thread = Thread(target=self._loop, args=(indice,), name=f"updates-{indice}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    @staticmethod
+    def chave(update) -> int:
+        """Chat dono do update; o que não tiver chat é espalhado pelo update_id"""
+        mensagem = update.message or update.edited_message or update.channel_post or update.edited_channel_post
+        if mensagem:
+            return mensagem.chat.id
+        if update.callback_query:
+            return update.callback_query.from_user.id
+        return update.update_id
+
+    def submeter(self, updates: List):
+        # Fila cheia bloqueia o polling: a pressão volta para o Telegram em vez de acumular memória
+        for update in updates:
+            self.filas[self.chave(update) % self.workers].put((time.monotonic(), update))
+
+    def _loop(self, indice: int):
+        fila = self.filas[indice]
+        while True:
+            item = fila.get()
+            if item is None:
+                break
+
+            enfileirado_em, update = item
+            inicio = time.monotonic()
+            self._inicio_atual[indice] = inicio
+            try:
+                self._processar([update])
+            except Exception as e:
+                with self._lock:
+                    self.falhas += 1
+                logger.log("error", f"❌ Erro processando update {update.update_id}: {e}")
+            finally:
+                self._inicio_atual[indice] = None
+                atraso = inicio - enfileirado_em
+                with self._lock:
+                    self.processados += 1
+                    self._atraso_total += atraso
+                    self._atraso_max = max(self._atraso_max, atraso)
+
+    def profundidades(self) -> List[int]:
+        return [fila.qsize() for fila in self.filas]
+
+    def parar(self, timeout: float = 5):
+        for fila in self.filas:
+            fila.put(None)
+        for thread in self._threads:
+            thread.join(timeout=timeout)
+
+    def resumo(self) -> str:
+        profundidades = self.profundidades()
+        agora = time.monotonic()
+        ocupados = [agora - inicio for inicio in self._inicio_atual if inicio is not None]
+        with self._lock:
+            media = self._atraso_total / self.processados * 1000 if self.processados else 0.0
+            maximo = self._atraso_max * 1000
+            processados, falhas = self.processados, self.falhas
+        return (
+            f"{self.workers} workers, {len(ocupados)} ocupados | fila {sum(profundidades)} "
+            f"(maior {max(profundidades)}) | espera média {media:.1f}ms (máx {maximo:.1f}ms) | "
+            f"mais longo em execução {max(ocupados, default=0):.1f}s | {processados} processados, {falhas} falhas"
+        )
+
 # ==================== HANDLERS DE COMANDOS ====================
 # Dados temporários dos usuários
-user_sessions = {}
+user_sessions = ArmazemSessoes()
+despachante = Despachante()
+
+# Único handler registrado no TeleBot: o roteamento fica todo no despachante.
+# Só texto, como os handlers antigos: fotos, áudios etc. não entram nos fluxos por etapa
+bot.register_message_handler(despachante.despachar, content_types=['text'], func=lambda mensagem: True)
+
+# Updates saem do polling para o pool: em ordem dentro de cada chat, em paralelo entre chats
+pool_updates = PoolProcessamento(bot.process_new_updates)
+
+def receber_updates(updates):
+    """Substitui bot.process_new_updates: avança o offset do polling e entrega ao pool"""
+    for update in updates:
+        if update.update_id > bot.last_update_id:
+            bot.last_update_id = update.update_id
+    pool_updates.submeter(updates)
+
+bot.process_new_updates = receber_updates
+
+@bot.middleware_handler(update_types=['message'])
+def registrar_acesso_usuario(bot_instance, mensagem):
+    """Marca o último acesso do remetente (escrita limitada por usuário)"""
+    if mensagem.from_user:
+        db.registrar_acesso(
+            str(mensagem.from_user.id),
+            mensagem.from_user.username,
+            mensagem.from_user.first_name
+        )
 
-@bot.message_handler(commands=['start', 'menu', 'cardapio'])
+@despachante.comando('start', 'menu', 'cardapio')
 def comando_menu(mensagem):
     """Menu principal com anúncios"""
     chat_id = mensagem.chat.id
 
     # Limpar sessão anterior
-    if chat_id in user_sessions:
-        del user_sessions[chat_id]
+    user_sessions.encerrar(chat_id)
 
-    logger.log("info", f"Usuário {chat_id} acessou o menu")
+    logger.log("info", f"Usuário {chat_id} acessou o menu", chat_id, chave="menu")
 
     # Mostrar anúncios ativos
     anuncios = db.buscar_anuncios_ativos(tipo="geral")
     if anuncios:
         for anuncio in anuncios[:2]:  # Máximo 2 anúncios
             try:
-                bot.send_message(
+                agendador.enviar(
                     chat_id,
                     f"📢 *{anuncio['titulo']}*\n\n{anuncio['mensagem']}\n\n━━━━━━━━━━━━━━",
                     parse_mode="Markdown"
                 )
-                time.sleep(0.3)
             except Exception as e:
                 logger.log("error", f"Erro ao enviar anúncio: {e}")
 
     # Menu principal
-    menu_texto = """
+    menu_texto = f"""
 *🍕 *PIZZARIA ROMEO* 🍕*
 _Sabores que conquistam corações!_
 
@@ -759,7 +3765,7 @@ _Sabores que conquistam corações!_
 • Zona Sul (consulte disponibilidade)
 
 *⏰ HORÁRIO DE FUNCIONAMENTO:*
-Todos os dias: 18:00 - 23:00
+Todos os dias: {config.horario_funcionamento}
 
 ━━━━━━━━━━━━━━━━━━━━━━
 *🎨 ESCOLHA SEU SABOR:*
@@ -782,32 +3788,32 @@ Todos os dias: 18:00 - 23:00
 /promocoes - Promoções ativas
 """
 
-    bot.send_message(chat_id, menu_texto)
+    agendador.enviar(chat_id, menu_texto)
 
     # Se for admin, mostrar opção
     if admin.is_admin(chat_id):
-        bot.send_message(chat_id, "👑 *Modo Administrador Ativo*\nUse /admin para acessar o painel completo")
+        agendador.enviar(chat_id, "👑 *Modo Administrador Ativo*\nUse /admin para acessar o painel completo")
 
-@bot.message_handler(commands=['calabresa', 'portuguesa', 'marguerita', 'frango', 'quatroqueijos', 'chocolate', 'romeuejulieta'])
+@despachante.comando('calabresa', 'portuguesa', 'marguerita', 'frango', 'quatroqueijos', 'chocolate', 'romeuejulieta')
 def iniciar_pedido(mensagem):
     """Inicia um novo pedido"""
     chat_id = mensagem.chat.id
     comando = mensagem.text.replace("/", "").lower()
 
     if comando not in PizzaSabor.SABORES:
-        bot.send_message(chat_id, "❌ Sabor não encontrado. Use /menu para ver as opções.")
+        agendador.enviar(chat_id, "❌ Sabor não encontrado. Use /menu para ver as opções.")
         return
 
     sabor_info = PizzaSabor.SABORES[comando]
 
     # Iniciar sessão
-    user_sessions[chat_id] = {
-        'pizza': sabor_info['nome'],
-        'descricao': sabor_info['desc'],
-        'preco_base': sabor_info['preco'],
-        'etapa': 'nome',
-        'timestamp': time.time()
-    }
+    user_sessions.iniciar(
+        chat_id,
+        pizza=sabor_info['nome'],
+        descricao=sabor_info['desc'],
+        preco_base=sabor_info['preco'],
+        etapa='nome'
+    )
 
     logger.log("info", f"Iniciando pedido de {comando} para {chat_id}")
 
@@ -825,27 +3831,62 @@ Vamos começar seu pedido! 🎉
 *1️⃣ Qual seu nome completo?*
 """
 
-    bot.send_message(chat_id, resposta)
+    agendador.enviar(chat_id, resposta)
+
+def oferecer_tamanhos(chat_id, sabor: str, aviso: str = ""):
+    """Teclado de tamanhos, só com os que atingem o pedido mínimo"""
+    permitidos = sistema_pedidos.tamanhos_permitidos(sabor)
+    if not permitidos:
+        user_sessions.encerrar(chat_id)
+        agendador.enviar(
+            chat_id,
+            f"❌ Este sabor não atinge o pedido mínimo de R$ {config.valor_minimo_entrega:.2f}.\n"
+            "Escolha outro sabor em /menu",
+            reply_markup=telebot.types.ReplyKeyboardRemove()
+        )
+        return
+
+    markup = telebot.types.ReplyKeyboardMarkup(
+        one_time_keyboard=True,
+        resize_keyboard=True,
+        row_width=2
+    )
+    linhas = []
+    for tamanho_key in permitidos:
+        tamanho_info = PizzaSabor.TAMANHOS[tamanho_key]
+        markup.add(f"{tamanho_info['nome']} ({tamanho_info['diametro']})")
+        linhas.append(f"• {tamanho_info['nome']} ({tamanho_info['diametro']}) - {tamanho_info['fatias']} fatias")
+
+    agendador.enviar(
+        chat_id,
+        f"{aviso}*5️⃣ Escolha o tamanho da pizza:*\n\n"
+        "📏 *Tamanhos disponíveis:*\n" + "\n".join(linhas),
+        reply_markup=markup
+    )
 
 # Handler para processar etapas do pedido
-@bot.message_handler(func=lambda m: m.chat.id in user_sessions and user_sessions[m.chat.id].get('etapa') in ['nome', 'telefone', 'endereco', 'idade', 'tamanho', 'pagamento', 'observacoes'])
+ETAPAS_PEDIDO = frozenset(['nome', 'telefone', 'endereco', 'idade', 'tamanho', 'pagamento', 'observacoes'])
+
+@despachante.estado(*ETAPAS_PEDIDO)
 def processar_etapa_pedido(mensagem):
     """Processa cada etapa do pedido"""
     chat_id = mensagem.chat.id
-    sessao = user_sessions[chat_id]
-    etapa = sessao['etapa']
+    sessao = user_sessions.obter(chat_id)
+    if not sessao:
+        return
+    etapa = sessao.etapa
     texto = mensagem.text.strip()
 
     try:
         if etapa == 'nome':
             if len(texto) < 3:
-                bot.send_message(chat_id, "❌ Nome muito curto. Digite seu nome completo:")
+                agendador.enviar(chat_id, "❌ Nome muito curto. Digite seu nome completo:")
                 return
 
-            sessao['nome'] = texto
-            sessao['etapa'] = 'telefone'
+            sessao.nome = texto
+            sessao.etapa = 'telefone'
 
-            bot.send_message(
+            agendador.enviar(
                 chat_id, 
                 f"✅ Obrigado, *{texto.split()[0]}*! 😊\n\n"
                 f"*2️⃣ Qual seu número de telefone?*\n"
@@ -856,7 +3897,7 @@ def processar_etapa_pedido(mensagem):
             # Validar telefone (simplificado)
             numeros = ''.join(filter(str.isdigit, texto))
             if len(numeros) < 10 or len(numeros) > 11:
-                bot.send_message(chat_id, "❌ Telefone inválido. Digite um número com DDD (ex: 11 99999-9999):")
+                agendador.enviar(chat_id, "❌ Telefone inválido. Digite um número com DDD (ex: 11 99999-9999):")
                 return
 
             # Formatar telefone
@@ -865,10 +3906,10 @@ def processar_etapa_pedido(mensagem):
             else:
                 telefone_formatado = f"({numeros[:2]}) {numeros[2:7]}-{numeros[7:]}"
 
-            sessao['telefone'] = telefone_formatado
-            sessao['etapa'] = 'endereco'
+            sessao.telefone = telefone_formatado
+            sessao.etapa = 'endereco'
 
-            bot.send_message(
+            agendador.enviar(
                 chat_id,
                 "*3️⃣ Qual o endereço de entrega?*\n"
                 "(Rua, número, bairro, complemento)\n"
@@ -877,13 +3918,13 @@ def processar_etapa_pedido(mensagem):
 
         elif etapa == 'endereco':
             if len(texto) < 10:
-                bot.send_message(chat_id, "❌ Endereço muito curto. Digite um endereço completo:")
+                agendador.enviar(chat_id, "❌ Endereço muito curto. Digite um endereço completo:")
                 return
 
-            sessao['endereco'] = texto
-            sessao['etapa'] = 'idade'
+            sessao.endereco = texto
+            sessao.etapa = 'idade'
 
-            bot.send_message(
+            agendador.enviar(
                 chat_id,
                 "*4️⃣ Para registro, qual sua idade?*\n"
                 "(Apenas número, ex: 25)"
@@ -894,33 +3935,12 @@ def processar_etapa_pedido(mensagem):
                 idade = int(texto)
                 if idade < 1 or idade > 120:
                     raise ValueError
-                sessao['idade'] = str(idade)
-                sessao['etapa'] = 'tamanho'
-
-                # Oferecer tamanhos
-                markup = telebot.types.ReplyKeyboardMarkup(
-                    one_time_keyboard=True, 
-                    resize_keyboard=True,
-                    row_width=2
-                )
-
-                for tamanho_key, tamanho_info in PizzaSabor.TAMANHOS.items():
-                    texto_botao = f"{tamanho_info['nome']} ({tamanho_info['diametro']})"
-                    markup.add(texto_botao)
-
-                bot.send_message(
-                    chat_id,
-                    "*5️⃣ Escolha o tamanho da pizza:*\n\n"
-                    "📏 *Tamanhos disponíveis:*\n"
-                    "• Pequena (25cm) - 4 fatias\n"
-                    "• Média (30cm) - 6 fatias\n"
-                    "• Grande (35cm) - 8 fatias\n"
-                    "• Família (45cm) - 12 fatias",
-                    reply_markup=markup
-                )
+                sessao.idade = str(idade)
+                sessao.etapa = 'tamanho'
+                oferecer_tamanhos(chat_id, sessao.pizza.split()[0].lower())
 
             except ValueError:
-                bot.send_message(chat_id, "❌ Idade inválida. Digite um número entre 1 e 120:")
+                agendador.enviar(chat_id, "❌ Idade inválida. Digite um número entre 1 e 120:")
 
         elif etapa == 'tamanho':
             # Identificar tamanho selecionado
@@ -933,14 +3953,23 @@ def processar_etapa_pedido(mensagem):
             if not tamanho_selecionado:
                 tamanho_selecionado = 'grande'  # Padrão
 
-            sessao['tamanho'] = tamanho_selecionado
-            sessao['etapa'] = 'pagamento'
-
             # Calcular valor
-            sabor = sessao['pizza'].split()[0].lower()
+            sabor = sessao.pizza.split()[0].lower()
             tamanho_info = PizzaSabor.TAMANHOS[tamanho_selecionado]
             valor = sistema_pedidos.calcular_valor(sabor, tamanho_selecionado)
-            valor_total = valor + sistema_pedidos.TAXA_ENTREGA
+
+            if tamanho_selecionado not in sistema_pedidos.tamanhos_permitidos(sabor):
+                oferecer_tamanhos(
+                    chat_id, sabor,
+                    f"❌ Pizza {tamanho_info['nome']}: R$ {valor:.2f}, abaixo do pedido mínimo "
+                    f"de R$ {config.valor_minimo_entrega:.2f}.\n\n"
+                )
+                return
+
+            sessao.tamanho = tamanho_selecionado
+            sessao.etapa = 'pagamento'
+            taxa = sistema_pedidos.calcular_taxa_entrega(valor)
+            valor_total = valor + taxa
 
             markup = telebot.types.ReplyKeyboardMarkup(
                 one_time_keyboard=True, 
@@ -949,22 +3978,22 @@ def processar_etapa_pedido(mensagem):
             )
             markup.add('💵 Dinheiro', '💳 Cartão (crédito)', '💳 Cartão (débito)', '📱 PIX')
 
-            bot.send_message(
+            agendador.enviar(
                 chat_id,
                 f"*6️⃣ Escolha a forma de pagamento:*\n\n"
                 f"💰 *Resumo do valor:*\n"
                 f"• Pizza {tamanho_info['nome']}: R$ {valor:.2f}\n"
-                f"• Taxa de entrega: R$ {sistema_pedidos.TAXA_ENTREGA:.2f}\n"
+                f"• Taxa de entrega: {f'R$ {taxa:.2f}' if taxa else 'Grátis 🎉'}\n"
                 f"• *Total: R$ {valor_total:.2f}*",
                 reply_markup=markup
             )
 
         elif etapa == 'pagamento':
-            sessao['pagamento'] = texto
-            sessao['etapa'] = 'observacoes'
+            sessao.pagamento = texto
+            sessao.etapa = 'observacoes'
 
             markup = telebot.types.ReplyKeyboardRemove()
-            bot.send_message(
+            agendador.enviar(
                 chat_id,
                 "*7️⃣ Alguma observação ou instrução especial?*\n\n"
                 "Exemplos:\n"
@@ -977,39 +4006,35 @@ def processar_etapa_pedido(mensagem):
 
         elif etapa == 'observacoes':
             if texto.upper() == 'OK' or texto.lower() == 'nenhuma':
-                sessao['observacoes'] = ''
+                sessao.observacoes = ''
             else:
-                sessao['observacoes'] = texto
+                sessao.observacoes = texto
 
             # Finalizar pedido
             finalizar_pedido_completo(chat_id)
 
     except Exception as e:
         logger.log("error", f"Erro no processamento do pedido: {e}", chat_id)
-        bot.send_message(
+        agendador.enviar(
             chat_id, 
             "❌ Ocorreu um erro no processamento. Por favor, comece novamente com /menu"
         )
-        if chat_id in user_sessions:
-            del user_sessions[chat_id]
+        user_sessions.encerrar(chat_id)
 
 def finalizar_pedido_completo(chat_id):
     """Finaliza o pedido e salva no banco"""
     try:
-        sessao = user_sessions[chat_id]
-
-        # Verificar timeout (30 minutos)
-        if time.time() - sessao.get('timestamp', 0) > 1800:
-            bot.send_message(chat_id, "⏰ *Sessão expirada!*\nPor favor, inicie um novo pedido com /menu")
-            if chat_id in user_sessions:
-                del user_sessions[chat_id]
+        # Sessões inativas além do TTL já não são devolvidas pelo armazém
+        sessao = user_sessions.obter(chat_id)
+        if not sessao:
+            agendador.enviar(chat_id, "⏰ *Sessão expirada!*\nPor favor, inicie um novo pedido com /menu")
             return
 
         # Criar dados do pedido
-        pedido_data = sistema_pedidos.criar_pedido_data(chat_id, sessao)
+        pedido_data = sistema_pedidos.criar_pedido_data(chat_id, sessao.dados_pedido())
 
         # Mostrar processamento
-        mensagem_processando = bot.send_message(
+        mensagem_processando = agendador.enviar(
             chat_id, 
             "⏳ *Processando seu pedido...*\n\n"
             "📦 Gerando código único...\n"
@@ -1022,47 +4047,34 @@ def finalizar_pedido_completo(chat_id):
 
         if sucesso:
             # Editar mensagem de processamento
-            bot.edit_message_text(
+            agendador.editar(
                 "✅ *Pedido processado com sucesso!*",
                 chat_id=chat_id,
-                message_id=mensagem_processando.message_id
+                message_id=mensagem_processando
             )
 
             # Enviar resumo completo
             resumo = sistema_pedidos.formatar_resumo_pedido(pedido_data, codigo)
-            bot.send_message(chat_id, resumo)
+            agendador.enviar(chat_id, resumo)
 
             # Enviar notificação para admin se for diferente do cliente
             if not admin.is_admin(chat_id):
-                try:
-                    bot.send_message(
-                        DONO_ID,
-                        f"📦 *NOVO PEDIDO RECEBIDO!*\n\n"
-                        f"📋 Código: `{codigo}`\n"
-                        f"👤 Cliente: {sessao['nome']}\n"
-                        f"🍕 Pizza: {sessao['pizza']}\n"
-                        f"📍 Endereço: {sessao['endereco'][:50]}...\n"
-                        f"💰 Valor: R$ {pedido_data['valor']:.2f}\n"
-                        f"📱 Telefone: {sessao['telefone']}\n\n"
-                        f"💾 Salvo em: {fonte.upper()}"
-                    )
-                except Exception as e:
-                    logger.log("error", f"Erro ao notificar admin: {e}")
+                notificador_admin.registrar_pedido(codigo, pedido_data, fonte)
 
             logger.log("success", f"Pedido {codigo} finalizado para {chat_id}")
         else:
-            bot.edit_message_text(
+            agendador.editar(
                 "❌ *Não foi possível processar seu pedido.*\n\n"
                 "Por favor, tente novamente ou entre em contato:\n"
-                "📞 (11) 99999-9999",
+                f"📞 {config.telefone_contato}",
                 chat_id=chat_id,
-                message_id=mensagem_processando.message_id
+                message_id=mensagem_processando
             )
             logger.log("error", f"Falha ao salvar pedido para {chat_id}")
 
     except Exception as e:
         logger.log("error", f"Erro ao finalizar pedido: {e}", chat_id)
-        bot.send_message(
+        agendador.enviar(
             chat_id, 
             "❌ Ocorreu um erro ao processar seu pedido.\n"
             "Por favor, tente novamente ou entre em contato."
@@ -1070,18 +4082,17 @@ def finalizar_pedido_completo(chat_id):
 
     finally:
         # Limpar sessão
-        if chat_id in user_sessions:
-            del user_sessions[chat_id]
+        user_sessions.encerrar(chat_id)
 
 # ==================== COMANDOS DE ADMINISTRAÇÃO ====================
 
-@bot.message_handler(commands=['admin'])
+@despachante.comando('admin')
 def comando_admin(mensagem):
     """Painel de administração"""
     chat_id = mensagem.chat.id
 
     if not admin.is_admin(chat_id):
-        bot.send_message(chat_id, "❌ *Acesso negado!*\nEste comando é apenas para administradores.")
+        agendador.enviar(chat_id, "❌ *Acesso negado!*\nEste comando é apenas para administradores.")
         return
 
     estatisticas = db.get_estatisticas()
@@ -1107,43 +4118,48 @@ def comando_admin(mensagem):
 /anunciar - Criar anúncio
 /anuncios - Ver anúncios ativos
 /remover_anuncio - Remover anúncio
+/difundir - Enviar anúncio a todos os clientes
+/difusao - Progresso das difusões
 /enviar_mensagem - Mensagem para cliente
 
 *📊 RELATÓRIOS:*
 /relatorio - Relatório completo
 /estatisticas - Estatísticas detalhadas
+/reconstruir_estatisticas - Recalcular estatísticas
+/reconciliar - Sincronizar SQLite e Supabase
 /backup - Criar backup dos dados
 
 *⚙️ SISTEMA:*
 /config - Configurações do sistema
 /logs - Ver logs do sistema
+/buscar_logs - Buscar logs por nível/chat
 /status_sistema - Status detalhado
 /reiniciar - Reiniciar conexões
 """
 
-    bot.send_message(chat_id, menu_admin)
+    agendador.enviar(chat_id, menu_admin)
 
-@bot.message_handler(commands=['pedidos'])
+@despachante.comando('pedidos')
 def comando_ver_pedidos(mensagem):
     """Ver todos os pedidos"""
     chat_id = mensagem.chat.id
 
     if not admin.is_admin(chat_id):
-        bot.send_message(chat_id, "❌ *Acesso negado!*")
+        agendador.enviar(chat_id, "❌ *Acesso negado!*")
         return
 
     pedidos = db.buscar_pedidos(limite=50)
     resposta = admin.formatar_pedidos_para_admin(pedidos)
 
-    bot.send_message(chat_id, resposta)
+    agendador.enviar(chat_id, resposta)
 
-@bot.message_handler(commands=['pedidos_hoje'])
+@despachante.comando('pedidos_hoje')
 def comando_pedidos_hoje(mensagem):
     """Pedidos de hoje"""
     chat_id = mensagem.chat.id
 
     if not admin.is_admin(chat_id):
-        bot.send_message(chat_id, "❌ *Acesso negado!*")
+        agendador.enviar(chat_id, "❌ *Acesso negado!*")
         return
 
     hoje = datetime.now().date()
@@ -1156,15 +4172,15 @@ def comando_pedidos_hoje(mensagem):
     resposta = f"📅 *PEDIDOS DE HOJE ({hoje.strftime('%d/%m/%Y')})*\n\n"
     resposta += admin.formatar_pedidos_para_admin(pedidos_hoje)
 
-    bot.send_message(chat_id, resposta)
+    agendador.enviar(chat_id, resposta)
 
-@bot.message_handler(commands=['pedidos_pendentes'])
+@despachante.comando('pedidos_pendentes')
 def comando_pedidos_pendentes(mensagem):
     """Pedidos pendentes"""
     chat_id = mensagem.chat.id
 
     if not admin.is_admin(chat_id):
-        bot.send_message(chat_id, "❌ *Acesso negado!*")
+        agendador.enviar(chat_id, "❌ *Acesso negado!*")
         return
 
     pedidos_pendentes = db.buscar_pedidos(filtros={"status": "pendente"})
@@ -1172,38 +4188,42 @@ def comando_pedidos_pendentes(mensagem):
     resposta = f"🟡 *PEDIDOS PENDENTES: {len(pedidos_pendentes)}*\n\n"
     resposta += admin.formatar_pedidos_para_admin(pedidos_pendentes)
 
-    bot.send_message(chat_id, resposta)
+    agendador.enviar(chat_id, resposta)
 
-@bot.message_handler(commands=['cancelar_pedido'])
+@despachante.comando('cancelar_pedido')
 def comando_cancelar_pedido(mensagem):
     """Cancelar um pedido"""
     chat_id = mensagem.chat.id
 
     if not admin.is_admin(chat_id):
-        bot.send_message(chat_id, "❌ *Acesso negado!*")
+        agendador.enviar(chat_id, "❌ *Acesso negado!*")
         return
 
-    bot.send_message(
+    agendador.enviar(
         chat_id,
         "❌ *CANCELAR PEDIDO*\n\nDigite o *código do pedido* que deseja cancelar (ex: PED20241225123045ABCDEF):"
     )
 
-    bot.register_next_step_handler(mensagem, processar_cancelamento)
+    user_sessions.iniciar(chat_id, acao='cancelar_pedido', etapa='cancelar_codigo')
 
+@despachante.estado('cancelar_codigo')
 def processar_cancelamento(mensagem):
     """Processa o cancelamento do pedido"""
     chat_id = mensagem.chat.id
     codigo = mensagem.text.strip().upper()
 
     if not codigo.startswith('PED'):
-        bot.send_message(chat_id, "❌ Código inválido. Deve começar com 'PED'")
+        agendador.enviar(chat_id, "❌ Código inválido. Deve começar com 'PED'")
+        user_sessions.encerrar(chat_id)
+        return
+
+    if not GeradorCodigoPedido.valido(codigo):
+        agendador.enviar(chat_id, "❌ Código inválido. Confira se foi digitado corretamente.")
+        user_sessions.encerrar(chat_id)
         return
 
     # Pedir motivo
-    user_sessions[chat_id] = {
-        'acao': 'cancelar_pedido',
-        'codigo': codigo
-    }
+    user_sessions.iniciar(chat_id, acao='cancelar_pedido', etapa='cancelar_motivo', codigo=codigo)
 
     markup = telebot.types.ReplyKeyboardMarkup(
         one_time_keyboard=True, 
@@ -1212,24 +4232,24 @@ def processar_cancelamento(mensagem):
     )
     markup.add('Cliente solicitou', 'Fora da área', 'Estoque insuficiente', 'Outro motivo')
 
-    bot.send_message(
+    agendador.enviar(
         chat_id,
         "📝 *Selecione ou digite o motivo do cancelamento:*",
         reply_markup=markup
     )
 
-    bot.register_next_step_handler(mensagem, processar_motivo_cancelamento)
-
+@despachante.estado('cancelar_motivo')
 def processar_motivo_cancelamento(mensagem):
     """Processa o motivo do cancelamento"""
     chat_id = mensagem.chat.id
 
-    if chat_id not in user_sessions:
-        bot.send_message(chat_id, "❌ Sessão expirada.")
+    sessao = user_sessions.obter(chat_id)
+    if not sessao:
+        agendador.enviar(chat_id, "❌ Sessão expirada.")
         return
 
     motivo = mensagem.text
-    codigo = user_sessions[chat_id]['codigo']
+    codigo = sessao.codigo
 
     # Cancelar pedido
     sucesso = db.atualizar_status_pedido(codigo, "cancelado", motivo)
@@ -1244,44 +4264,42 @@ def processar_motivo_cancelamento(mensagem):
 
 _O pedido foi marcado como cancelado no sistema._
 """
-        bot.send_message(chat_id, resposta, reply_markup=telebot.types.ReplyKeyboardRemove())
+        agendador.enviar(chat_id, resposta, reply_markup=telebot.types.ReplyKeyboardRemove())
     else:
-        bot.send_message(chat_id, f"❌ Pedido `{codigo}` não encontrado ou já cancelado.")
+        agendador.enviar(chat_id, f"❌ Pedido `{codigo}` não encontrado ou já cancelado.")
 
     # Limpar sessão
-    if chat_id in user_sessions:
-        del user_sessions[chat_id]
+    user_sessions.encerrar(chat_id)
 
-@bot.message_handler(commands=['status_pedido'])
+@despachante.comando('status_pedido')
 def comando_status_pedido(mensagem):
     """Alterar status de um pedido"""
     chat_id = mensagem.chat.id
 
     if not admin.is_admin(chat_id):
-        bot.send_message(chat_id, "❌ *Acesso negado!*")
+        agendador.enviar(chat_id, "❌ *Acesso negado!*")
         return
 
-    bot.send_message(
+    agendador.enviar(
         chat_id,
         "🔄 *ALTERAR STATUS DO PEDIDO*\n\nDigite o *código do pedido*:"
     )
 
-    bot.register_next_step_handler(mensagem, processar_codigo_status)
+    user_sessions.iniciar(chat_id, acao='alterar_status', etapa='status_codigo')
 
+@despachante.estado('status_codigo')
 def processar_codigo_status(mensagem):
     """Processa código para alterar status"""
     chat_id = mensagem.chat.id
     codigo = mensagem.text.strip().upper()
 
-    if not codigo.startswith('PED'):
-        bot.send_message(chat_id, "❌ Código inválido.")
+    if not GeradorCodigoPedido.valido(codigo):
+        agendador.enviar(chat_id, "❌ Código inválido.")
+        user_sessions.encerrar(chat_id)
         return
 
     # Salvar na sessão
-    user_sessions[chat_id] = {
-        'acao': 'alterar_status',
-        'codigo': codigo
-    }
+    user_sessions.iniciar(chat_id, acao='alterar_status', etapa='status_novo', codigo=codigo)
 
     # Mostrar opções de status
     markup = telebot.types.ReplyKeyboardMarkup(
@@ -1293,20 +4311,20 @@ def processar_codigo_status(mensagem):
     for status_key, status_info in PizzaSabor.STATUS.items():
         markup.add(f"{status_info['emoji']} {status_info['nome']}")
 
-    bot.send_message(
+    agendador.enviar(
         chat_id,
         "📊 *Selecione o novo status:*",
         reply_markup=markup
     )
 
-    bot.register_next_step_handler(mensagem, processar_novo_status)
-
+@despachante.estado('status_novo')
 def processar_novo_status(mensagem):
     """Processa novo status do pedido"""
     chat_id = mensagem.chat.id
 
-    if chat_id not in user_sessions:
-        bot.send_message(chat_id, "❌ Sessão expirada.")
+    sessao = user_sessions.obter(chat_id)
+    if not sessao:
+        agendador.enviar(chat_id, "❌ Sessão expirada.")
         return
 
     # Identificar status selecionado
@@ -1321,7 +4339,7 @@ def processar_novo_status(mensagem):
     if not novo_status:
         novo_status = 'pendente'
 
-    codigo = user_sessions[chat_id]['codigo']
+    codigo = sessao.codigo
 
     # Atualizar status
     sucesso = db.atualizar_status_pedido(codigo, novo_status)
@@ -1335,34 +4353,35 @@ def processar_novo_status(mensagem):
 📊 *Novo status:* {status_info['nome']}
 ⏰ *Atualizado em:* {datetime.now().strftime('%H:%M')}
 """
-        bot.send_message(chat_id, resposta, reply_markup=telebot.types.ReplyKeyboardRemove())
+        agendador.enviar(chat_id, resposta, reply_markup=telebot.types.ReplyKeyboardRemove())
     else:
-        bot.send_message(chat_id, f"❌ Pedido `{codigo}` não encontrado.")
+        agendador.enviar(chat_id, f"❌ Pedido `{codigo}` não encontrado.")
 
     # Limpar sessão
-    if chat_id in user_sessions:
-        del user_sessions[chat_id]
+    user_sessions.encerrar(chat_id)
 
-@bot.message_handler(commands=['buscar_pedido'])
+@despachante.comando('buscar_pedido')
 def comando_buscar_pedido(mensagem):
     """Buscar pedido específico"""
     chat_id = mensagem.chat.id
 
     if not admin.is_admin(chat_id):
-        bot.send_message(chat_id, "❌ *Acesso negado!*")
+        agendador.enviar(chat_id, "❌ *Acesso negado!*")
         return
 
-    bot.send_message(
+    agendador.enviar(
         chat_id,
         "🔍 *BUSCAR PEDIDO*\n\nDigite o *código do pedido* ou *nome do cliente*:"
     )
 
-    bot.register_next_step_handler(mensagem, processar_busca_pedido)
+    user_sessions.iniciar(chat_id, acao='buscar_pedido', etapa='buscar_termo')
 
+@despachante.estado('buscar_termo')
 def processar_busca_pedido(mensagem):
     """Processa busca de pedido"""
     chat_id = mensagem.chat.id
     termo = mensagem.text.strip()
+    user_sessions.encerrar(chat_id)
 
     # Buscar pedidos
     todos_pedidos = db.buscar_pedidos(limite=100)
@@ -1380,63 +4399,59 @@ def processar_busca_pedido(mensagem):
     else:
         resposta = f"❌ *Nenhum pedido encontrado para:* {termo}"
 
-    bot.send_message(chat_id, resposta)
+    agendador.enviar(chat_id, resposta)
 
-@bot.message_handler(commands=['anunciar'])
+@despachante.comando('anunciar')
 def comando_anunciar(mensagem):
     """Criar um anúncio"""
     chat_id = mensagem.chat.id
 
     if not admin.is_admin(chat_id):
-        bot.send_message(chat_id, "❌ *Acesso negado!*")
+        agendador.enviar(chat_id, "❌ *Acesso negado!*")
         return
 
     # Iniciar criação de anúncio
-    user_sessions[chat_id] = {
-        'acao': 'criar_anuncio',
-        'etapa': 'titulo'
-    }
+    user_sessions.iniciar(chat_id, acao='criar_anuncio', etapa='anuncio_titulo')
 
-    bot.send_message(
+    agendador.enviar(
         chat_id,
         "📢 *CRIAR NOVO ANÚNCIO*\n\n*1️⃣ Digite o título do anúncio:*\n(ex: 🎉 PROMOÇÃO ESPECIAL)"
     )
 
-    bot.register_next_step_handler(mensagem, processar_titulo_anuncio)
-
+@despachante.estado('anuncio_titulo')
 def processar_titulo_anuncio(mensagem):
     """Processa título do anúncio"""
     chat_id = mensagem.chat.id
 
-    if chat_id not in user_sessions or user_sessions[chat_id].get('acao') != 'criar_anuncio':
-        bot.send_message(chat_id, "❌ Sessão expirada.")
+    sessao = user_sessions.obter(chat_id)
+    if not sessao or sessao.acao != 'criar_anuncio':
+        agendador.enviar(chat_id, "❌ Sessão expirada.")
         return
 
-    user_sessions[chat_id]['titulo'] = mensagem.text
-    user_sessions[chat_id]['etapa'] = 'mensagem'
+    sessao.titulo = mensagem.text
+    sessao.etapa = 'anuncio_mensagem'
 
-    bot.send_message(
+    agendador.enviar(
         chat_id,
         "*2️⃣ Agora digite a mensagem do anúncio:*\n(Máximo: 1000 caracteres)"
     )
 
-    bot.register_next_step_handler(mensagem, processar_mensagem_anuncio)
-
+@despachante.estado('anuncio_mensagem')
 def processar_mensagem_anuncio(mensagem):
     """Processa mensagem do anúncio"""
     chat_id = mensagem.chat.id
 
-    if chat_id not in user_sessions or user_sessions[chat_id].get('acao') != 'criar_anuncio':
-        bot.send_message(chat_id, "❌ Sessão expirada.")
+    sessao = user_sessions.obter(chat_id)
+    if not sessao or sessao.acao != 'criar_anuncio':
+        agendador.enviar(chat_id, "❌ Sessão expirada.")
         return
 
     if len(mensagem.text) > 1000:
-        bot.send_message(chat_id, "❌ Mensagem muito longa. Máximo 1000 caracteres. Digite novamente:")
-        bot.register_next_step_handler(mensagem, processar_mensagem_anuncio)
+        agendador.enviar(chat_id, "❌ Mensagem muito longa. Máximo 1000 caracteres. Digite novamente:")
         return
 
-    user_sessions[chat_id]['mensagem'] = mensagem.text
-    user_sessions[chat_id]['etapa'] = 'tipo'
+    sessao.mensagem = mensagem.text
+    sessao.etapa = 'anuncio_tipo'
 
     markup = telebot.types.ReplyKeyboardMarkup(
         one_time_keyboard=True, 
@@ -1444,20 +4459,20 @@ def processar_mensagem_anuncio(mensagem):
     )
     markup.add('📢 Geral', '🎉 Promoção', '⚠️ Aviso', '📋 Informativo')
 
-    bot.send_message(
+    agendador.enviar(
         chat_id,
         "*3️⃣ Selecione o tipo do anúncio:*",
         reply_markup=markup
     )
 
-    bot.register_next_step_handler(mensagem, processar_tipo_anuncio)
-
+@despachante.estado('anuncio_tipo')
 def processar_tipo_anuncio(mensagem):
     """Processa tipo do anúncio"""
     chat_id = mensagem.chat.id
 
-    if chat_id not in user_sessions or user_sessions[chat_id].get('acao') != 'criar_anuncio':
-        bot.send_message(chat_id, "❌ Sessão expirada.")
+    sessao = user_sessions.obter(chat_id)
+    if not sessao or sessao.acao != 'criar_anuncio':
+        agendador.enviar(chat_id, "❌ Sessão expirada.")
         return
 
     # Determinar tipo
@@ -1471,12 +4486,12 @@ def processar_tipo_anuncio(mensagem):
     else:
         tipo = 'geral'
 
-    user_sessions[chat_id]['tipo'] = tipo
+    sessao.tipo = tipo
 
     # Criar dados do anúncio
     anuncio_data = {
-        "titulo": user_sessions[chat_id]['titulo'],
-        "mensagem": user_sessions[chat_id]['mensagem'],
+        "titulo": sessao.titulo,
+        "mensagem": sessao.mensagem,
         "tipo": tipo,
         "prioridade": 1,
         "criado_em": datetime.now(timezone.utc).isoformat(),
@@ -1497,28 +4512,28 @@ def processar_tipo_anuncio(mensagem):
 ⏰ *Criado em:* {datetime.now().strftime('%H:%M')}
 
 O anúncio será exibido para todos os usuários no próximo /menu
+Para enviar agora a todos os clientes: /anuncios (ID) e /difundir
 """
-        bot.send_message(chat_id, resposta, reply_markup=telebot.types.ReplyKeyboardRemove())
+        agendador.enviar(chat_id, resposta, reply_markup=telebot.types.ReplyKeyboardRemove())
     else:
-        bot.send_message(chat_id, "❌ Erro ao salvar anúncio. Tente novamente.")
+        agendador.enviar(chat_id, "❌ Erro ao salvar anúncio. Tente novamente.")
 
     # Limpar sessão
-    if chat_id in user_sessions:
-        del user_sessions[chat_id]
+    user_sessions.encerrar(chat_id)
 
-@bot.message_handler(commands=['anuncios'])
+@despachante.comando('anuncios')
 def comando_ver_anuncios(mensagem):
     """Ver anúncios ativos"""
     chat_id = mensagem.chat.id
 
     if not admin.is_admin(chat_id):
-        bot.send_message(chat_id, "❌ *Acesso negado!*")
+        agendador.enviar(chat_id, "❌ *Acesso negado!*")
         return
 
     anuncios = db.buscar_anuncios_ativos()
 
     if not anuncios:
-        bot.send_message(chat_id, "📭 *Nenhum anúncio ativo no momento.*")
+        agendador.enviar(chat_id, "📭 *Nenhum anúncio ativo no momento.*")
         return
 
     resposta = "📢 *ANÚNCIOS ATIVOS*\n\n"
@@ -1541,21 +4556,21 @@ def comando_ver_anuncios(mensagem):
         resposta += "━━━━━━━━━━━━━━\n"
 
     resposta += f"\n*Total:* {len(anuncios)} anúncio(s) ativo(s)"
-    bot.send_message(chat_id, resposta)
+    agendador.enviar(chat_id, resposta)
 
-@bot.message_handler(commands=['remover_anuncio'])
+@despachante.comando('remover_anuncio')
 def comando_remover_anuncio(mensagem):
     """Remover um anúncio"""
     chat_id = mensagem.chat.id
 
     if not admin.is_admin(chat_id):
-        bot.send_message(chat_id, "❌ *Acesso negado!*")
+        agendador.enviar(chat_id, "❌ *Acesso negado!*")
         return
 
     anuncios = db.buscar_anuncios_ativos()
 
     if not anuncios:
-        bot.send_message(chat_id, "📭 Nenhum anúncio para remover.")
+        agendador.enviar(chat_id, "📭 Nenhum anúncio para remover.")
         return
 
     # Mostrar lista de anúncios
@@ -1565,72 +4580,121 @@ def comando_remover_anuncio(mensagem):
     for anuncio in anuncios[:10]:  # Limitar a 10
         resposta += f"`{anuncio['id']}` - {anuncio['titulo'][:30]}...\n"
 
-    bot.send_message(chat_id, resposta)
-    bot.register_next_step_handler(mensagem, processar_remocao_anuncio)
+    agendador.enviar(chat_id, resposta)
+    user_sessions.iniciar(chat_id, acao='remover_anuncio', etapa='remover_anuncio_id')
 
+@despachante.estado('remover_anuncio_id')
 def processar_remocao_anuncio(mensagem):
     """Processa remoção de anúncio"""
     chat_id = mensagem.chat.id
     anuncio_id = mensagem.text.strip()
+    user_sessions.encerrar(chat_id)
 
     try:
-        # Tentar desativar no banco
-        if db.sqlite_conn:
-            cursor = db.sqlite_conn.cursor()
-            cursor.execute("UPDATE anuncios SET ativo = 0 WHERE id = ?", (anuncio_id,))
-            db.sqlite_conn.commit()
-
-            if cursor.rowcount > 0:
-                bot.send_message(chat_id, f"✅ Anúncio ID `{anuncio_id}` removido com sucesso!")
-            else:
-                bot.send_message(chat_id, f"❌ Anúncio ID `{anuncio_id}` não encontrado.")
-
-        # Também tentar no Supabase se estiver ativo
-        if db.supabase:
-            try:
-                db.supabase.table("anuncios").update({"ativo": False}).eq("id", anuncio_id).execute()
-            except:
-                pass
+        if db.desativar_anuncio(anuncio_id):
+            agendador.enviar(chat_id, f"✅ Anúncio ID `{anuncio_id}` removido com sucesso!")
+        else:
+            agendador.enviar(chat_id, f"❌ Anúncio ID `{anuncio_id}` não encontrado.")
 
     except Exception as e:
-        bot.send_message(chat_id, f"❌ Erro ao remover anúncio: {e}")
+        agendador.enviar(chat_id, f"❌ Erro ao remover anúncio: {e}")
+
+@despachante.comando('difundir')
+def comando_difundir(mensagem):
+    """Enviar um anúncio ativo a todos os clientes"""
+    chat_id = mensagem.chat.id
+
+    if not admin.is_admin(chat_id):
+        agendador.enviar(chat_id, "❌ *Acesso negado!*")
+        return
+
+    partes = mensagem.text.split()
+    if len(partes) < 2:
+        agendador.enviar(chat_id, "📣 Uso: `/difundir <id do anúncio>`\n\nVeja os IDs em /anuncios")
+        return
+
+    anuncio_id = partes[1]
+    anuncio = next((a for a in db.buscar_anuncios_ativos() if str(a['id']) == anuncio_id), None)
+    if not anuncio:
+        agendador.enviar(chat_id, f"❌ Anúncio ativo `{anuncio_id}` não encontrado.")
+        return
+
+    if difusor.em_andamento(anuncio_id):
+        agendador.enviar(chat_id, f"⚠️ O anúncio `{anuncio_id}` já está sendo difundido. Acompanhe em /difusao")
+        return
+
+    difusao_id = difusor.iniciar(anuncio, chat_id)
+    agendador.enviar(
+        chat_id,
+        f"📣 *Difusão #{difusao_id} iniciada!*\n\n"
+        f"📢 {anuncio['titulo']}\n"
+        f"👥 Clientes: {difusor.buscar(difusao_id)['total']}\n\n"
+        f"Acompanhe o progresso em /difusao"
+    )
+
+@despachante.comando('difusao')
+def comando_difusao(mensagem):
+    """Progresso das difusões (ou /difusao cancelar <id>)"""
+    chat_id = mensagem.chat.id
 
-@bot.message_handler(commands=['enviar_mensagem'])
+    if not admin.is_admin(chat_id):
+        agendador.enviar(chat_id, "❌ *Acesso negado!*")
+        return
+
+    partes = mensagem.text.split()
+    if len(partes) >= 3 and partes[1].lower() == 'cancelar':
+        if partes[2].isdigit() and difusor.cancelar(int(partes[2])):
+            agendador.enviar(chat_id, f"🛑 Difusão #{partes[2]} cancelada.")
+        else:
+            agendador.enviar(chat_id, f"❌ Difusão `{partes[2]}` não está em andamento.")
+        return
+
+    difusoes = difusor.listar()
+    if not difusoes:
+        agendador.enviar(chat_id, "📭 Nenhuma difusão realizada ainda.\n\nUse `/difundir <id do anúncio>`")
+        return
+
+    resposta = "📣 *DIFUSÕES DE ANÚNCIOS*\n\n"
+    resposta += "\n\n".join(difusor.formatar(difusao) for difusao in difusoes)
+    resposta += "\n\nPara cancelar: `/difusao cancelar <id>`"
+    agendador.enviar(chat_id, resposta)
+
+@despachante.comando('enviar_mensagem')
 def comando_enviar_mensagem(mensagem):
     """Enviar mensagem para cliente"""
     chat_id = mensagem.chat.id
 
     if not admin.is_admin(chat_id):
-        bot.send_message(chat_id, "❌ *Acesso negado!*")
+        agendador.enviar(chat_id, "❌ *Acesso negado!*")
         return
 
-    bot.send_message(
+    agendador.enviar(
         chat_id,
         "📨 *ENVIAR MENSAGEM PARA CLIENTE*\n\nDigite o *código do pedido*:"
     )
 
-    bot.register_next_step_handler(mensagem, processar_mensagem_cliente)
+    user_sessions.iniciar(chat_id, acao='enviar_mensagem', etapa='mensagem_codigo')
 
+@despachante.estado('mensagem_codigo')
 def processar_mensagem_cliente(mensagem):
     """Processa envio de mensagem"""
     chat_id = mensagem.chat.id
     codigo = mensagem.text.strip().upper()
 
     # Buscar pedido
-    pedidos = db.buscar_pedidos(filtros={"codigo_pedido": codigo})
+    pedidos = db.buscar_pedidos(filtros={"codigo_pedido": codigo}, consulta="pedido_codigo")
 
     if not pedidos:
-        bot.send_message(chat_id, f"❌ Pedido `{codigo}` não encontrado.")
+        agendador.enviar(chat_id, f"❌ Pedido `{codigo}` não encontrado.")
+        user_sessions.encerrar(chat_id)
         return
 
     pedido = pedidos[0]
-    user_sessions[chat_id] = {
-        'acao': 'enviar_mensagem',
-        'codigo': codigo,
-        'user_id': pedido['user_id']
-    }
+    user_sessions.iniciar(
+        chat_id, acao='enviar_mensagem', etapa='mensagem_texto', codigo=codigo, user_id=pedido['user_id']
+    )
 
-    bot.send_message(
+    agendador.enviar(
         chat_id,
         f"👤 *Cliente:* {pedido['nome']}\n"
         f"📋 *Pedido:* {pedido['pizza']}\n"
@@ -1638,52 +4702,53 @@ def processar_mensagem_cliente(mensagem):
         f"*Agora digite a mensagem:*"
     )
 
-    bot.register_next_step_handler(mensagem, enviar_mensagem_final)
-
+@despachante.estado('mensagem_texto')
 def enviar_mensagem_final(mensagem):
     """Envia a mensagem final para o cliente"""
     chat_id = mensagem.chat.id
 
-    if chat_id not in user_sessions:
-        bot.send_message(chat_id, "❌ Sessão expirada.")
+    sessao = user_sessions.obter(chat_id)
+    if not sessao:
+        agendador.enviar(chat_id, "❌ Sessão expirada.")
         return
 
     texto_mensagem = mensagem.text
-    user_id = user_sessions[chat_id]['user_id']
-    codigo = user_sessions[chat_id]['codigo']
-
-    try:
-        # Enviar para o cliente
-        bot.send_message(
-            user_id,
-            f"📨 *MENSAGEM DA PIZZARIA ROMEO*\n\n"
-            f"{texto_mensagem}\n\n"
-            f"📋 *Pedido:* {codigo}\n"
-            f"📞 *Dúvidas:* (11) 99999-9999"
-        )
-
-        bot.send_message(
-            chat_id, 
-            f"✅ Mensagem enviada para o cliente do pedido `{codigo}`!"
-        )
+    user_id = sessao.user_id
+    codigo = sessao.codigo
+
+    # Enviar para o cliente; o admin recebe a confirmação quando o envio terminar
+    envio = agendador.enviar(
+        user_id,
+        f"📨 *MENSAGEM DA PIZZARIA ROMEO*\n\n"
+        f"{texto_mensagem}\n\n"
+        f"📋 *Pedido:* {codigo}\n"
+        f"📞 *Dúvidas:* {config.telefone_contato}"
+    )
 
-        logger.log("info", f"Mensagem enviada para cliente {user_id} (pedido {codigo})")
+    def confirmar_envio(futuro):
+        erro = futuro.exception()
+        if erro:
+            agendador.enviar(chat_id, f"❌ Erro ao enviar mensagem: {erro}")
+            logger.log("error", f"Erro ao enviar mensagem: {erro}")
+        else:
+            agendador.enviar(
+                chat_id, 
+                f"✅ Mensagem enviada para o cliente do pedido `{codigo}`!"
+            )
+            logger.log("info", f"Mensagem enviada para cliente {user_id} (pedido {codigo})")
 
-    except Exception as e:
-        bot.send_message(chat_id, f"❌ Erro ao enviar mensagem: {e}")
-        logger.log("error", f"Erro ao enviar mensagem: {e}")
+    envio.add_done_callback(confirmar_envio)
 
     # Limpar sessão
-    if chat_id in user_sessions:
-        del user_sessions[chat_id]
+    user_sessions.encerrar(chat_id)
 
-@bot.message_handler(commands=['relatorio'])
+@despachante.comando('relatorio')
 def comando_relatorio(mensagem):
     """Relatório completo"""
     chat_id = mensagem.chat.id
 
     if not admin.is_admin(chat_id):
-        bot.send_message(chat_id, "❌ *Acesso negado!*")
+        agendador.enviar(chat_id, "❌ *Acesso negado!*")
         return
 
     estatisticas = db.get_estatisticas()
@@ -1725,15 +4790,15 @@ def comando_relatorio(mensagem):
 • Data do relatório: *{datetime.now().strftime('%d/%m/%Y %H:%M')}*
 """
 
-    bot.send_message(chat_id, relatorio)
+    agendador.enviar(chat_id, relatorio)
 
-@bot.message_handler(commands=['estatisticas'])
+@despachante.comando('estatisticas')
 def comando_estatisticas(mensagem):
     """Estatísticas rápidas"""
     chat_id = mensagem.chat.id
 
     if not admin.is_admin(chat_id):
-        bot.send_message(chat_id, "❌ *Acesso negado!*")
+        agendador.enviar(chat_id, "❌ *Acesso negado!*")
         return
 
     estatisticas = db.get_estatisticas()
@@ -1763,19 +4828,78 @@ def comando_estatisticas(mensagem):
 • Atualizado: {datetime.now().strftime('%H:%M:%S')}
 """
 
-    bot.send_message(chat_id, resposta)
+    agendador.enviar(chat_id, resposta)
+
+@despachante.comando('reconstruir_estatisticas')
+def comando_reconstruir_estatisticas(mensagem):
+    """Recalcula as estatísticas materializadas a partir dos pedidos"""
+    chat_id = mensagem.chat.id
+
+    if not admin.is_admin(chat_id):
+        agendador.enviar(chat_id, "❌ *Acesso negado!*")
+        return
+
+    if not db.sqlite:
+        agendador.enviar(chat_id, "❌ SQLite indisponível.")
+        return
+
+    try:
+        agendador.enviar(chat_id, "🔄 *Reconstruindo estatísticas...*")
+        inicio = time.time()
+        total = db.reconstruir_estatisticas()
+        agendador.enviar(
+            chat_id,
+            f"✅ *Estatísticas reconstruídas!*\n\n"
+            f"📦 Pedidos processados: {total}\n"
+            f"⏱️ Tempo: {time.time() - inicio:.2f}s"
+        )
+    except Exception as e:
+        agendador.enviar(chat_id, f"❌ Erro ao reconstruir estatísticas: {e}")
+        logger.log("error", f"Erro ao reconstruir estatísticas: {e}")
+
+@despachante.comando('reconciliar')
+def comando_reconciliar(mensagem):
+    """Executa uma rodada de reconciliação entre SQLite e Supabase"""
+    chat_id = mensagem.chat.id
+
+    if not admin.is_admin(chat_id):
+        agendador.enviar(chat_id, "❌ *Acesso negado!*")
+        return
+
+    if not (db.sqlite and db.supabase_disponivel):
+        agendador.enviar(chat_id, "❌ Reconciliação requer SQLite e Supabase disponíveis.")
+        return
+
+    try:
+        agendador.enviar(chat_id, "🔁 *Reconciliando pedidos...*")
+        resultado = db.reconciliador.executar()
+        if resultado is None:
+            agendador.enviar(chat_id, "⏳ Já existe uma reconciliação em andamento.")
+            return
+
+        agendador.enviar(
+            chat_id,
+            f"✅ *Reconciliação concluída!*\n\n"
+            f"📤 Enviados ao Supabase: {resultado['enviados']}\n"
+            f"📥 Recebidos no SQLite: {resultado['recebidos']}\n"
+            f"🔎 Verificados: {resultado['verificados']}\n"
+            f"⏱️ Tempo: {resultado['segundos']:.2f}s ({resultado['linhas_por_segundo']:.0f} linhas/s)"
+        )
+    except Exception as e:
+        agendador.enviar(chat_id, f"❌ Erro na reconciliação: {e}")
+        logger.log("error", f"Erro na reconciliação: {e}")
 
-@bot.message_handler(commands=['backup'])
+@despachante.comando('backup')
 def comando_backup(mensagem):
     """Criar backup dos dados"""
     chat_id = mensagem.chat.id
 
     if not admin.is_admin(chat_id):
-        bot.send_message(chat_id, "❌ *Acesso negado!*")
+        agendador.enviar(chat_id, "❌ *Acesso negado!*")
         return
 
     try:
-        bot.send_message(chat_id, "💾 *Gerando backup...*")
+        agendador.enviar(chat_id, "💾 *Gerando backup...*")
 
         # Coletar dados
         pedidos = db.buscar_pedidos(limite=1000)
@@ -1799,9 +4923,9 @@ def comando_backup(mensagem):
         with open(filename, 'w', encoding='utf-8') as f:
             json.dump(backup_data, f, ensure_ascii=False, indent=2)
 
-        # Enviar arquivo
+        # Enviar arquivo (espera o envio: o arquivo é fechado e removido logo depois)
         with open(filename, 'rb') as f:
-            bot.send_document(
+            agendador.documento(
                 chat_id,
                 f,
                 caption=f"📦 *BACKUP COMPLETO*\n\n"
@@ -1809,7 +4933,7 @@ def comando_backup(mensagem):
                        f"📢 Anúncios: {len(anuncios)}\n"
                        f"📅 Data: {datetime.now().strftime('%d/%m/%Y %H:%M')}\n"
                        f"💾 Tamanho: {os.path.getsize(filename) / 1024:.1f} KB"
-            )
+            ).result()
 
         # Limpar arquivo
         os.remove(filename)
@@ -1817,27 +4941,55 @@ def comando_backup(mensagem):
         logger.log("success", f"Backup criado por {chat_id}")
 
     except Exception as e:
-        bot.send_message(chat_id, f"❌ Erro ao criar backup: {e}")
+        agendador.enviar(chat_id, f"❌ Erro ao criar backup: {e}")
         logger.log("error", f"Erro no backup: {e}")
 
-@bot.message_handler(commands=['config'])
+@despachante.comando('config')
 def comando_config(mensagem):
     """Configurações do sistema"""
     chat_id = mensagem.chat.id
 
     if not admin.is_admin(chat_id):
-        bot.send_message(chat_id, "❌ *Acesso negado!*")
+        agendador.enviar(chat_id, "❌ *Acesso negado!*")
+        return
+
+    partes = mensagem.text.split(maxsplit=3)
+
+    # /config set <chave> <valor>
+    if len(partes) > 1 and partes[1].lower() == 'set':
+        if len(partes) < 4:
+            agendador.enviar(chat_id, "❌ Uso: `/config set <chave> <valor>`")
+            return
+
+        chave, valor = partes[2].lower(), partes[3].strip()
+        try:
+            convertido = config.definir(chave, valor)
+            agendador.enviar(chat_id, f"✅ *{ConfiguracaoSistema.CHAVES[chave][2]}* atualizado para: `{convertido}`")
+            logger.log("info", f"Configuração {chave} alterada por {chat_id}")
+        except KeyError:
+            agendador.enviar(
+                chat_id,
+                "❌ Chave desconhecida. Disponíveis:\n" + "\n".join(f"• `{c}`" for c in ConfiguracaoSistema.CHAVES)
+            )
+        except ValueError:
+            agendador.enviar(chat_id, f"❌ Valor inválido para `{chave}`: {valor}")
+        except Exception as e:
+            agendador.enviar(chat_id, f"❌ Erro ao salvar configuração: {e}")
         return
 
     estatisticas = db.get_estatisticas()
+    loja_text = "\n".join(
+        f"• {descricao}: `{config.obter(chave)}`"
+        for chave, (_, _, descricao) in ConfiguracaoSistema.CHAVES.items()
+    )
 
     config_text = f"""
 *⚙️ CONFIGURAÇÕES DO SISTEMA*
 
 *🔧 BANCO DE DADOS:*
 • Modo atual: *{db.get_modo().upper()}*
-• Supabase: {'✅ Conectado' if db.supabase else '❌ Offline'}
-• SQLite: {'✅ Ativo' if db.sqlite_conn else '❌ Inativo'}
+• Supabase: {'✅ Conectado' if db.supabase_disponivel else '❌ Offline'}
+• SQLite: {'✅ Ativo' if db.sqlite else '❌ Inativo'}
 
 *📊 ESTATÍSTICAS:*
 • Pedidos salvos: *{estatisticas['total_pedidos']}*
@@ -1849,10 +5001,13 @@ def comando_config(mensagem):
 • Token Telegram: {'✅ Configurado' if CHAVE_API else '❌ Não configurado'}
 • Supabase URL: {'✅ Configurada' if SUPABASE_URL else '❌ Não configurada'}
 
+*🏪 LOJA:* (altere com `/config set <chave> <valor>`)
+{loja_text}
+
 *📈 STATUS:*
 • Bot: ✅ Online
 • Web Server: ✅ Ativo
-• Logs: ✅ Ativos ({len(json.load(open(logger.log_file, 'r')) if os.path.exists(logger.log_file) else 0)} registros)
+• Logs: ✅ Ativos ({logger.total_registros} registros)
 
 *🔄 COMANDOS DISPONÍVEIS:*
 /status_sistema - Status detalhado
@@ -1860,56 +5015,108 @@ def comando_config(mensagem):
 /reiniciar - Reiniciar conexões
 """
 
-    bot.send_message(chat_id, config_text)
+    agendador.enviar(chat_id, config_text)
 
-@bot.message_handler(commands=['logs'])
+@despachante.comando('logs')
 def comando_logs(mensagem):
     """Ver logs do sistema"""
     chat_id = mensagem.chat.id
 
     if not admin.is_admin(chat_id):
-        bot.send_message(chat_id, "❌ *Acesso negado!*")
+        agendador.enviar(chat_id, "❌ *Acesso negado!*")
         return
 
-    try:
-        if os.path.exists(logger.log_file):
-            with open(logger.log_file, 'r', encoding='utf-8') as f:
-                logs = json.load(f)
+    # Argumentos opcionais: /logs [nivel] [quantidade]
+    nivel = None
+    quantidade = 15
+    for argumento in mensagem.text.split()[1:]:
+        if argumento.isdigit():
+            quantidade = min(int(argumento), 50)
+        else:
+            nivel = argumento.lower()
 
-            # Últimos 15 logs
-            ultimos_logs = logs[-15:]
+    try:
+        ultimos_logs = logger.recentes(quantidade, nivel)
 
-            resposta = "📝 *ÚLTIMOS LOGS DO SISTEMA*\n\n"
+        if ultimos_logs:
+            titulo = f"ÚLTIMOS LOGS [{nivel.upper()}]" if nivel else "ÚLTIMOS LOGS DO SISTEMA"
+            resposta = f"📝 *{titulo}*\n\n"
 
             for log in ultimos_logs:
-                nivel = log.get('nivel', 'info')
+                nivel_log = log.get('nivel', 'info')
                 emoji = {
                     'info': 'ℹ️',
                     'success': '✅',
                     'warning': '⚠️',
                     'error': '❌'
-                }.get(nivel, '📝')
+                }.get(nivel_log, '📝')
 
                 hora = datetime.fromisoformat(log['timestamp']).strftime('%H:%M:%S')
-                mensagem = log['mensagem'][:60] + '...' if len(log['mensagem']) > 60 else log['mensagem']
-                resposta += f"{emoji} *[{hora}]* {mensagem}\n"
+                texto = log['mensagem'][:60] + '...' if len(log['mensagem']) > 60 else log['mensagem']
+                resposta += f"{emoji} *[{hora}]* {texto}\n"
 
-            resposta += f"\n*Total de logs:* {len(logs)}"
+            resposta += f"\n*Total de logs:* {logger.total_registros}"
+            resposta += "\n_Uso: /logs [nivel] [quantidade]_"
 
-            bot.send_message(chat_id, resposta)
+            agendador.enviar(chat_id, resposta)
         else:
-            bot.send_message(chat_id, "📭 Nenhum log encontrado.")
+            agendador.enviar(chat_id, "📭 Nenhum log encontrado.")
 
     except Exception as e:
-        bot.send_message(chat_id, f"❌ Erro ao ler logs: {e}")
+        agendador.enviar(chat_id, f"❌ Erro ao ler logs: {e}")
 
-@bot.message_handler(commands=['status_sistema'])
+@despachante.comando('buscar_logs')
+def comando_buscar_logs(mensagem):
+    """Buscar logs por nível, chat e período (ex: /buscar_logs error 12345 6)"""
+    chat_id = mensagem.chat.id
+
+    if not admin.is_admin(chat_id):
+        agendador.enviar(chat_id, "❌ *Acesso negado!*")
+        return
+
+    argumentos = mensagem.text.split()[1:]
+    if not argumentos:
+        agendador.enviar(
+            chat_id,
+            "🔎 *BUSCAR LOGS*\n\n"
+            "Uso: `/buscar_logs <nivel> [chat_id] [horas]`\n"
+            "Exemplo: `/buscar_logs error 123456789 6`"
+        )
+        return
+
+    nivel = argumentos[0].lower()
+    chat_filtro = argumentos[1] if len(argumentos) > 1 else None
+    try:
+        horas = float(argumentos[2]) if len(argumentos) > 2 else 24
+    except ValueError:
+        horas = 24
+
+    try:
+        desde = datetime.now(timezone.utc) - timedelta(hours=horas)
+        registros = logger.consultar(nivel=nivel, chat_id=chat_filtro, desde=desde, limite=20)
+
+        if not registros:
+            agendador.enviar(chat_id, "📭 Nenhum log encontrado para esse filtro.")
+            return
+
+        resposta = f"🔎 *LOGS [{nivel.upper()}] - últimas {horas:g}h*\n\n"
+        for log in registros:
+            hora = datetime.fromisoformat(log['timestamp']).strftime('%d/%m %H:%M:%S')
+            texto = log['mensagem'][:60] + '...' if len(log['mensagem']) > 60 else log['mensagem']
+            resposta += f"*[{hora}]* {texto}\n"
+
+        agendador.enviar(chat_id, resposta)
+
+    except Exception as e:
+        agendador.enviar(chat_id, f"❌ Erro ao buscar logs: {e}")
+
+@despachante.comando('status_sistema')
 def comando_status_sistema(mensagem):
     """Status detalhado do sistema"""
     chat_id = mensagem.chat.id
 
     if not admin.is_admin(chat_id):
-        bot.send_message(chat_id, "❌ *Acesso negado!*")
+        agendador.enviar(chat_id, "❌ *Acesso negado!*")
         return
 
     estatisticas = db.get_estatisticas()
@@ -1919,16 +5126,30 @@ def comando_status_sistema(mensagem):
 
 *🤖 BOT TELEGRAM:*
 • Status: ✅ Online
-• Modo: Infinity Polling
+• Modo: {'Webhook' if BOT_MODO == 'webhook' else 'Infinity Polling'}
 • Parse Mode: Markdown V2
-• Usuários ativos: {len(user_sessions)}
+• Usuários ativos: {len(user_sessions)} (expiradas: {user_sessions.expiradas} | despejadas: {user_sessions.despejadas} | retomadas: {user_sessions.restauradas})
+• Mensagens despachadas: {despachante.despachadas} ({despachante.total_rotas} rotas)
+• Processamento: {pool_updates.resumo()}
+• Envios: {agendador.resumo()}
+• Avisos ao admin: {notificador_admin.resumo()}
 
 *💾 BANCO DE DADOS:*
 • Modo principal: *{db.get_modo().upper()}*
-• Supabase: {'✅ Conectado' if db.supabase else '❌ Offline'}
-• SQLite: {'✅ Pronto' if db.sqlite_conn else '❌ Erro'}
+• Supabase: {'✅ Conectado' if db.supabase_disponivel else '❌ Offline'}
+• Disjuntor Supabase: {db.disjuntor.resumo()}
+• SQLite: {'✅ Pronto' if db.sqlite else '❌ Erro'}
 • Pedidos salvos: *{estatisticas['total_pedidos']}*
 • Anúncios ativos: *{estatisticas['anuncios_ativos']}*
+• Outbox pendente: {db.outbox_pendentes()} | Replicados: {db.replicador.replicados} | Descartados: {db.replicador.descartados}
+• Reconciliação: {db.reconciliador.resumo()}
+• Cache de anúncios: {db.cache_anuncios.acertos} acertos / {db.cache_anuncios.falhas} consultas
+
+*⏱️ LEITURAS (política/latência):*
+{chr(10).join('• ' + linha for linha in db.roteador.resumo()) or '• Nenhuma leitura registrada'}
+
+*🔌 CONEXÕES HTTP:*
+{chr(10).join('• ' + linha for linha in transporte.resumo())}
 
 *🌐 SERVIDOR WEB:*
 • Status: ✅ Ativo (Flask)
@@ -1941,6 +5162,11 @@ def comando_status_sistema(mensagem):
 • Valor total: R$ {estatisticas['valor_total']:.2f}
 • Status pendentes: {estatisticas['por_status'].get('pendente', 0)}
 
+*📝 LOGS:*
+• Registros: *{logger.total_registros}*
+• Erros: {logger.contadores.get('error', 0)} | Avisos: {logger.contadores.get('warning', 0)}
+• Descartados (fila cheia): {logger.descartados}
+
 *⚙️ CONFIGURAÇÕES:*
 • Dono ID: `{DONO_ID}`
 • Ambiente: {'Produção' if os.getenv('ENV') == 'production' else 'Desenvolvimento'}
@@ -1961,42 +5187,52 @@ def comando_status_sistema(mensagem):
 4. Verificar anúncios ativos: /anuncios
 """
 
-    bot.send_message(chat_id, status_text)
+    agendador.enviar(chat_id, status_text)
 
-@bot.message_handler(commands=['reiniciar'])
+@despachante.comando('reiniciar')
 def comando_reiniciar(mensagem):
     """Reiniciar conexões do sistema"""
     chat_id = mensagem.chat.id
 
     if not admin.is_admin(chat_id):
-        bot.send_message(chat_id, "❌ *Acesso negado!*")
+        agendador.enviar(chat_id, "❌ *Acesso negado!*")
         return
 
-    bot.send_message(chat_id, "🔄 *Reiniciando conexões do sistema...*")
+    agendador.enviar(chat_id, "🔄 *Reiniciando conexões do sistema...*")
 
     # Reinicializar banco de dados
     global db
+    user_sessions.persistir()
+    db.fechar()
     db = DatabaseManager()
 
-    bot.send_message(
+    agendador.enviar(
         chat_id,
         f"✅ *Conexões reiniciadas com sucesso!*\n\n"
         f"📊 Novo status:\n"
         f"• Banco: {db.get_modo().upper()}\n"
-        f"• Supabase: {'✅ Conectado' if db.supabase else '❌ Offline'}\n"
-        f"• SQLite: {'✅ Ativo' if db.sqlite_conn else '❌ Inativo'}"
+        f"• Supabase: {'✅ Conectado' if db.supabase_disponivel else '❌ Offline'}\n"
+        f"• SQLite: {'✅ Ativo' if db.sqlite else '❌ Inativo'}"
     )
 
     logger.log("success", f"Sistema reiniciado por {chat_id}")
 
 # ==================== COMANDOS PÚBLICOS ADICIONAIS ====================
 
-@bot.message_handler(commands=['ajuda', 'help'])
+@despachante.comando('ajuda', 'help')
 def comando_ajuda(mensagem):
     """Ajuda e contato"""
     chat_id = mensagem.chat.id
+    entrega_gratis = (
+        f"Grátis a partir de R$ {config.valor_entrega_gratis:.2f}".replace('.', ',')
+        if config.valor_entrega_gratis > 0 else "Sem entrega grátis no momento"
+    )
+    pedido_minimo = (
+        f"• Pedido mínimo: R$ {config.valor_minimo_entrega:.2f}\n".replace('.', ',')
+        if config.valor_minimo_entrega > 0 else ""
+    )
 
-    ajuda_text = """
+    ajuda_text = f"""
 *📞 AJUDA E CONTATO*
 
 *🤔 COMO FAÇO UM PEDIDO?*
@@ -2007,7 +5243,7 @@ def comando_ajuda(mensagem):
 5. Aguarde a confirmação!
 
 *⏰ HORÁRIO DE FUNCIONAMENTO:*
-• Segunda a Domingo: 18:00 - 23:00
+• Segunda a Domingo: {config.horario_funcionamento}
 • Feriados: Consulte disponibilidade
 
 *📍 ÁREA DE ENTREGA:*
@@ -2022,14 +5258,14 @@ def comando_ajuda(mensagem):
 • 📱 PIX - Chave: pizzaria.romeo@email.com
 
 *📱 CONTATO:*
-• Telefone/WhatsApp: (11) 99999-9999
+• Telefone/WhatsApp: {config.telefone_contato}
 • Instagram: @pizzariaromeo
 • Facebook: /PizzariaRomeoOficial
 
 *🚚 INFORMAÇÕES DE ENTREGA:*
-• Taxa fixa: R$ 5,00
-• Grátis para pedidos acima de R$ 60,00
-• Tempo médio: 30-45 minutos
+• Taxa fixa: R$ {f"{config.taxa_entrega:.2f}".replace('.', ',')}
+{pedido_minimo}• {entrega_gratis}
+• Tempo médio: {config.previsao_entrega}
 • Entregador identificado
 
 *❓ PROBLEMAS COM PEDIDO?*
@@ -2049,18 +5285,19 @@ def comando_ajuda(mensagem):
 /promocoes - Ver promoções ativas
 """
 
-    bot.send_message(chat_id, ajuda_text)
+    agendador.enviar(chat_id, ajuda_text)
 
-@bot.message_handler(commands=['status'])
+@despachante.comando('status')
 def comando_status_pedido_usuario(mensagem):
     """Verificar status do pedido do usuário"""
     chat_id = mensagem.chat.id
 
-    # Buscar últimos pedidos do usuário
-    pedidos = db.buscar_pedidos(filtros={"user_id": str(chat_id)})
+    # Totais mantidos na tabela usuarios + só os 3 pedidos exibidos
+    usuario = db.buscar_usuario(str(chat_id))
+    pedidos = db.buscar_pedidos(filtros={"user_id": str(chat_id)}, limite=3, consulta="pedidos_usuario")
 
     if not pedidos:
-        bot.send_message(
+        agendador.enviar(
             chat_id,
             "📭 *Você ainda não fez nenhum pedido.*\n\n"
             "Use /menu para ver o cardápio e fazer seu primeiro pedido! 🍕\n\n"
@@ -2071,7 +5308,7 @@ def comando_status_pedido_usuario(mensagem):
     # Mostrar últimos 3 pedidos
     resposta = "📋 *SEUS ÚLTIMOS PEDIDOS*\n\n"
 
-    for i, pedido in enumerate(pedidos[:3], 1):
+    for i, pedido in enumerate(pedidos, 1):
         status_info = PizzaSabor.STATUS.get(pedido.get('status', 'pendente'), {"nome": "Pendente", "emoji": "🟡"})
 
         resposta += f"{status_info['emoji']} *Pedido #{i}*\n"
@@ -2089,16 +5326,20 @@ def comando_status_pedido_usuario(mensagem):
 
         resposta += "━━━━━━━━━━━━━━\n"
 
-    if len(pedidos) > 3:
-        resposta += f"\n*... e mais {len(pedidos) - 3} pedidos anteriores*"
+    total_pedidos = usuario['total_pedidos'] if usuario else len(pedidos)
+    if total_pedidos > len(pedidos):
+        resposta += f"\n*... e mais {total_pedidos - len(pedidos)} pedidos anteriores*"
 
-    valor_total = sum(p.get('valor', 0) for p in pedidos)
+    if usuario:
+        valor_total = usuario['total_gasto']
+    else:
+        valor_total = sum(p.get('valor', 0) for p in pedidos if p.get('status') != 'cancelado')
     resposta += f"\n💰 *Total gasto conosco:* R$ {valor_total:.2f}"
-    resposta += f"\n📞 *Dúvidas?* (11) 99999-9999"
+    resposta += f"\n📞 *Dúvidas?* {config.telefone_contato}"
 
-    bot.send_message(chat_id, resposta)
+    agendador.enviar(chat_id, resposta)
 
-@bot.message_handler(commands=['promocoes'])
+@despachante.comando('promocoes')
 def comando_promocoes(mensagem):
     """Mostra promoções ativas"""
     chat_id = mensagem.chat.id
@@ -2141,17 +5382,18 @@ def comando_promocoes(mensagem):
 
         promocoes_text += "━━━━━━━━━━━━━━\n"
         promocoes_text += "*PROMOÇÕES PERMANENTES:*\n"
-        promocoes_text += "• Entrega grátis acima de R$ 60,00\n"
+        if config.valor_entrega_gratis > 0:
+            promocoes_text += f"• Entrega grátis a partir de R$ {config.valor_entrega_gratis:.2f}\n".replace('.', ',')
         promocoes_text += "• Programa cliente frequente\n"
         promocoes_text += "• Desconto no PIX: 5%\n"
 
-    promocoes_text += "\n📞 *Mais informações:* (11) 99999-9999"
+    promocoes_text += f"\n📞 *Mais informações:* {config.telefone_contato}"
 
-    bot.send_message(chat_id, promocoes_text)
+    agendador.enviar(chat_id, promocoes_text)
 
 # ==================== HANDLER PARA MENSAGENS NÃO RECONHECIDAS ====================
 
-@bot.message_handler(func=lambda mensagem: True)
+@despachante.padrao
 def mensagem_nao_reconhecida(mensagem):
     """Responde a mensagens não reconhecidas"""
     chat_id = mensagem.chat.id
@@ -2184,8 +5426,13 @@ Não entendi sua mensagem. Aqui estão os comandos disponíveis:
 *Ou responda diretamente ao que precisa!* 😊
 """
 
-        bot.send_message(chat_id, resposta)
-        logger.log("info", f"Mensagem não reconhecida de {chat_id}: {mensagem.text[:50]}")
+        agendador.enviar(chat_id, resposta)
+        logger.log(
+            "info",
+            f"Mensagem não reconhecida de {chat_id}: {mensagem.text[:50]}",
+            chat_id,
+            chave="mensagem_nao_reconhecida"
+        )
 
 # ==================== INICIALIZAÇÃO DO SISTEMA ====================
 
@@ -2213,8 +5460,8 @@ def mostrar_status_inicial():
 
     print(f"\n🔗 CONEXÕES:")
     print(f"   • Modo banco: {db.get_modo().upper()}")
-    print(f"   • Supabase: {'✅ CONECTADO' if db.supabase else '❌ OFFLINE'}")
-    print(f"   • SQLite: {'✅ PRONTO' if db.sqlite_conn else '❌ ERRO'}")
+    print(f"   • Supabase: {'✅ CONECTADO' if db.supabase_disponivel else '❌ OFFLINE'}")
+    print(f"   • SQLite: {'✅ PRONTO' if db.sqlite else '❌ ERRO'}")
 
     print(f"\n📊 DADOS INICIAIS:")
     pedidos = db.buscar_pedidos(limite=5)
@@ -2225,11 +5472,25 @@ def mostrar_status_inicial():
     print(f"\n🌐 SERVIDOR WEB:")
     print(f"   • Status: ✅ INICIANDO")
     print(f"   • Porta: 8080")
+    print(f"   • Updates: {'WEBHOOK' if BOT_MODO == 'webhook' else 'POLLING'}")
 
     print("\n" + "="*60)
     print("🤖 INICIANDO BOT TELEGRAM...")
     print("="*60 + "\n")
 
+def configurar_webhook():
+    """Registra o webhook no Telegram; sem WEBHOOK_URL a rota só recebe POSTs locais"""
+    if not WEBHOOK_URL:
+        logger.log("warning", "⚠️ WEBHOOK_URL não definida: webhook não registrado no Telegram (somente POSTs locais)")
+        return
+
+    bot.set_webhook(
+        url=f"{WEBHOOK_URL}/webhook/{WEBHOOK_SEGREDO}",
+        secret_token=WEBHOOK_SEGREDO,
+        max_connections=pool_updates.workers
+    )
+    logger.log("success", f"🔗 Webhook registrado em {WEBHOOK_URL}/webhook/***")
+
 if __name__ == "__main__":
     try:
         # Mostrar banner
@@ -2238,17 +5499,27 @@ if __name__ == "__main__":
         # Mostrar status inicial
         mostrar_status_inicial()
 
-        # Iniciar servidor web
-        keep_alive()
-        logger.log("success", "Servidor web iniciado na porta 8080")
+        if BOT_MODO == "webhook":
+            # Updates chegam pelo Flask, que passa a ser o processo principal
+            configurar_webhook()
+            logger.log("info", "Iniciando bot Telegram em modo webhook...")
+            run_web_server()
+        else:
+            # Iniciar servidor web
+            keep_alive()
+            logger.log("success", "Servidor web iniciado na porta 8080")
 
-        # Iniciar bot
-        logger.log("info", "Iniciando bot Telegram...")
-        bot.infinity_polling(timeout=30, long_polling_timeout=10)
+            # Iniciar bot (um webhook ativo impediria o getUpdates)
+            logger.log("info", "Iniciando bot Telegram...")
+            bot.remove_webhook()
+            bot.infinity_polling(timeout=30, long_polling_timeout=10)
 
     except Exception as e:
         logger.log("error", f"Erro fatal: {e}")
         print(f"\n❌ ERRO FATAL: {e}")
         print("🔄 Reiniciando em 10 segundos...")
+        agendador.drenar()
+        user_sessions.persistir()
+        logger.fechar()
         time.sleep(10)
         os.execv(sys.executable, ['python'] + sys.argv)